@@ -26,13 +26,17 @@ import yaml
 
 from charmhelpers.fetch import (
     apt_install,
+    current_apt_batch,
     filter_installed_packages,
 )
+from charmhelpers.core import unitdata
 from charmhelpers.core.hookenv import (
     config,
     is_relation_made,
     local_unit,
     log,
+    inputs_changed,
+    record_inputs,
     relation_get,
     relation_ids,
     related_units,
@@ -93,10 +97,17 @@ class OSContextError(Exception):
 
 
 def ensure_packages(packages):
-    """Install but do not upgrade required plugin packages."""
+    """Install but do not upgrade required plugin packages.
+
+    Within a :func:`charmhelpers.fetch.apt_batch` block the packages are
+    queued on the batch instead of being installed straight away."""
     required = filter_installed_packages(packages)
     if required:
-        apt_install(required, fatal=True)
+        batch = current_apt_batch()
+        if batch is not None:
+            batch.install(required, fatal=True)
+        else:
+            apt_install(required, fatal=True)
 
 
 def context_complete(ctxt):
@@ -194,6 +205,72 @@ class OSContextGenerator(object):
         raise NotImplementedError
 
 
+class MemoizedContext(OSContextGenerator):
+    """Reuse the context of another generator until what it read changes.
+
+    The hook tool reads made by the generator, such as charm config and
+    relation ids, units and settings, are recorded with
+    :func:`hookenv.record_inputs`. Later calls repeat just those reads,
+    which are themselves cached for the hook, and return the previous
+    context if their results are unchanged. If one of them fails, as
+    reading a relation that has since departed does, the context is
+    generated again.
+
+    With `key` set, the context and the reads it depends on are also kept
+    in unitdata under that name, so later hooks can skip the generator
+    entirely while its inputs stay the same. Contexts that JSON would not
+    give back unchanged, such as those with tuples or keys that are not
+    strings, are generated again by every hook instead.
+
+    Only wrap generators whose context depends on nothing but hook tool
+    data, and whose side effects need not be repeated::
+
+        configs.register('/etc/nova/nova.conf',
+                         [MemoizedContext(SharedDBContext(), 'shared-db')])
+    """
+
+    def __init__(self, generator, key=None):
+        self.generator = generator
+        self.key = key
+        self._memo = None
+
+    @property
+    def interfaces(self):
+        return self.generator.interfaces
+
+    def __call__(self):
+        kv_key = 'openstack.context.%s' % self.key
+        db = unitdata.kv() if self.key is not None else None
+        if self._memo is None and db is not None:
+            self._memo = db.get(kv_key)
+        if self._memo is not None:
+            if not inputs_changed(self._memo['inputs']):
+                return self._memo['context']
+            self._memo = None
+
+        with record_inputs() as inputs:
+            ctxt = self.generator()
+        if db is not None and not _json_round_trips(ctxt):
+            log('Not storing context %s, it does not round trip through '
+                'JSON' % self.key, level=DEBUG)
+            inputs.memoisable = False
+        if not inputs.memoisable:
+            if db is not None:
+                db.unset(kv_key)
+            return ctxt
+        self._memo = {'inputs': inputs.replayable(), 'context': ctxt}
+        if db is not None:
+            db.set(kv_key, self._memo)
+        return ctxt
+
+
+def _json_round_trips(value):
+    try:
+        return json.loads(json.dumps(value)) == value
+    except (TypeError, ValueError):
+        return False
+
+
 class SharedDBContext(OSContextGenerator):
     interfaces = ['shared-db']
 
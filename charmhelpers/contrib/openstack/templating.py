@@ -15,10 +15,13 @@
 # along with charm-helpers.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import stat
+import time
 
 import six
 
 from charmhelpers.fetch import apt_install
+from charmhelpers.core.host import threaded_map, write_file
 from charmhelpers.core.hookenv import (
     log,
     ERROR,
@@ -83,6 +86,19 @@ def get_loader(templates_dir, os_release):
     return ChoiceLoader(loaders)
 
 
+def _file_owner(path):
+    """
+    Return the owner and group ids and the permissions of a file, or those
+    given to a new file if it does not exist. Ids are not looked up by name,
+    as files created from containers often have none.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return os.getuid(), os.getgid(), 0o644
+    return st.st_uid, st.st_gid, stat.S_IMODE(st.st_mode)
+
+
 class OSConfigTemplate(object):
     """
     Associates a config file template with a list of context generators.
@@ -98,10 +114,20 @@ class OSConfigTemplate(object):
 
         self._complete_contexts = []
 
-    def context(self):
+    def context(self, cache=None):
+        '''
+        Return the combined context of all generators. If `cache` is given,
+        it is a dict of generator results shared by templates, so that each
+        generator is only called once.
+        '''
         ctxt = {}
         for context in self.contexts:
-            _ctxt = context()
+            if cache is None:
+                _ctxt = context()
+            else:
+                if id(context) not in cache:
+                    cache[id(context)] = context()
+                _ctxt = cache[id(context)]
             if _ctxt:
                 ctxt.update(_ctxt)
                 # track interfaces for every complete context.
@@ -235,7 +261,9 @@ class OSConfigRenderer(object):
             log('Config not registered: %s' % config_file, level=ERROR)
             raise OSConfigException
         ctxt = self.templates[config_file].context()
+        return self._render(config_file, ctxt)
 
+    def _render(self, config_file, ctxt):
         _tmpl = os.path.basename(config_file)
         try:
             template = self._get_template(_tmpl)
@@ -258,23 +286,62 @@ class OSConfigRenderer(object):
     def write(self, config_file):
         """
         Write a single config file, raises if config file is not registered.
+        As with :meth:`write_all`, the file is only replaced if its content
+        has changed.
         """
         if config_file not in self.templates:
             log('Config not registered: %s' % config_file, level=ERROR)
             raise OSConfigException
 
-        _out = self.render(config_file)
+        self._write(config_file, self.templates[config_file].context())
 
-        with open(config_file, 'wb') as out:
-            out.write(_out)
-
-        log('Wrote template %s.' % config_file, level=INFO)
+    def _write(self, config_file, ctxt):
+        """
+        Render a config file and, if its content has changed, atomically
+        replace it, keeping the owner and permissions of the existing file.
 
-    def write_all(self):
+        Returns whether the file was written, and the milliseconds spent
+        rendering its template.
+        """
+        started = time.time()
+        _out = self._render(config_file, ctxt)
+        render_ms = (time.time() - started) * 1000
+        if isinstance(_out, six.text_type):
+            _out = _out.encode('UTF-8')
+        owner, group, perms = _file_owner(config_file)
+        changed = write_file(config_file, _out, owner, group, perms,
+                             if_changed=True)
+        if changed:
+            log('Wrote template %s.' % config_file, level=INFO)
+        return changed, render_ms
+
+    def write_all(self, max_workers=4):
         """
         Write out all registered config files.
+
+        Each context generator is called once, however many config files
+        share it. The templates are then rendered on up to `max_workers`
+        threads, and only files whose content has changed are written.
+
+        Returns a dict of each config file to a tuple of whether it was
+        written, and the milliseconds spent rendering its template and
+        generating its context.
         """
-        [self.write(k) for k in six.iterkeys(self.templates)]
+        if self.templates:
+            self._get_tmpl_env()
+        cache = {}
+        contexts = {}
+        for config_file, template in six.iteritems(self.templates):
+            started = time.time()
+            contexts[config_file] = (template.context(cache),
+                                     (time.time() - started) * 1000)
+
+        def write(config_file):
+            ctxt, context_ms = contexts[config_file]
+            changed, render_ms = self._write(config_file, ctxt)
+            return changed, render_ms, context_ms
+
+        return threaded_map(write, self.templates, max_workers)
 
     def set_release(self, openstack_release):
         """
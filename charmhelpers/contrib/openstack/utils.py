@@ -54,7 +54,12 @@ from charmhelpers.contrib.network.ip import (
 )
 
 from charmhelpers.core.host import lsb_release, mounts, umount
-from charmhelpers.fetch import apt_install, apt_cache, install_remote
+from charmhelpers.fetch import (
+    apt_install,
+    apt_cache,
+    install_remote,
+    installed_version,
+)
 from charmhelpers.contrib.python.packages import pip_install
 from charmhelpers.contrib.storage.linux.utils import is_block_device, zap_disk
 from charmhelpers.contrib.storage.linux.loopback import ensure_loopback_device
@@ -174,29 +179,35 @@ def get_os_codename_package(package, fatal=True):
     '''Derive OpenStack release codename from an installed package.'''
     import apt_pkg as apt
 
-    cache = apt_cache()
+    version = installed_version(package)
+    if version is not None:
+        apt.init()
+    else:
+        cache = apt_cache(shared=True)
 
-    try:
-        pkg = cache[package]
-    except:
-        if not fatal:
-            return None
-        # the package is unknown to the current apt cache.
-        e = 'Could not determine version of package with no installation '\
-            'candidate: %s' % package
-        error_out(e)
+        try:
+            pkg = cache[package]
+        except:
+            if not fatal:
+                return None
+            # the package is unknown to the current apt cache.
+            e = 'Could not determine version of package with no '\
+                'installation candidate: %s' % package
+            error_out(e)
 
-    if not pkg.current_ver:
-        if not fatal:
-            return None
-        # package is known, but no version is currently installed.
-        e = 'Could not determine version of uninstalled package: %s' % package
-        error_out(e)
+        if not pkg.current_ver:
+            if not fatal:
+                return None
+            # package is known, but no version is currently installed.
+            e = 'Could not determine version of uninstalled package: %s' % \
+                package
+            error_out(e)
+        version = pkg.current_ver.ver_str
 
-    vers = apt.upstream_version(pkg.current_ver.ver_str)
+    vers = apt.upstream_version(version)
 
     try:
-        if 'swift' in pkg.name:
+        if 'swift' in package:
             swift_vers = vers[:5]
             if swift_vers not in SWIFT_CODENAMES:
                 # Deal with 1.10.0 upward
@@ -22,6 +22,7 @@ from charmhelpers.core.hookenv import (
     relation_get,
     local_unit,
     relation_set,
+    relation_set_batch,
 )
 
 
@@ -138,12 +139,15 @@ def peer_store_and_set(relation_id=None, peer_relation_name='cluster',
                  relation_settings=relation_settings,
                  **kwargs)
     if is_relation_made(peer_relation_name):
-        for key, value in six.iteritems(dict(list(kwargs.items()) +
-                                             list(relation_settings.items()))):
-            key_prefix = relation_id or current_relation_id()
-            peer_store(key_prefix + delimiter + key,
-                       value,
-                       relation_name=peer_relation_name)
+        # Write all keys to the peer relation with one relation-set
+        with relation_set_batch():
+            for key, value in six.iteritems(
+                    dict(list(kwargs.items()) +
+                         list(relation_settings.items()))):
+                key_prefix = relation_id or current_relation_id()
+                peer_store(key_prefix + delimiter + key,
+                           value,
+                           relation_name=peer_relation_name)
     else:
         if peer_store_fatal:
             raise ValueError('Unable to detect '
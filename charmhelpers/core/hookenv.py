@@ -21,17 +21,26 @@
 #  Charm Helpers Developers <juju@lists.ubuntu.com>
 
 from __future__ import print_function
+from contextlib import contextmanager
 from functools import wraps
+import atexit
+import base64
+import hashlib
 import os
 import json
 import yaml
+import socket
 import subprocess
 import sys
 import errno
 import tempfile
+import threading
+import time
+from collections import OrderedDict
 from subprocess import CalledProcessError
 
 import six
+from six.moves import socketserver
 if not six.PY3:
     from UserDict import UserDict
 else:
@@ -44,7 +53,199 @@ INFO = "INFO"
 DEBUG = "DEBUG"
 MARKER = object()
 
-cache = {}
+
+class HookCache(object):
+    """Memoised results of :func:`cached` functions.
+
+    Entries are grouped in one namespace per cached function and keyed by
+    the tuple of that function's arguments, bound to its parameter names so
+    that ``relation_get('foo', rid='db:1')`` and
+    ``relation_get(attribute='foo', rid='db:1')`` share an entry. This allows
+    targeted invalidation::
+
+        cache.invalidate('relation_get', rid='db:1', unit='mysql/0')
+
+    The cache holds at most `maxsize` entries, evicting the least recently
+    used first, and entries older than `ttl` seconds are refetched. Either
+    limit may be None to disable it.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._namespaces = {}
+        self._params = {}
+        self._aliases = {}
+        self._lock = threading.RLock()
+        self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def configure(self, maxsize=MARKER, ttl=MARKER):
+        """Change the size or age limits, evicting entries as needed"""
+        with self._lock:
+            if maxsize is not MARKER:
+                self.maxsize = maxsize
+            if ttl is not MARKER:
+                self.ttl = ttl
+            self._evict()
+
+    def register(self, namespace, params, alias=None):
+        """Record the parameter names keys of `namespace` are bound to.
+
+        `alias`, such as the bare name of a function, may then be passed to
+        :meth:`invalidate` in place of `namespace`. Several namespaces can
+        share an alias.
+        """
+        self._params[namespace] = tuple(params)
+        if alias is not None and alias != namespace:
+            self._aliases.setdefault(alias, set()).add(namespace)
+
+    def get(self, namespace, key):
+        """Return a cached value, or raise :class:`KeyError`"""
+        with self._lock:
+            try:
+                value, stored = self._entries.pop((namespace, key))
+            except KeyError:
+                self.misses += 1
+                raise
+            if self.ttl is not None and time.time() - stored > self.ttl:
+                self._namespaces[namespace].discard(key)
+                self.misses += 1
+                raise KeyError(key)
+            self._entries[(namespace, key)] = (value, stored)
+            self.hits += 1
+            return value
+
+    def set(self, namespace, key, value):
+        with self._lock:
+            self._entries.pop((namespace, key), None)
+            self._entries[(namespace, key)] = (value, time.time())
+            self._namespaces.setdefault(namespace, set()).add(key)
+            self._evict()
+
+    def _evict(self):
+        if self.maxsize is None:
+            return
+        while len(self._entries) > self.maxsize:
+            (namespace, key), _ = self._entries.popitem(last=False)
+            self._namespaces[namespace].discard(key)
+            self.evictions += 1
+
+    def invalidate(self, namespace=None, **params):
+        """Drop cached entries.
+
+        With no arguments the whole cache is dropped. Given a `namespace`,
+        only entries of that function are dropped, optionally restricted to
+        those whose arguments match every keyword in `params`.
+        """
+        with self._lock:
+            if namespace is None:
+                self._entries.clear()
+                self._namespaces.clear()
+                return
+            for name in self._aliases.get(namespace, ()):
+                self._invalidate(name, params)
+            self._invalidate(namespace, params)
+
+    def _invalidate(self, namespace, params):
+        with self._lock:
+            keys = self._namespaces.get(namespace, set())
+            if params:
+                names = self._params.get(namespace, ())
+                positions = [(names.index(name), value)
+                             for name, value in params.items()
+                             if name in names]
+                if len(positions) != len(params):
+                    return
+                # Keys of unhashable arguments are opaque strings, so they
+                # are dropped conservatively.
+                keys = [key for key in keys
+                        if not isinstance(key, tuple) or
+                        all(key[i] == value for i, value in positions)]
+            for key in list(keys):
+                self._entries.pop((namespace, key), None)
+                self._namespaces[namespace].discard(key)
+
+    # The plain dict cache that preceded this class was also read and written
+    # directly, under keys of the caller's choosing. Those entries are kept
+    # in a namespace of their own.
+
+    def __getitem__(self, key):
+        return self.get(_LEGACY_NAMESPACE, key)
+
+    def __setitem__(self, key, value):
+        self.set(_LEGACY_NAMESPACE, key, value)
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._entries[(_LEGACY_NAMESPACE, key)]
+            self._namespaces[_LEGACY_NAMESPACE].discard(key)
+
+    def __contains__(self, key):
+        return (_LEGACY_NAMESPACE, key) in self._entries
+
+    def keys(self, namespace):
+        """Return the keys of the entries held for `namespace`"""
+        with self._lock:
+            return list(self._namespaces.get(namespace, ()))
+
+    def flush(self, match):
+        """Drop entries whose namespace or arguments mention `match`"""
+        with self._lock:
+            for namespace, key in list(self._entries):
+                if match in namespace or match in str(key):
+                    del self._entries[(namespace, key)]
+                    self._namespaces[namespace].discard(key)
+
+    def clear(self):
+        """Drop all entries and reset the statistics"""
+        self.invalidate()
+        self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self._entries),
+        }
+
+
+_LEGACY_NAMESPACE = ''
+
+cache = _cache = HookCache()
+# The functions decorated by cached(), by cache namespace.
+_cached_functions = {}
+
+
+def _active_cache():
+    """Return the :class:`HookCache` used by :func:`cached` functions.
+
+    When the cache was a plain dict it was reset with ``hookenv.cache = {}``.
+    For as long as the module's `cache` name is bound to something else
+    that way, the cache is emptied on every use, so that nothing cached
+    before the reset is returned. Call ``cache.clear()`` instead.
+    """
+    if cache is not _cache:
+        _cache.clear()
+    return _cache
+
+
+def _cache_key(params, defaults, args, kwargs):
+    if len(args) > len(params) or not set(kwargs).issubset(params):
+        return None
+    values = dict(defaults)
+    values.update(zip(params, args))
+    values.update(kwargs)
+    key = tuple(values.get(name) for name in params)
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
 
 
 def cached(func):
@@ -59,44 +260,499 @@ def cached(func):
         unit_get('test')
 
     will cache the result of unit_get + 'test' for future calls.
+    Results are stored in the module level :class:`HookCache`, under a
+    namespace named after the function's module and qualified name, which
+    is numbered if another cached function has the same name. The
+    bare function name, such as ``'unit_get'``, is an alias of that
+    namespace for :meth:`HookCache.invalidate` and :func:`flush`.
     """
+    code = six.get_function_code(func)
+    params = code.co_varnames[:code.co_argcount]
+    defaults = six.get_function_defaults(func) or ()
+    defaults = list(zip(params[len(params) - len(defaults):], defaults))
+    namespace = _function_namespace(func)
+    _cache.register(namespace, params, alias=func.__name__)
+
     @wraps(func)
     def wrapper(*args, **kwargs):
-        global cache
-        key = str((func, args, kwargs))
+        key = _cache_key(params, defaults, args, kwargs)
+        if key is None:
+            key = repr((args, sorted(kwargs.items())))
         try:
-            return cache[key]
+            res = _active_cache().get(namespace, key)
         except KeyError:
-            pass  # Drop out of the exception handler scope.
-        res = func(*args, **kwargs)
-        cache[key] = res
+            res = MARKER  # Drop out of the exception handler scope.
+        if res is MARKER:
+            res = _read(func, args, kwargs)
+            _active_cache().set(namespace, key, res)
+        _record(namespace, args, kwargs, res)
+        return res
+    _cached_functions[namespace] = wrapper
+    return wrapper
+
+
+def _function_namespace(func):
+    """Name a function after its module and qualified name, numbered
+    if another registered function has the same name, as functions made
+    by the same factory do."""
+    namespace = name = '%s.%s' % (
+        func.__module__, getattr(func, '__qualname__', func.__name__))
+    count = 1
+    while namespace in _cached_functions:
+        count += 1
+        namespace = '%s#%d' % (name, count)
+    return namespace
+
+
+def _recorded(func):
+    """Record the calls made to func by :func:`record_inputs`, so that
+    they can be replayed, without caching its results.
+
+    For reads that are cheap or must not be cached for the whole hook,
+    such as :func:`relation_id` and :func:`leader_get`.
+    """
+    namespace = _function_namespace(func)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        res = _read(func, args, kwargs)
+        _record(namespace, args, kwargs, res)
         return res
+    _cached_functions[namespace] = wrapper
     return wrapper
 
 
+_recorders = threading.local()
+
+
+class RecordedInputs(list):
+    """The (cache namespace, args, kwargs, result) tuples recorded by
+    :func:`record_inputs`.
+
+    `memoisable` is False if a hook tool was read in a way that cannot be
+    replayed, in which case whatever was computed from the reads has to
+    be computed again next time. Callers reading charm state that
+    :func:`inputs_changed` doesn't know about should set it too.
+    """
+    memoisable = True
+
+    def replayable(self):
+        """Return the recorded calls as (cache namespace, args, kwargs,
+        result digest) lists, which can be stored in unitdata and passed to
+        :func:`inputs_changed`."""
+        return [[name, list(args), kwargs, _result_digest(result)]
+                for name, args, kwargs, result in self]
+
+
+@contextmanager
+def record_inputs():
+    """Record the calls made to :func:`cached` functions, such as
+    :func:`config` and :func:`relation_get`, and to the uncached reads
+    such as :func:`relation_id` and :func:`leader_get`, by the current
+    thread within the block.
+
+    Yields a :class:`RecordedInputs` list that is appended a (cache
+    namespace, args, kwargs, result) tuple for each call, so that the calls
+    can be repeated later to find out whether what was read has changed::
+
+        with record_inputs() as inputs:
+            ctxt = generate_context()
+    """
+    inputs = RecordedInputs()
+    if not hasattr(_recorders, 'active'):
+        _recorders.active = []
+    _recorders.active.append(inputs)
+    try:
+        yield inputs
+    finally:
+        _recorders.active.pop()
+
+
+def share_recording(func):
+    """Wrap func so that the reads it makes, on whichever thread it is
+    called, are recorded by the :func:`record_inputs` blocks active on the
+    current thread.
+
+    For handing work within those blocks to other threads, which would
+    otherwise go unrecorded, as :func:`host.threaded_map` does.
+    """
+    recorders = list(getattr(_recorders, 'active', ()))
+    if not recorders:
+        return func
+    owner = threading.current_thread()
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if threading.current_thread() is owner:
+            return func(*args, **kwargs)
+        previous = getattr(_recorders, 'active', [])
+        _recorders.active = previous + recorders
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _recorders.active = previous
+    return wrapper
+
+
+def _record(namespace, args, kwargs, result):
+    if getattr(_recorders, 'depth', 0):
+        return  # Replaying the outermost read repeats this one.
+    for recorder in getattr(_recorders, 'active', ()):
+        recorder.append((namespace, args, kwargs, result))
+
+
+def _read(func, args, kwargs):
+    """Call the function of a recorded read.
+
+    A read that fails is not recorded, so if the caller handles the error,
+    what it computes would pass for unchanged while the read still fails.
+    Any recording in progress is made unmemoisable instead.
+    """
+    try:
+        with _reading():
+            return func(*args, **kwargs)
+    except Exception:
+        _unmemoisable()
+        raise
+
+
+def _unmemoisable():
+    """Make the recordings in progress unmemoisable, unless the read is
+    made by a recorded function, whose replay would repeat it."""
+    if not getattr(_recorders, 'depth', 0):
+        for recorder in getattr(_recorders, 'active', ()):
+            recorder.memoisable = False
+
+
+@contextmanager
+def _reading():
+    """Mark hook tools run by the current thread within the block as
+    read by a recorded function."""
+    _recorders.depth = getattr(_recorders, 'depth', 0) + 1
+    try:
+        yield
+    finally:
+        _recorders.depth -= 1
+
+
+def _check_output(cmd, **kwargs):
+    """Read the output of a hook tool through the active transport.
+
+    Reads made outside of :func:`cached` or :func:`_recorded` functions
+    cannot be replayed, so they make any recording in progress
+    unmemoisable rather than letting it pass for unchanged.
+    """
+    _unmemoisable()
+    return _transport.check_output(cmd, **kwargs)
+
+
+def inputs_changed(replayable):
+    """Whether repeating the calls returned by
+    :meth:`RecordedInputs.replayable` gives different results.
+
+    The calls are repeated in the order they were recorded, stopping at the
+    first whose result differs, so that reads which depended on it, such as
+    the settings of a relation that is no longer listed, are not attempted.
+    A call that fails, as relation-get does once a relation has departed,
+    or of a function that no longer exists, counts as a change.
+    """
+    for entry in replayable:
+        if len(entry) != 4:
+            return True
+        name, args, kwargs, digest = entry
+        func = _cached_functions.get(name)
+        if func is None:
+            return True
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            return True
+        if _result_digest(result) != digest:
+            return True
+    return False
+
+
+def _result_digest(result):
+    return hashlib.sha1(json.dumps(
+        result, sort_keys=True, default=repr).encode('UTF-8')).hexdigest()
+
+
 def flush(key):
     """Flushes any entries from function cache where the
-    key is found in the function+args """
-    flush_list = []
-    for item in cache:
-        if key in item:
-            flush_list.append(item)
-    for item in flush_list:
-        del cache[item]
+    key is found in the function name or its arguments.
+
+    Prefer :meth:`HookCache.invalidate`, which only inspects the
+    entries of a single function."""
+    _active_cache().flush(key)
+
+
+class HookToolTransport(object):
+    """Channel through which Juju hook tools are invoked.
+
+    Every helper in this module runs hook tools (config-get, relation-get,
+    juju-log, ...) through the active transport, which mirrors the parts of
+    the :mod:`subprocess` API used here. See :func:`set_transport`.
+    """
+
+    def check_output(self, cmd, **kwargs):
+        raise NotImplementedError
+
+    def check_call(self, cmd, **kwargs):
+        raise NotImplementedError
+
+    def call(self, cmd, **kwargs):
+        raise NotImplementedError
+
+
+class SubprocessTransport(HookToolTransport):
+    """Run every hook tool in a fresh process (the default)"""
+
+    def check_output(self, cmd, **kwargs):
+        return subprocess.check_output(cmd, **kwargs)
+
+    def check_call(self, cmd, **kwargs):
+        return subprocess.check_call(cmd, **kwargs)
+
+    def call(self, cmd, **kwargs):
+        return subprocess.call(cmd, **kwargs)
+
+
+class SocketTransport(HookToolTransport):
+    """Send hook tool invocations to a :class:`HookToolServer`.
+
+    A single connection to the server's unix socket is opened on first use
+    and reused for every request, so a hook pays for one connection rather
+    than one fork+exec per hook tool. Requests and responses are JSON
+    documents, one per line, tagged with an id; :meth:`run_many` pipelines
+    several requests over the channel before reading any response.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._sock = None
+        self._reader = None
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def close(self):
+        with self._lock:
+            self._disconnect()
+
+    def _disconnect(self):
+        if self._sock is not None:
+            self._reader.close()
+            self._sock.close()
+            self._sock = self._reader = None
+
+    def _connect(self):
+        if self._sock is None:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.connect(self.path)
+            self._reader = self._sock.makefile('rb')
+
+    def _send(self, cmd):
+        self._next_id += 1
+        request = {'id': self._next_id, 'args': list(cmd)}
+        self._sock.sendall(json.dumps(request).encode('UTF-8') + b'\n')
+        return self._next_id
+
+    def _receive(self):
+        line = self._reader.readline()
+        if not line:
+            raise IOError('hook tool server closed the connection')
+        response = json.loads(line.decode('UTF-8'))
+        if response.get('errno') is not None:
+            response['error'] = OSError(response['errno'],
+                                        os.strerror(response['errno']))
+        response['output'] = base64.b64decode(response['output'])
+        return response
+
+    def run_many(self, cmds):
+        """Run several hook tools, returning (returncode, output) pairs.
+
+        All requests are written before any response is read. Tools that
+        could not be executed yield an :class:`OSError` in place of the pair.
+        """
+        with self._lock:
+            try:
+                self._connect()
+                ids = [self._send(cmd) for cmd in cmds]
+                responses = {}
+                for _ in ids:
+                    response = self._receive()
+                    responses[response['id']] = response
+            except Exception:
+                # Responses may still be on their way, so the connection
+                # cannot be reused. The next request opens another.
+                self._disconnect()
+                raise
+        results = []
+        for request_id in ids:
+            response = responses[request_id]
+            if 'error' in response:
+                results.append(response['error'])
+            else:
+                results.append((response['returncode'], response['output']))
+        return results
+
+    def _run(self, cmd):
+        result = self.run_many([cmd])[0]
+        if isinstance(result, OSError):
+            raise result
+        return result
+
+    def check_output(self, cmd, universal_newlines=False, **kwargs):
+        returncode, output = self._run(cmd)
+        if returncode:
+            raise CalledProcessError(returncode, cmd, output)
+        if universal_newlines:
+            return output.decode('UTF-8')
+        return output
+
+    def check_call(self, cmd, **kwargs):
+        returncode, _ = self._run(cmd)
+        if returncode:
+            raise CalledProcessError(returncode, cmd)
+        return 0
+
+    def call(self, cmd, **kwargs):
+        return self._run(cmd)[0]
+
+
+def run_hook_tool(args):
+    """Run a hook tool, returning its exit code and standard output"""
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE)
+    output = proc.communicate()[0]
+    return proc.returncode, output
+
+
+class _HookToolRequestHandler(socketserver.StreamRequestHandler):
+
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        self.server._add_connection(self.connection)
+
+    def finish(self):
+        self.server._remove_connection(self.connection)
+        socketserver.StreamRequestHandler.finish(self)
+
+    def handle(self):
+        for line in iter(self.rfile.readline, b''):
+            request = json.loads(line.decode('UTF-8'))
+            response = {'id': request['id'], 'errno': None}
+            try:
+                returncode, output = self.server.handler(request['args'])
+            except OSError as e:
+                returncode, output = None, b''
+                response['errno'] = e.errno
+            response['returncode'] = returncode
+            response['output'] = base64.b64encode(output).decode('ascii')
+            self.wfile.write(json.dumps(response).encode('UTF-8') + b'\n')
+            self.wfile.flush()
+
+
+class HookToolServer(socketserver.ThreadingMixIn,
+                     socketserver.UnixStreamServer):
+    """Serve hook tool requests from :class:`SocketTransport` clients.
+
+    `handler` is called with the argument list of each request and must
+    return an ``(exit code, output bytes)`` pair, or raise :class:`OSError`
+    if the tool cannot be run. It defaults to :func:`run_hook_tool`; tests
+    can pass a function returning canned responses to stand in for Juju::
+
+        server = HookToolServer('/tmp/hook-tools.sock', fake_handler)
+        server.start()
+        set_transport(SocketTransport(server.path))
+    """
+    daemon_threads = True
+
+    def __init__(self, path, handler=None):
+        socketserver.UnixStreamServer.__init__(
+            self, path, _HookToolRequestHandler)
+        self.path = path
+        self.handler = handler or run_hook_tool
+        self._thread = None
+        self._connections = set()
+        self._connections_lock = threading.Lock()
+        self._stopped = False
+
+    def start(self, poll_interval=0.1):
+        """Serve requests from a background thread"""
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        args=(poll_interval,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop serving, and close the connections of existing clients"""
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+        with self._connections_lock:
+            self._stopped = True
+            connections, self._connections = self._connections, set()
+        for connection in connections:
+            _close_connection(connection)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def _add_connection(self, connection):
+        with self._connections_lock:
+            if not self._stopped:
+                self._connections.add(connection)
+                return
+        _close_connection(connection)
+
+    def _remove_connection(self, connection):
+        with self._connections_lock:
+            self._connections.discard(connection)
+
+
+def _close_connection(connection):
+    """Shut a connection down, so that the thread serving it stops"""
+    try:
+        connection.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+        pass  # Already closed by the client.
+
+
+_transport = SubprocessTransport()
+
+
+def get_transport():
+    """Return the transport used to invoke hook tools"""
+    return _transport
+
+
+def set_transport(transport):
+    """Route all hook tool invocations through `transport`.
+
+    Returns the previously active transport so it can be restored.
+    """
+    global _transport
+    previous, _transport = _transport, transport
+    return previous
 
 
 def log(message, level=None):
     """Write a message to the juju log"""
+    if not isinstance(message, six.string_types):
+        message = repr(message)
+    if _log_buffer is not None:
+        _log_buffer.write(message, level)
+        return
+    _juju_log(message, level)
+
+
+def _juju_log(message, level=None):
     command = ['juju-log']
     if level:
         command += ['-l', level]
-    if not isinstance(message, six.string_types):
-        message = repr(message)
     command += [message]
     # Missing juju-log should not cause failures in unit tests
     # Send log output to stderr
     try:
-        subprocess.call(command)
+        _transport.call(command)
     except OSError as e:
         if e.errno == errno.ENOENT:
             if level:
@@ -107,6 +763,147 @@ def log(message, level=None):
             raise
 
 
+LOG_LEVELS = {DEBUG: 10, INFO: 20, WARNING: 30, ERROR: 40, CRITICAL: 50}
+
+
+class LogBuffer(object):
+    """Queue of log messages written to juju-log in batches.
+
+    Messages below `threshold` are dropped without invoking juju-log.
+    The rest are queued and written by :meth:`flush`, which joins runs of
+    consecutive messages of the same level into a single juju-log call and
+    collapses repeats of an identical message into one line. Once started,
+    a background thread flushes the queue every `flush_interval` seconds,
+    or sooner when `max_pending` messages are waiting.
+
+    :attr:`stats` counts messages ``queued``, ``dropped`` below the
+    threshold, ``coalesced`` into another message's juju-log call, and
+    the juju-log ``invocations`` made.
+    """
+
+    def __init__(self, threshold=DEBUG, flush_interval=1.0, max_pending=100):
+        self.threshold = threshold
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.stats = {'queued': 0, 'dropped': 0, 'coalesced': 0,
+                      'invocations': 0}
+        self._pending = []
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Condition()
+        self._thread = None
+        self._stopping = False
+
+    def write(self, message, level=None):
+        rank = LOG_LEVELS.get((level or INFO).upper())
+        if rank is not None and rank < LOG_LEVELS.get(self.threshold, 0):
+            self.stats['dropped'] += 1
+            return
+        with self._wakeup:
+            self._pending.append((level, message))
+            self.stats['queued'] += 1
+            if len(self._pending) >= self.max_pending:
+                self._wakeup.notify()
+
+    def flush(self):
+        """Write all queued messages to juju-log"""
+        with self._flush_lock:
+            with self._wakeup:
+                pending, self._pending = self._pending, []
+            batches = []
+            for level, message in pending:
+                if batches and batches[-1][0] == level:
+                    lines = batches[-1][1]
+                    if lines[-1][0] == message:
+                        lines[-1][1] += 1
+                    else:
+                        lines.append([message, 1])
+                    self.stats['coalesced'] += 1
+                else:
+                    batches.append((level, [[message, 1]]))
+            for level, lines in batches:
+                _juju_log('\n'.join(
+                    message if count == 1 else
+                    '{} (repeated {} times)'.format(message, count)
+                    for message, count in lines), level)
+                self.stats['invocations'] += 1
+
+    def _run(self):
+        while True:
+            with self._wakeup:
+                if (not self._stopping and
+                        len(self._pending) < self.max_pending):
+                    self._wakeup.wait(self.flush_interval)
+                stopping = self._stopping
+            self.flush()
+            if stopping:
+                return
+
+    def start(self):
+        """Flush the queue from a background thread"""
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread, flushing any queued messages"""
+        if self._thread is not None:
+            with self._wakeup:
+                self._stopping = True
+                self._wakeup.notify()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+
+_log_buffer = None
+
+
+def enable_log_buffer(threshold=DEBUG, flush_interval=1.0):
+    """Buffer log() messages instead of running juju-log for each one.
+
+    Queued messages are flushed by a background thread and when the
+    interpreter exits. Returns the active :class:`LogBuffer`.
+    """
+    global _log_buffer
+    if _log_buffer is None:
+        _log_buffer = LogBuffer(threshold, flush_interval)
+        _log_buffer.start()
+    return _log_buffer
+
+
+def disable_log_buffer():
+    """Flush buffered log messages and go back to unbuffered logging"""
+    global _log_buffer
+    log_buffer, _log_buffer = _log_buffer, None
+    if log_buffer is not None:
+        log_buffer.stop()
+    return log_buffer
+
+
+atexit.register(disable_log_buffer)
+
+
+@contextmanager
+def buffered_log(threshold=DEBUG, flush_interval=1.0):
+    """Buffer log() messages for the duration of the block.
+
+    Queued messages are flushed when the block exits, including when it
+    raises, so messages describing a failure are not lost::
+
+        with buffered_log(threshold=INFO):
+            hooks.execute(sys.argv)
+    """
+    if _log_buffer is not None:
+        yield _log_buffer
+        return
+    log_buffer = enable_log_buffer(threshold, flush_interval)
+    try:
+        yield log_buffer
+    finally:
+        disable_log_buffer()
+
+
 class Serializable(UserDict):
     """Wrapper, an object that can be serialized to yaml or json"""
 
@@ -165,11 +962,13 @@ def in_relation_hook():
     return 'JUJU_RELATION' in os.environ
 
 
+@_recorded
 def relation_type():
     """The scope for the current relation hook"""
     return os.environ.get('JUJU_RELATION', None)
 
 
+@_recorded
 def relation_id():
     """The relation ID for the current relation hook"""
     return os.environ.get('JUJU_RELATION_ID', None)
@@ -180,6 +979,7 @@ def local_unit():
     return os.environ['JUJU_UNIT_NAME']
 
 
+@_recorded
 def remote_unit():
     """The remote unit for the current relation hook"""
     return os.environ.get('JUJU_REMOTE_UNIT', None)
@@ -190,6 +990,7 @@ def service_name():
     return local_unit().split('/')[0]
 
 
+@_recorded
 def hook_name(args=sys.argv):
     """The name of the currently executing hook"""
     script = os.path.basename(args[0])
@@ -334,7 +1135,7 @@ def config(scope=None):
     config_cmd_line.append('--format=json')
     try:
         config_data = json.loads(
-            subprocess.check_output(config_cmd_line).decode('UTF-8'))
+            _check_output(config_cmd_line).decode('UTF-8'))
         if scope is not None:
             return config_data
         return Config(config_data)
@@ -342,9 +1143,32 @@ def config(scope=None):
         return None
 
 
+# Settings of remote units fetched in bulk by prefetch_relation() are kept
+# in the HookCache, keyed by unit and relation id. The namespace is an alias
+# of relation_get, so invalidating or flushing relation_get drops them too.
+_RELATION_SNAPSHOT = 'charmhelpers.core.hookenv.relation_get.snapshot'
+_cache.register(_RELATION_SNAPSHOT, ('unit', 'rid'), alias='relation_get')
+relation_snapshot_stats = {'invocations': 0, 'saved': 0}
+
+
 @cached
 def relation_get(attribute=None, unit=None, rid=None):
     """Get relation information"""
+    if _active_cache().keys(_RELATION_SNAPSHOT):
+        try:
+            settings = _active_cache().get(_RELATION_SNAPSHOT, (
+                unit or remote_unit(), rid or relation_id()))
+        except KeyError:
+            pass
+        else:
+            relation_snapshot_stats['saved'] += 1
+            if attribute:
+                return settings.get(attribute)
+            return dict(settings)
+    return _relation_get(attribute, unit, rid)
+
+
+def _relation_get(attribute=None, unit=None, rid=None):
     _args = ['relation-get', '--format=json']
     if rid:
         _args.append('-r')
@@ -353,7 +1177,7 @@ def relation_get(attribute=None, unit=None, rid=None):
     if unit:
         _args.append(unit)
     try:
-        return json.loads(subprocess.check_output(_args).decode('UTF-8'))
+        return json.loads(_check_output(_args).decode('UTF-8'))
     except ValueError:
         return None
     except CalledProcessError as e:
@@ -362,24 +1186,111 @@ def relation_get(attribute=None, unit=None, rid=None):
         raise
 
 
+def prefetch_relation(rid=None):
+    """Fetch the settings of every remote unit on a relation in one pass.
+
+    Each unit's settings are retrieved with a single relation-get call and
+    kept in the hook cache. Later calls to :func:`relation_get` (and so
+    :func:`relation_for_unit`, :func:`relations_for_id` and
+    :func:`relations_of_type`) for those units are answered from them
+    instead of invoking relation-get once per attribute, until they are
+    dropped with ``cache.invalidate('relation_get', rid=rid)`` or
+    :func:`flush_relation_snapshot`.
+    """
+    rid = rid or relation_id()
+    _active_cache().invalidate(_RELATION_SNAPSHOT, rid=rid)
+    units = {}
+    for unit in related_units(rid):
+        units[unit] = _relation_get(unit=unit, rid=rid) or {}
+        relation_snapshot_stats['invocations'] += 1
+        _active_cache().set(_RELATION_SNAPSHOT, (unit, rid),
+                            dict(units[unit]))
+    return units
+
+
+def prefetch_relations(reltype=None):
+    """Prefetch the settings of all relation ids of a relation type"""
+    return dict((rid, prefetch_relation(rid))
+                for rid in relation_ids(reltype))
+
+
+def flush_relation_snapshot(rid=None):
+    """Drop prefetched and cached settings of a relation id, or of all of
+    them"""
+    if rid is None:
+        _active_cache().invalidate('relation_get')
+        return
+    rids = set([rid])
+    if rid == os.environ.get('JUJU_RELATION_ID'):
+        rids.add(None)
+    for rid in rids:
+        _active_cache().invalidate('relation_get', rid=rid)
+
+
+_relation_set_accepts_file = None
+_relation_set_batch = None
+
+
+def relation_set_accepts_file():
+    """Whether relation-set supports --file, probed once per process"""
+    global _relation_set_accepts_file
+    if _relation_set_accepts_file is None:
+        help_text = _transport.check_output(['relation-set', '--help'])
+        if isinstance(help_text, bytes):
+            help_text = help_text.decode('UTF-8')
+        _relation_set_accepts_file = "--file" in help_text
+    return _relation_set_accepts_file
+
+
+@contextmanager
+def relation_set_batch():
+    """Coalesce relation_set() calls made within the block.
+
+    Settings destined for the same relation id are merged, later values
+    winning, and written with a single relation-set invocation per relation
+    id when the block exits. Nested blocks join the outermost one. If the
+    block raises, the pending settings are discarded.
+
+    While the block is active, relation_get() for the local unit still
+    returns the settings from before the block.
+    """
+    global _relation_set_batch
+    if _relation_set_batch is not None:
+        yield
+        return
+    _relation_set_batch = OrderedDict()
+    try:
+        yield
+        pending = _relation_set_batch
+    finally:
+        _relation_set_batch = None
+    for relation_id, settings in pending.items():
+        _relation_set(relation_id, settings)
+
+
 def relation_set(relation_id=None, relation_settings=None, **kwargs):
     """Set relation information for the current unit"""
     relation_settings = relation_settings if relation_settings else {}
+    settings = relation_settings.copy()
+    settings.update(kwargs)
+    if _relation_set_batch is not None:
+        _relation_set_batch.setdefault(relation_id, {}).update(settings)
+        return
+    _relation_set(relation_id, settings)
+
+
+def _relation_set(relation_id, settings):
     relation_cmd_line = ['relation-set']
-    accepts_file = "--file" in subprocess.check_output(
-        relation_cmd_line + ["--help"])
     if relation_id is not None:
         relation_cmd_line.extend(('-r', relation_id))
-    settings = relation_settings.copy()
-    settings.update(kwargs)
-    if accepts_file:
+    if relation_set_accepts_file():
         # --file was introduced in Juju 1.23.2. Use it by default if
         # available, since otherwise we'll break if the relation data is
         # too big. Ideally we should tell relation-set to read the data from
         # stdin, but that feature is broken in 1.23.2: Bug #1454678.
         with tempfile.NamedTemporaryFile(delete=False) as settings_file:
             settings_file.write(yaml.safe_dump(settings).encode("utf-8"))
-        subprocess.check_call(
+        _transport.check_call(
             relation_cmd_line + ["--file", settings_file.name])
         os.remove(settings_file.name)
     else:
@@ -388,9 +1299,18 @@ def relation_set(relation_id=None, relation_settings=None, **kwargs):
                 relation_cmd_line.append('{}='.format(key))
             else:
                 relation_cmd_line.append('{}={}'.format(key, value))
-        subprocess.check_call(relation_cmd_line)
-    # Flush cache of any relation-gets for local unit
-    flush(local_unit())
+        _transport.check_call(relation_cmd_line)
+    # Flush cache of any relation-gets for local unit on this relation
+    current_rid = os.environ.get('JUJU_RELATION_ID')
+    rids = set([relation_id])
+    if relation_id in (None, current_rid):
+        rids.update([None, current_rid])
+    for rid in rids:
+        _active_cache().invalidate('relation_get', unit=local_unit(),
+                                   rid=rid)
+        _active_cache().invalidate('relation_for_unit', unit=local_unit(),
+                                   rid=rid)
+    _active_cache().invalidate('relations')
 
 
 def relation_clear(r_id=None):
@@ -412,7 +1332,7 @@ def relation_ids(reltype=None):
     if reltype is not None:
         relid_cmd_line.append(reltype)
         return json.loads(
-            subprocess.check_output(relid_cmd_line).decode('UTF-8')) or []
+            _check_output(relid_cmd_line).decode('UTF-8')) or []
     return []
 
 
@@ -424,7 +1344,7 @@ def related_units(relid=None):
     if relid is not None:
         units_cmd_line.extend(('-r', relid))
     return json.loads(
-        subprocess.check_output(units_cmd_line).decode('UTF-8')) or []
+        _check_output(units_cmd_line).decode('UTF-8')) or []
 
 
 @cached
@@ -528,14 +1448,14 @@ def open_port(port, protocol="TCP"):
     """Open a service network port"""
     _args = ['open-port']
     _args.append('{}/{}'.format(port, protocol))
-    subprocess.check_call(_args)
+    _transport.check_call(_args)
 
 
 def close_port(port, protocol="TCP"):
     """Close a service network port"""
     _args = ['close-port']
     _args.append('{}/{}'.format(port, protocol))
-    subprocess.check_call(_args)
+    _transport.check_call(_args)
 
 
 @cached
@@ -543,7 +1463,7 @@ def unit_get(attribute):
     """Get the unit ID for the remote unit"""
     _args = ['unit-get', '--format=json', attribute]
     try:
-        return json.loads(subprocess.check_output(_args).decode('UTF-8'))
+        return json.loads(_check_output(_args).decode('UTF-8'))
     except ValueError:
         return None
 
@@ -632,7 +1552,7 @@ def action_get(key=None):
     if key is not None:
         cmd.append(key)
     cmd.append('--format=json')
-    action_data = json.loads(subprocess.check_output(cmd).decode('UTF-8'))
+    action_data = json.loads(_check_output(cmd).decode('UTF-8'))
     return action_data
 
 
@@ -641,14 +1561,14 @@ def action_set(values):
     cmd = ['action-set']
     for k, v in list(values.items()):
         cmd.append('{}={}'.format(k, v))
-    subprocess.check_call(cmd)
+    _transport.check_call(cmd)
 
 
 def action_fail(message):
     """Sets the action status to failed and sets the error message.
 
     The results set by action_set are preserved."""
-    subprocess.check_call(['action-fail', message])
+    _transport.check_call(['action-fail', message])
 
 
 def status_set(workload_state, message):
@@ -668,7 +1588,7 @@ def status_set(workload_state, message):
         )
     cmd = ['status-set', workload_state, message]
     try:
-        ret = subprocess.call(cmd)
+        ret = _transport.call(cmd)
         if ret == 0:
             return
     except OSError as e:
@@ -679,6 +1599,7 @@ def status_set(workload_state, message):
     log(log_message, level='INFO')
 
 
+@_recorded
 def status_get():
     """Retrieve the previously set juju workload state
 
@@ -687,7 +1608,7 @@ def status_get():
     """
     cmd = ['status-get']
     try:
-        raw_status = subprocess.check_output(cmd, universal_newlines=True)
+        raw_status = _check_output(cmd, universal_newlines=True)
         status = raw_status.rstrip()
         return status
     except OSError as e:
@@ -699,6 +1620,7 @@ def status_get():
 
 def translate_exc(from_exc, to_exc):
     def inner_translate_exc1(f):
+        @wraps(f)
         def inner_translate_exc2(*args, **kwargs):
             try:
                 return f(*args, **kwargs)
@@ -710,6 +1632,7 @@ def translate_exc(from_exc, to_exc):
     return inner_translate_exc1
 
 
+@_recorded
 @translate_exc(from_exc=OSError, to_exc=NotImplementedError)
 def is_leader():
     """Does the current unit hold the juju leadership
@@ -717,14 +1640,15 @@ def is_leader():
     Uses juju to determine whether the current unit is the leader of its peers
     """
     cmd = ['is-leader', '--format=json']
-    return json.loads(subprocess.check_output(cmd).decode('UTF-8'))
+    return json.loads(_check_output(cmd).decode('UTF-8'))
 
 
+@_recorded
 @translate_exc(from_exc=OSError, to_exc=NotImplementedError)
 def leader_get(attribute=None):
     """Juju leader get value(s)"""
     cmd = ['leader-get', '--format=json'] + [attribute or '-']
-    return json.loads(subprocess.check_output(cmd).decode('UTF-8'))
+    return json.loads(_check_output(cmd).decode('UTF-8'))
 
 
 @translate_exc(from_exc=OSError, to_exc=NotImplementedError)
@@ -739,4 +1663,4 @@ def leader_set(settings=None, **kwargs):
             cmd.append('{}='.format(k))
         else:
             cmd.append('{}={}'.format(k, v))
-    subprocess.check_call(cmd)
+    _transport.check_call(cmd)
@@ -24,19 +24,32 @@
 import os
 import re
 import pwd
+import glob
 import grp
 import random
+import signal
 import string
+import stat
 import subprocess
+import sys
 import hashlib
+import tempfile
+import threading
+import time
 from contextlib import contextmanager
 from collections import OrderedDict
 
 import six
 
-from .hookenv import log
+from . import unitdata
+from .hookenv import log, share_recording, WARNING
 from .fstab import Fstab
 
+# Files are hashed this many bytes at a time.
+HASH_CHUNK_SIZE = 64 * 1024
+
+_GLOB_MAGIC = re.compile('[*?[]')
+
 
 def service_start(service_name):
     """Start a system service"""
@@ -62,10 +75,35 @@ def service_reload(service_name, restart_on_failure=False):
     return service_result
 
 
-def service(action, service_name):
-    """Control a system service"""
+def service(action, service_name, timeout=None):
+    """Control a system service, giving up after `timeout` seconds"""
     cmd = ['service', service_name, action]
-    return subprocess.call(cmd) == 0
+    if timeout is None:
+        return subprocess.call(cmd) == 0
+    return _call_with_timeout(cmd, timeout) == 0
+
+
+def _call_with_timeout(cmd, timeout):
+    """Run `cmd` and return its exit status, or None if it was killed for
+    running longer than `timeout` seconds.
+
+    The command runs in a process group of its own, which is killed as a
+    whole, so that the systemctl or initctl started by `service` does not
+    outlive it holding the service's lock."""
+    proc = subprocess.Popen(cmd, preexec_fn=os.setsid)
+    deadline = time.time() + timeout
+    while proc.poll() is None:
+        if time.time() >= deadline:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass  # Exited meanwhile.
+            proc.wait()
+            log('%s timed out after %s seconds' % (' '.join(cmd), timeout),
+                level=WARNING)
+            return None
+        time.sleep(0.1)
+    return proc.returncode
 
 
 def service_running(service):
@@ -190,15 +228,77 @@ def mkdir(path, owner='root', group='root', perms=0o555, force=False):
     os.chmod(realpath, perms)
 
 
-def write_file(path, content, owner='root', group='root', perms=0o444):
-    """Create or overwrite a file with the contents of a byte string."""
+def write_file(path, content, owner='root', group='root', perms=0o444,
+               if_changed=False):
+    """Create or overwrite a file with the contents of a byte string.
+
+    With `if_changed` set, a file that already holds `content` is left
+    alone apart from correcting its ownership and permissions. Otherwise
+    the content is written to a temporary file in the same directory,
+    synced, and renamed over `path`, so readers never see a partial file.
+
+    `owner` and `group` may be names or numeric ids.
+
+    :returns: Whether the contents of the file were written.
+    """
+    uid = owner if isinstance(owner, int) else pwd.getpwnam(owner).pw_uid
+    gid = group if isinstance(group, int) else grp.getgrnam(group).gr_gid
+    if if_changed:
+        path = os.path.realpath(path)
+        st = _file_with_content(path, content)
+        if st is not None:
+            if (st.st_uid, st.st_gid) != (uid, gid):
+                os.chown(path, uid, gid)
+            if stat.S_IMODE(st.st_mode) != perms:
+                os.chmod(path, perms)
+            return False
     log("Writing file {} {}:{} {:o}".format(path, owner, group, perms))
-    uid = pwd.getpwnam(owner).pw_uid
-    gid = grp.getgrnam(group).gr_gid
+    if if_changed:
+        _atomic_write(path, content, uid, gid, perms)
+        return True
     with open(path, 'wb') as target:
         os.fchown(target.fileno(), uid, gid)
         os.fchmod(target.fileno(), perms)
         target.write(content)
+    return True
+
+
+def _file_with_content(path, content):
+    """Return the stat of `path` if it is a file holding `content`"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if not stat.S_ISREG(st.st_mode) or st.st_size != len(content):
+        return None
+    if _hash_file(path, 'sha256') != hashlib.sha256(content).hexdigest():
+        return None
+    return st
+
+
+def _atomic_write(path, content, uid, gid, perms):
+    directory = os.path.dirname(path)
+    fd, tmp = tempfile.mkstemp(
+        dir=directory, prefix='.%s.' % os.path.basename(path))
+    renamed = False
+    try:
+        with os.fdopen(fd, 'wb') as target:
+            os.fchown(target.fileno(), uid, gid)
+            os.fchmod(target.fileno(), perms)
+            target.write(content)
+            target.flush()
+            os.fsync(target.fileno())
+        os.rename(tmp, path)
+        renamed = True
+    finally:
+        if not renamed:
+            os.unlink(tmp)
+    # Make the rename itself durable.
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
 
 def fstab_remove(mp):
@@ -253,22 +353,189 @@ def mounts():
     return system_mounts
 
 
-def file_hash(path, hash_type='md5'):
+def file_hash(path, hash_type='md5', cache=False):
     """
     Generate a hash checksum of the contents of 'path' or None if not found.
 
     :param str hash_type: Any hash alrgorithm supported by :mod:`hashlib`,
                           such as md5, sha1, sha256, sha512, etc.
+    :param bool cache: Reuse the checksum recorded in :func:`unitdata.kv`
+                       when the file's inode, size and modification time are
+                       unchanged, rather than reading the file again.
     """
+    if cache:
+        return file_hashes([path], hash_type, cache=True)[path]
     if os.path.exists(path):
-        h = getattr(hashlib, hash_type)()
-        with open(path, 'rb') as source:
-            h.update(source.read())
-        return h.hexdigest()
+        return _hash_file(path, hash_type)
     else:
         return None
 
 
+def file_hashes(paths, hash_type='md5', cache=False, max_workers=4):
+    """
+    Return a dict of the hash checksum of each of 'paths', or None for those
+    not found. Files are read concurrently by up to `max_workers` threads.
+
+    See :func:`file_hash` for `hash_type` and `cache`.
+    """
+    checksums = {}
+    pending = []
+    stats = {}
+    db = unitdata.kv() if cache else None
+    for path in paths:
+        if not os.path.exists(path):
+            checksums[path] = None
+            continue
+        if db is not None:
+            stats[path] = _file_signature(path)
+            recorded = db.get(_file_hash_key(path, hash_type))
+            if recorded and recorded[:-1] == stats[path]:
+                checksums[path] = recorded[-1]
+                continue
+        pending.append(path)
+    hashed = threaded_map(
+        lambda path: _hash_file(path, hash_type), pending, max_workers)
+    checksums.update(hashed)
+    for path, checksum in hashed.items():
+        # A file modified within the timestamp resolution of its last
+        # change could be changed again without its signature changing.
+        if path in stats and time.time() - stats[path][2] / 1e9 > 1:
+            db.set(_file_hash_key(path, hash_type),
+                   stats[path] + [checksum])
+    return checksums
+
+
+def tree_hashes(paths, hash_type='md5', cache=False, max_workers=4):
+    """
+    Return a dict of a fingerprint of each of 'paths', or None for those
+    that match nothing. Each path may be a file, a directory or a glob
+    pattern.
+
+    Directories are fingerprinted as a Merkle tree of the checksums of the
+    files beneath them, so adding, removing or changing any of them changes
+    the fingerprint. The files are hashed with :func:`file_hashes`; with
+    `cache` set only the files modified since they were last hashed are
+    read.
+    """
+    roots = OrderedDict()
+    layout = {}
+    files = []
+    for path in paths:
+        if _GLOB_MAGIC.search(path):
+            roots[path] = sorted(glob.glob(path))
+        elif os.path.isdir(path):
+            roots[path] = [path]
+        else:
+            files.append(path)
+            continue
+        for root in roots[path]:
+            if not os.path.isdir(root):
+                files.append(root)
+                continue
+            for dirpath, dirnames, filenames in os.walk(root):
+                layout[dirpath] = (sorted(dirnames), sorted(filenames))
+                files.extend(os.path.join(dirpath, name)
+                             for name in filenames)
+    checksums = file_hashes(
+        list(OrderedDict.fromkeys(files)), hash_type, cache, max_workers)
+    fingerprints = {}
+    for path in paths:
+        if path not in roots:
+            fingerprints[path] = checksums[path]
+        elif roots[path]:
+            fingerprints[path] = _merkle_digest(
+                [(root, _tree_digest(root, layout, checksums, hash_type))
+                 for root in roots[path]], hash_type)
+        else:
+            fingerprints[path] = None
+    return fingerprints
+
+
+def _tree_digest(path, layout, checksums, hash_type):
+    if path not in layout:
+        if os.path.islink(path) and os.path.isdir(path):
+            # os.walk does not descend into links to directories.
+            return 'link:%s' % os.readlink(path)
+        return checksums.get(path)
+    dirnames, filenames = layout[path]
+    return _merkle_digest(
+        [(name, _tree_digest(os.path.join(path, name), layout, checksums,
+                             hash_type))
+         for name in sorted(dirnames + filenames)], hash_type)
+
+
+def _merkle_digest(entries, hash_type):
+    h = getattr(hashlib, hash_type)()
+    for name, digest in entries:
+        h.update(('%r %s\n' % (name, digest)).encode('utf-8'))
+    return h.hexdigest()
+
+
+def _hash_file(path, hash_type):
+    h = getattr(hashlib, hash_type)()
+    with open(path, 'rb') as source:
+        while True:
+            chunk = source.read(HASH_CHUNK_SIZE)
+            h.update(chunk)
+            # Files only return short reads at the end.
+            if len(chunk) < HASH_CHUNK_SIZE:
+                break
+    return h.hexdigest()
+
+
+def _file_signature(path):
+    st = os.stat(path)
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1e9)
+    return [st.st_ino, st.st_size, mtime_ns]
+
+
+def _file_hash_key(path, hash_type):
+    return 'host.file_hash.%s.%s' % (hash_type, path)
+
+
+def threaded_map(func, items, max_workers):
+    """Return a dict of each of `items` to `func(item)`, calling `func` from
+    up to `max_workers` threads. The first exception raised is re-raised.
+
+    Hook tool reads made by `func` are recorded by the
+    :func:`hookenv.record_inputs` blocks active in the calling thread."""
+    items = list(items)
+    results = {}
+    if len(items) < 2 or max_workers < 2:
+        for item in items:
+            results[item] = func(item)
+        return results
+    func = share_recording(func)
+    queue = six.moves.queue.Queue()
+    for item in items:
+        queue.put(item)
+    errors = []
+
+    def worker():
+        while not errors:
+            try:
+                item = queue.get_nowait()
+            except six.moves.queue.Empty:
+                return
+            try:
+                results[item] = func(item)
+            except Exception:
+                errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(max_workers, len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        six.reraise(*errors[0])
+    return results
+
+
 def check_hash(path, checksum, hash_type='md5'):
     """
     Validate a file using a cryptographic checksum.
@@ -289,7 +556,9 @@ class ChecksumError(ValueError):
     pass
 
 
-def restart_on_change(restart_map, stopstart=False):
+def restart_on_change(restart_map, stopstart=False, hash_cache=False,
+                      dependencies=None, max_workers=1, timeout=None,
+                      report=None):
     """Restart services based on configuration files changing
 
     This function is used a decorator, for example::
@@ -303,29 +572,101 @@ def restart_on_change(restart_map, stopstart=False):
     In this example, the cinder-api and cinder-volume services
     would be restarted if /etc/ceph/ceph.conf is changed by the
     ceph_client_changed function.
+
+    Directories and glob patterns such as '/etc/apache2/sites-enabled/*'
+    may be used in place of files, and the services are restarted if any
+    file they cover is added, removed or changed (see :func:`tree_hashes`).
+
+    The files are hashed concurrently before and after the function runs.
+    With `hash_cache` set, checksums recorded in unitdata are reused for
+    files that have not been modified since (see :func:`file_hash`).
+
+    `dependencies`, `max_workers` and `timeout` are passed on to
+    :func:`restart_services`, and if `report` is given it is called with
+    the timings that returns.
     """
     def wrap(f):
         def wrapped_f(*args, **kwargs):
-            checksums = {}
-            for path in restart_map:
-                checksums[path] = file_hash(path)
+            checksums = tree_hashes(restart_map, cache=hash_cache)
             f(*args, **kwargs)
+            current = tree_hashes(restart_map, cache=hash_cache)
             restarts = []
             for path in restart_map:
-                if checksums[path] != file_hash(path):
+                if checksums[path] != current[path]:
                     restarts += restart_map[path]
-            services_list = list(OrderedDict.fromkeys(restarts))
-            if not stopstart:
-                for service_name in services_list:
-                    service('restart', service_name)
-            else:
-                for action in ['stop', 'start']:
-                    for service_name in services_list:
-                        service(action, service_name)
+            timings = restart_services(
+                restarts, stopstart, dependencies, max_workers, timeout)
+            if report is not None:
+                report(timings)
         return wrapped_f
     return wrap
 
 
+def restart_services(services, stopstart=False, dependencies=None,
+                     max_workers=1, timeout=None):
+    """Restart `services`, by stopping them all and then starting them if
+    `stopstart` is set.
+
+    :param dict dependencies: Maps a service to the services it must be
+        started after. Services are stopped in the reverse order.
+    :param int max_workers: Act on up to this many services at once, among
+        those whose dependencies have been dealt with.
+    :param timeout: Seconds to wait for each action before treating it as
+        failed.
+    :returns: An OrderedDict of each service to a dict of each action taken
+        to a tuple of whether it succeeded and the seconds it took.
+    :raises ValueError: If the dependencies are circular.
+    """
+    services = list(OrderedDict.fromkeys(services))
+    waves = dependency_waves(services, dependencies or {})
+    timings = OrderedDict((service_name, {}) for service_name in services)
+
+    def act(action):
+        def call(service_name):
+            started = time.time()
+            if timeout is None:
+                success = service(action, service_name)
+            else:
+                success = service(action, service_name, timeout=timeout)
+            timings[service_name][action] = (success, time.time() - started)
+            if not success:
+                log('Failed to %s %s' % (action, service_name),
+                    level=WARNING)
+        return call
+
+    if not stopstart:
+        actions = [('restart', waves)]
+    else:
+        actions = [('stop', waves[::-1]), ('start', waves)]
+    for action, ordered in actions:
+        for wave in ordered:
+            threaded_map(act(action), wave, max_workers)
+    return timings
+
+
+def dependency_waves(services, dependencies):
+    """Split `services` into lists that each only depend on earlier ones.
+
+    :param dict dependencies: Maps a service to those it depends on. Those
+        not among `services` are ignored.
+    :raises ValueError: If the dependencies are circular.
+    """
+    waves = []
+    done = set()
+    remaining = services
+    while remaining:
+        wave = [s for s in remaining
+                if all(d in done or d not in services
+                       for d in dependencies.get(s, ()))]
+        if not wave:
+            raise ValueError(
+                'Circular service dependencies: %s' % ', '.join(remaining))
+        waves.append(wave)
+        done.update(wave)
+        remaining = [s for s in remaining if s not in done]
+    return waves
+
+
 def lsb_release():
     """Return /etc/lsb-release in a dict"""
     d = {}
@@ -410,13 +751,19 @@ def cmp_pkgrevno(package, revno, pkgcache=None):
     * -1 => Installed revno is less than supplied arg
 
     This function imports apt_cache function from charmhelpers.fetch if
-    the pkgcache argument is None. Be sure to add charmhelpers.fetch if
-    you call this function, or pass an apt_pkg.Cache() instance.
+    the pkgcache argument is None, and looks the package up in the index of
+    installed packages, falling back to the shared apt cache. Be sure to
+    add charmhelpers.fetch if you call this function, or pass an
+    apt_pkg.Cache() instance.
     '''
     import apt_pkg
     if not pkgcache:
-        from charmhelpers.fetch import apt_cache
-        pkgcache = apt_cache()
+        from charmhelpers.fetch import apt_cache, installed_version
+        version = installed_version(package)
+        if version is not None:
+            apt_pkg.init()
+            return apt_pkg.version_compare(version, revno)
+        pkgcache = apt_cache(shared=True)
     pkg = pkgcache[package]
     return apt_pkg.version_compare(pkg.current_ver.ver_str, revno)
 
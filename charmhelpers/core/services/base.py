@@ -15,21 +15,45 @@
 # along with charm-helpers.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import sys
 import json
+import time
+import hashlib
+import threading
+from functools import partial
 from inspect import getargspec
-from collections import Iterable, OrderedDict
+from collections import Iterable, Mapping, OrderedDict
 
 from charmhelpers.core import host
 from charmhelpers.core import hookenv
+from charmhelpers.core import unitdata
 
 
-__all__ = ['ServiceManager', 'ManagerCallback',
-           'PortManagerCallback', 'open_ports', 'close_ports', 'manage_ports',
-           'service_restart', 'service_stop']
+__all__ = ['ServiceManager', 'ManagerCallback', 'ParallelCallback',
+           'ServiceEventError', 'PortManagerCallback', 'open_ports',
+           'close_ports', 'manage_ports', 'service_restart', 'service_stop']
+
+
+class ServiceEventError(Exception):
+    """
+    Raised when callbacks run concurrently fail, once they have all finished.
+
+    `failures` is a list of a description of each failed callback and the
+    exception info it raised.
+    """
+    def __init__(self, failures):
+        self.failures = failures
+        super(ServiceEventError, self).__init__('; '.join(
+            '%s: %r' % (description, exc_info[1])
+            for description, exc_info in failures))
 
 
 class ServiceManager(object):
-    def __init__(self, services=None):
+    # Hooks in which incremental managers still reconfigure every service,
+    # as the charm's templates or the machine may have changed.
+    full_reconfigure_hooks = ('install', 'upgrade-charm', 'start')
+
+    def __init__(self, services=None, incremental=False, max_workers=1):
         """
         Register a list of services, given their definitions.
 
@@ -45,13 +69,16 @@ class ServiceManager(object):
                 "start": <one or more callbacks>,
                 "stop": <one or more callbacks>,
                 "ports": <list of ports to manage>,
+                "after": <list of service names>,
             }
 
         The 'required_data' list should contain dicts of required data (or
         dependency managers that act like dicts and know how to collect the data).
         Only when all items in the 'required_data' list are populated are the list
         of 'data_ready' and 'start' callbacks executed.  See `is_ready()` for more
-        information.
+        information.  An item can also be a factory, such as a `RelationContext`
+        subclass, which is only called once a hook needs its data.  See
+        `required_context()`.
 
         The 'provided_data' list should contain relation data providers, most likely
         a subclass of :class:`charmhelpers.core.services.helpers.RelationContext`,
@@ -87,6 +114,26 @@ class ServiceManager(object):
         and the default 'stop' handler will close the ports prior to stopping
         the service.
 
+        With `incremental` set, a service is only reconfigured when its
+        inputs have changed since the hook that last reconfigured it. Its
+        inputs are the contents of its 'required_data' items, and whatever
+        config and relation data its callbacks read through hookenv, which
+        is recorded with :func:`hookenv.record_inputs`. A fingerprint of
+        these, and which services are ready, are kept in unitdata rather than
+        in the READY-SERVICES.json file. Every service is still reconfigured
+        in the hooks listed in `full_reconfigure_hooks`, and so is a service
+        whose callbacks read hook tools other than through hookenv's
+        recorded helpers.
+
+        With `max_workers` above 1, services are reconfigured concurrently on
+        that many threads, except that a service is only reconfigured once
+        the services named in its 'after' list are done. Callbacks wrapped in
+        a :class:`ParallelCallback` also run concurrently, and what they read
+        through hookenv counts as inputs of their service. The failures of
+        concurrent callbacks are raised together as a
+        :class:`ServiceEventError`, and the time each callback took is
+        logged.
+
 
         Examples:
 
@@ -119,6 +166,12 @@ class ServiceManager(object):
         """
         self._ready_file = os.path.join(hookenv.charm_dir(), 'READY-SERVICES.json')
         self._ready = None
+        self._ready_lock = threading.RLock()
+        # The contexts made by 'required_data' factories, by factory.
+        self._contexts = {}
+        self._contexts_lock = threading.Lock()
+        self.incremental = incremental
+        self.max_workers = max_workers
         self.services = OrderedDict()
         for service in services or []:
             service_name = service['service']
@@ -128,6 +181,7 @@ class ServiceManager(object):
         """
         Handle the current hook by doing The Right Thing with the registered services.
         """
+        self._contexts.clear()
         hook_name = hookenv.hook_name()
         if hook_name == 'stop':
             self.stop_services()
@@ -137,6 +191,8 @@ class ServiceManager(object):
         cfg = hookenv.config()
         if cfg.implicit_save:
             cfg.save()
+        if self.incremental:
+            unitdata.kv().flush()
 
     def provide_data(self):
         """
@@ -183,20 +239,97 @@ class ServiceManager(object):
 
         If no service names are given, reconfigures all registered services.
         """
-        for service_name in service_names or self.services.keys():
-            if self.is_ready(service_name):
+        service_names = list(service_names or self.services.keys())
+        if self.max_workers < 2:
+            for service_name in service_names:
+                state = self._reconfigure_state(service_name)
+                if state is not None:
+                    inputs = self._reconfigure(service_name, *state)
+                    self._reconfigured(service_name, state[0], inputs)
+            return
+        dependencies = dict(
+            (service_name, self.get_service(service_name).get('after', []))
+            for service_name in service_names)
+        for wave in host.dependency_waves(service_names, dependencies):
+            states = OrderedDict()
+            for service_name in wave:
+                state = self._reconfigure_state(service_name)
+                if state is not None:
+                    states[service_name] = state
+            inputs = self.run_concurrently([
+                (name, partial(self._reconfigure, name, *args))
+                for name, args in states.items()])
+            for service_name, state in states.items():
+                self._reconfigured(
+                    service_name, state[0], inputs[service_name])
+
+    def _reconfigure_state(self, service_name):
+        """
+        Return whether the service is and was ready, or None if it can be
+        skipped.
+        """
+        ready = self.is_ready(service_name)
+        if self.incremental and self._unchanged(service_name, ready):
+            hookenv.log('Skipping %s, its inputs are unchanged' %
+                        service_name, level=hookenv.DEBUG)
+            return None
+        return ready, self.was_ready(service_name)
+
+    def _reconfigure(self, service_name, ready, was_ready):
+        with hookenv.record_inputs() as inputs:
+            if ready:
                 self.fire_event('data_ready', service_name)
                 self.fire_event('start', service_name, default=[
                     service_restart,
                     manage_ports])
-                self.save_ready(service_name)
             else:
-                if self.was_ready(service_name):
+                if was_ready:
                     self.fire_event('data_lost', service_name)
                 self.fire_event('stop', service_name, default=[
                     manage_ports,
                     service_stop])
-                self.save_lost(service_name)
+        return inputs
+
+    def _reconfigured(self, service_name, ready, inputs):
+        if ready:
+            self.save_ready(service_name)
+        else:
+            self.save_lost(service_name)
+        if self.incremental:
+            self._save_fingerprint(service_name, inputs)
+
+    def run_concurrently(self, calls):
+        """
+        Call each of a list of (description, function) pairs on up to
+        `max_workers` threads, and return a dict of each description to
+        the function's result.
+
+        The time each took is logged, and if any raise, a
+        :class:`ServiceEventError` listing them all is raised once every
+        function has finished.
+        """
+        results = {}
+        timings = []
+        failures = []
+
+        def call(index):
+            description, func = calls[index]
+            started = time.time()
+            try:
+                results[description] = func()
+            except Exception:
+                failures.append((description, sys.exc_info()))
+            timings.append((index, description, time.time() - started))
+
+        host.threaded_map(call, range(len(calls)), self.max_workers)
+        if timings:
+            hookenv.log('Callback timings: %s' % ', '.join(
+                '%s %.3fs' % (description, elapsed)
+                for _, description, elapsed in sorted(timings)),
+                level=hookenv.DEBUG)
+        if failures:
+            raise ServiceEventError(failures)
+        return results
 
     def stop_services(self, *service_names):
         """
@@ -228,26 +361,63 @@ class ServiceManager(object):
             return
         if not isinstance(callbacks, Iterable):
             callbacks = [callbacks]
+        timings = []
         for callback in callbacks:
-            if isinstance(callback, ManagerCallback):
-                callback(self, service_name, event_name)
-            else:
-                callback(service_name)
+            started = time.time()
+            self._fire_callback(callback, service_name, event_name)
+            timings.append((callback, time.time() - started))
+        if self.max_workers > 1:
+            hookenv.log('%s %s callback timings: %s' % (
+                service_name, event_name, ', '.join(
+                    '%s %.3fs' % (_callback_name(callback), elapsed)
+                    for callback, elapsed in timings)),
+                level=hookenv.DEBUG)
+
+    def _fire_callback(self, callback, service_name, event_name):
+        if isinstance(callback, ManagerCallback):
+            callback(self, service_name, event_name)
+        else:
+            callback(service_name)
 
     def is_ready(self, service_name):
         """
         Determine if a registered service is ready, by checking its 'required_data'.
 
         A 'required_data' item can be any mapping type, and is considered ready
-        if `bool(item)` evaluates as True.
+        if `bool(item)` evaluates as True.  Factories listed after an item that
+        is not ready are not called.
         """
         service = self.get_service(service_name)
         reqs = service.get('required_data', [])
-        return all(bool(req) for req in reqs)
+        return all(bool(self.required_context(req)) for req in reqs)
+
+    def required_context(self, req):
+        """
+        Return the context of a 'required_data' item.
+
+        An item that is callable, such as a `RelationContext` subclass or a
+        `functools.partial` of one, is a factory.  It is called the first time
+        its context is needed, and the context is then shared by every service
+        listing the same factory, until the next call to `manage()`.  Services
+        that are never checked do not read their relations at all::
+
+            'required_data': [MysqlRelation, partial(HttpRelation, name='web')]
+        """
+        if not callable(req):
+            return req
+        with self._contexts_lock:
+            if req not in self._contexts:
+                self._contexts[req] = req()
+            return self._contexts[req]
 
     def _load_ready_file(self):
         if self._ready is not None:
             return
+        if self.incremental:
+            self._ready = unitdata.kv().get('services.ready')
+            if self._ready is not None:
+                self._ready = set(self._ready)
+                return
         if os.path.exists(self._ready_file):
             with open(self._ready_file) as fp:
                 self._ready = set(json.load(fp))
@@ -257,31 +427,70 @@ class ServiceManager(object):
     def _save_ready_file(self):
         if self._ready is None:
             return
+        if self.incremental:
+            unitdata.kv().set('services.ready', sorted(self._ready))
+            return
         with open(self._ready_file, 'w') as fp:
             json.dump(list(self._ready), fp)
 
+    def _fingerprint(self, service_name):
+        service = self.get_service(service_name)
+        data = [self.required_context(req)
+                for req in service.get('required_data', [])]
+        data = [dict(req) if isinstance(req, Mapping) else req
+                for req in data]
+        return hashlib.sha1(json.dumps(
+            data, sort_keys=True, default=repr).encode('UTF-8')).hexdigest()
+
+    def _unchanged(self, service_name, ready):
+        """
+        Whether the service was last reconfigured in the same state of
+        readiness, from the same inputs.
+        """
+        if hookenv.hook_name() in self.full_reconfigure_hooks:
+            return False
+        if self.was_ready(service_name) != ready:
+            return False
+        recorded = unitdata.kv().get('services.inputs.%s' % service_name)
+        if recorded is None:
+            return False
+        return (recorded['fingerprint'] == self._fingerprint(service_name) and
+                not hookenv.inputs_changed(recorded['inputs']))
+
+    def _save_fingerprint(self, service_name, inputs):
+        if not inputs.memoisable:
+            unitdata.kv().unset('services.inputs.%s' % service_name)
+            return
+        unitdata.kv().set('services.inputs.%s' % service_name, {
+            'inputs': inputs.replayable(),
+            'fingerprint': self._fingerprint(service_name),
+        })
+
     def save_ready(self, service_name):
         """
         Save an indicator that the given service is now data_ready.
         """
-        self._load_ready_file()
-        self._ready.add(service_name)
-        self._save_ready_file()
+        with self._ready_lock:
+            self._load_ready_file()
+            self._ready.add(service_name)
+            self._save_ready_file()
 
     def save_lost(self, service_name):
         """
         Save an indicator that the given service is no longer data_ready.
         """
-        self._load_ready_file()
-        self._ready.discard(service_name)
-        self._save_ready_file()
+        with self._ready_lock:
+            self._load_ready_file()
+            self._ready.discard(service_name)
+            self._save_ready_file()
 
     def was_ready(self, service_name):
         """
         Determine if the given service was previously data_ready.
         """
-        self._load_ready_file()
-        return service_name in self._ready
+        with self._ready_lock:
+            self._load_ready_file()
+            return service_name in self._ready
 
 
 class ManagerCallback(object):
@@ -299,6 +508,34 @@ class ManagerCallback(object):
         raise NotImplementedError()
 
 
+class ParallelCallback(ManagerCallback):
+    """
+    Callback that fires several independent callbacks at once, on the
+    manager's threads (see the `max_workers` option of `ServiceManager`).
+    Callbacks listed before or after it still run before or after all of
+    them, for example::
+
+        'data_ready': [
+            ParallelCallback(services.template(source='a.conf'),
+                             services.template(source='b.conf')),
+            restart_callback,
+        ]
+    """
+    def __init__(self, *callbacks):
+        self.callbacks = callbacks
+
+    def __call__(self, manager, service_name, event_name):
+        manager.run_concurrently([
+            ('%s %s %s' % (service_name, event_name, _callback_name(callback)),
+             partial(manager._fire_callback, callback, service_name,
+                     event_name))
+            for callback in self.callbacks])
+
+
+def _callback_name(callback):
+    return getattr(callback, '__name__', None) or type(callback).__name__
+
+
 class PortManagerCallback(ManagerCallback):
     """
     Callback class that will open or close ports, for use as either
@@ -40,6 +40,12 @@ class RelationContext(dict):
     The generated context will be namespaced under the relation :attr:`name`,
     to prevent potential naming conflicts.
 
+    The relation is read when the context is created.  List the class itself,
+    or a :func:`functools.partial` of it, in a service's 'required_data' to
+    have the :class:`ServiceManager` create it only once it is needed, and
+    share it among the services listing it (see
+    :meth:`ServiceManager.required_context`).
+
     :param str name: Override the relation :attr:`name`, since it can vary from charm to charm
     :param list additional_required_keys: Extend the list of :attr:`required_keys`
     """
@@ -110,11 +116,12 @@ class RelationContext(dict):
         set of data came from, you'll need to extend this class to preserve
         that information.
         """
-        if not hookenv.relation_ids(self.name):
+        relation_ids = hookenv.relation_ids(self.name)
+        if not relation_ids:
             return
 
-        ns = self.setdefault(self.name, [])
-        for rid in sorted(hookenv.relation_ids(self.name)):
+        ns = self[self.name] = []
+        for rid in sorted(relation_ids):
             for unit in sorted(hookenv.related_units(rid)):
                 reldata = hookenv.relation_get(rid=rid, unit=unit)
                 if self._is_ready(reldata):
@@ -258,7 +265,8 @@ class TemplateCallback(ManagerCallback):
         service = manager.get_service(service_name)
         context = {}
         for ctx in service.get('required_data', []):
-            context.update(ctx)
+            context.update(manager.required_context(ctx) if callable(ctx)
+                           else ctx)
         templating.render(self.source, self.target, context,
                           self.owner, self.group, self.perms)
 
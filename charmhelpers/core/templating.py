@@ -19,9 +19,16 @@ import os
 from charmhelpers.core import host
 from charmhelpers.core import hookenv
 
+# Compiled templates are cached here, relative to the charm directory.
+BYTECODE_CACHE_DIR = '.jinja2-cache'
+
+# (templates_dir, bytecode cache directory) -> jinja2 Environment
+_environments = {}
+
 
 def render(source, target, context, owner='root', group='root',
-           perms=0o444, templates_dir=None, encoding='UTF-8'):
+           perms=0o444, templates_dir=None, encoding='UTF-8',
+           if_changed=False, bytecode_cache=False):
     """
     Render a template.
 
@@ -36,11 +43,47 @@ def render(source, target, context, owner='root', group='root',
 
     If omitted, `templates_dir` defaults to the `templates` folder in the charm.
 
+    With `if_changed` set, the target is only written if the rendered content
+    differs from what it already holds, and is then replaced atomically (see
+    `write_file`). Returns whether the target was written.
+
+    The jinja2 environment for each `templates_dir` is kept for later calls,
+    so each template is only compiled once per hook. With `bytecode_cache`
+    set, compiled templates are also stored in `BYTECODE_CACHE_DIR` in the
+    charm directory and reused by later hooks.
+
     Note: Using this requires python-jinja2; if it is not installed, calling
     this will attempt to use charmhelpers.fetch.apt_install to install it.
     """
+    template = _get_template(source, templates_dir, bytecode_cache)
+    return _write(template.render(context), target, owner, group, perms,
+                  encoding, if_changed)
+
+
+def render_many(renders, owner='root', group='root', perms=0o444,
+                templates_dir=None, encoding='UTF-8', if_changed=False,
+                bytecode_cache=False):
+    """
+    Render a batch of templates from one `templates_dir`.
+
+    `renders` is a sequence of (source, target, context) tuples, and the
+    remaining options are as for `render`. Every template is loaded before
+    any target is written. Returns a dict of whether each target was
+    written.
+    """
+    templates = [
+        (_get_template(source, templates_dir, bytecode_cache),
+         target, context)
+        for source, target, context in renders]
+    return dict(
+        (target, _write(template.render(context), target, owner, group,
+                        perms, encoding, if_changed))
+        for template, target, context in templates)
+
+
+def _get_template(source, templates_dir, bytecode_cache):
     try:
-        from jinja2 import FileSystemLoader, Environment, exceptions
+        from jinja2 import exceptions
     except ImportError:
         try:
             from charmhelpers.fetch import apt_install
@@ -50,11 +93,11 @@ def render(source, target, context, owner='root', group='root',
                         level=hookenv.ERROR)
             raise
         apt_install('python-jinja2', fatal=True)
-        from jinja2 import FileSystemLoader, Environment, exceptions
+        from jinja2 import exceptions
 
     if templates_dir is None:
         templates_dir = os.path.join(hookenv.charm_dir(), 'templates')
-    loader = Environment(loader=FileSystemLoader(templates_dir))
+    loader = _get_environment(templates_dir, bytecode_cache)
     try:
         source = source
         template = loader.get_template(source)
@@ -63,6 +106,30 @@ def render(source, target, context, owner='root', group='root',
                     (source, templates_dir),
                     level=hookenv.ERROR)
         raise e
-    content = template.render(context)
-    host.mkdir(os.path.dirname(target), owner, group, perms=0o755)
-    host.write_file(target, content.encode(encoding), owner, group, perms)
+    return template
+
+
+def _get_environment(templates_dir, bytecode_cache):
+    from jinja2 import FileSystemLoader, Environment, FileSystemBytecodeCache
+
+    cache_dir = None
+    if bytecode_cache:
+        cache_dir = os.path.join(hookenv.charm_dir(), BYTECODE_CACHE_DIR)
+    key = (templates_dir, cache_dir)
+    if key not in _environments:
+        cache = None
+        if cache_dir:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir, 0o700)
+            cache = FileSystemBytecodeCache(cache_dir)
+        _environments[key] = Environment(
+            loader=FileSystemLoader(templates_dir), bytecode_cache=cache)
+    return _environments[key]
+
+
+def _write(content, target, owner, group, perms, encoding, if_changed):
+    target_dir = os.path.dirname(target)
+    if not (if_changed and os.path.isdir(target_dir)):
+        host.mkdir(target_dir, owner, group, perms=0o755)
+    return host.write_file(target, content.encode(encoding), owner, group,
+                           perms, if_changed=if_changed)
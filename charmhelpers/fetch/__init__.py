@@ -14,18 +14,29 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with charm-helpers.  If not, see <http://www.gnu.org/licenses/>.
 
+from collections import OrderedDict
+from contextlib import contextmanager
+import fcntl
+import glob
 import importlib
+import io
+import json
 from tempfile import NamedTemporaryFile
+import threading
 import time
 from yaml import safe_load
 from charmhelpers.core.host import (
-    lsb_release
+    file_hashes,
+    lsb_release,
 )
 import subprocess
 from charmhelpers.core.hookenv import (
+    DEBUG,
+    charm_dir,
     config,
     log,
 )
+from charmhelpers.core import unitdata
 import os
 
 import six
@@ -103,6 +114,36 @@ FETCH_HANDLERS = (
 APT_NO_LOCK = 100  # The return code for "couldn't acquire lock" in APT.
 APT_NO_LOCK_RETRY_DELAY = 10  # Wait 10 seconds between apt lock checks.
 APT_NO_LOCK_RETRY_COUNT = 30  # Retry to acquire the lock X times.
+APT_LOCK_POLL_DELAY = 0.1  # First wait between polls of the APT locks.
+APT_LOCK_FILES = (
+    '/var/lib/dpkg/lock',
+    '/var/lib/apt/lists/lock',
+)
+
+# Whether apt_cache() parses the package lists in memory rather than loading
+# /var/cache/apt/pkgcache.bin, which later hooks can reuse if the lists have
+# not changed.
+APT_CACHE_IN_MEMORY = True
+
+# Files whose content apt-get update depends on. Changes to files in
+# APT_SOURCE_PARTS only require those files to be updated.
+APT_SOURCES = (
+    '/etc/apt/sources.list',
+    '/etc/apt/sources.list.d/*.list',
+    '/etc/apt/trusted.gpg',
+    '/etc/apt/trusted.gpg.d/*',
+)
+APT_SOURCE_PARTS = '/etc/apt/sources.list.d/'
+# apt_update() runs a full update when the last one is older than this many
+# seconds, even if the sources are unchanged. None disables the limit.
+APT_UPDATE_MAX_AGE = 24 * 60 * 60
+
+DPKG_STATUS = '/var/lib/dpkg/status'
+# File in the charm directory keeping the index read from DPKG_STATUS
+# between hooks.
+DPKG_INDEX_CACHE = '.dpkg-index.json'
+# Package states in which dpkg has no version of a package installed.
+DPKG_NOT_INSTALLED = ('not-installed', 'config-files')
 
 
 class SourceConfigError(Exception):
@@ -143,9 +184,13 @@ class BaseFetchHandler(object):
 
 def filter_installed_packages(packages):
     """Returns a list of packages that require installation"""
-    cache = apt_cache()
+    installed = installed_packages()
+    missing = [package for package in packages if package not in installed]
+    if not missing:
+        return []
+    cache = apt_cache(shared=True)
     _pkgs = []
-    for package in packages:
+    for package in missing:
         try:
             p = cache[package]
             p.current_ver or _pkgs.append(package)
@@ -156,16 +201,153 @@ def filter_installed_packages(packages):
     return _pkgs
 
 
-def apt_cache(in_memory=True):
-    """Build and return an apt cache"""
+_installed_packages = {}
+_installed_packages_lock = threading.Lock()
+
+
+def installed_packages(persist=None):
+    """Return a dict of the installed version of each package, by name.
+
+    The index is read from :data:`DPKG_STATUS`, and only read again once the
+    size or modification time of that file change. Packages installed for a
+    foreign architecture are also listed as ``name:arch``.
+
+    :param persist: Keep the index in :data:`DPKG_INDEX_CACHE` in the charm
+        directory so that later hooks reuse it. Defaults to whether the
+        process runs in a charm, that is whether CHARM_DIR is set.
+    """
+    try:
+        st = os.stat(DPKG_STATUS)
+    except OSError:
+        return {}
+    signature = [st.st_ino, st.st_size, st.st_mtime]
+    with _installed_packages_lock:
+        if _installed_packages.get('signature') == signature:
+            return _installed_packages['packages']
+        if persist is None:
+            persist = bool(charm_dir())
+        path = os.path.join(charm_dir() or '', DPKG_INDEX_CACHE)
+        recorded = _load_dpkg_index(path) if persist else None
+        if recorded and recorded.get('signature') == signature:
+            packages = recorded['packages']
+        else:
+            packages = _read_dpkg_status(DPKG_STATUS)
+            if persist:
+                _save_dpkg_index(path, {
+                    'signature': signature,
+                    'packages': packages,
+                })
+        _installed_packages['signature'] = signature
+        _installed_packages['packages'] = packages
+        return packages
+
+
+def _load_dpkg_index(path):
+    try:
+        with open(path) as index:
+            return json.load(index)
+    except (IOError, ValueError):
+        return None
+
+
+def _save_dpkg_index(path, recorded):
+    """Replace the index file in one rename, so that a hook never reads a
+    partial one. The index is only a cache: failing to write it is logged
+    and otherwise ignored."""
+    try:
+        with NamedTemporaryFile('w', dir=os.path.dirname(path) or '.',
+                                prefix=DPKG_INDEX_CACHE,
+                                delete=False) as index:
+            json.dump(recorded, index)
+        try:
+            os.rename(index.name, path)
+        except OSError:
+            os.unlink(index.name)
+            raise
+    except (IOError, OSError) as e:
+        log('Not keeping the package index in {}: {}'.format(path, e),
+            level=DEBUG)
+
+
+def installed_version(package):
+    """Return the installed version of a package, or None if it is not
+    installed"""
+    return installed_packages().get(package)
+
+
+def _read_dpkg_status(path):
+    packages = {}
+    fields = {}
+    with io.open(path, encoding='UTF-8', errors='replace') as status:
+        for line in status:
+            if line[:1] in (' ', '\t'):
+                continue
+            line = line.strip()
+            if line:
+                name, _, value = line.partition(':')
+                fields[name] = value.strip()
+                continue
+            _add_dpkg_package(packages, fields)
+            fields = {}
+    _add_dpkg_package(packages, fields)
+    return packages
+
+
+def _add_dpkg_package(packages, fields):
+    name = fields.get('Package')
+    state = fields.get('Status', '').split()[-1:]
+    if not name or not state or state[0] in DPKG_NOT_INSTALLED:
+        return
+    version = fields.get('Version')
+    packages.setdefault(name, version)
+    arch = fields.get('Architecture')
+    if arch and arch != 'all':
+        packages['%s:%s' % (name, arch)] = version
+
+
+_shared_apt_caches = {}
+_shared_apt_cache_lock = threading.Lock()
+
+
+def apt_cache(in_memory=None, shared=False):
+    """Build and return an apt cache
+
+    :param in_memory: Parse the package lists in memory instead of using the
+        on-disk pkgcache.bin. Defaults to :data:`APT_CACHE_IN_MEMORY`.
+    :param shared: Return the cache built by an earlier call with `shared`
+        set, if any. Shared caches are dropped by
+        :func:`invalidate_apt_cache`, which is called after every apt command
+        run by this module and by :func:`add_source`, so they must not be
+        modified by the caller.
+    """
+    if in_memory is None:
+        in_memory = APT_CACHE_IN_MEMORY
+    if not shared:
+        return _apt_cache(in_memory)
+    with _shared_apt_cache_lock:
+        if in_memory not in _shared_apt_caches:
+            _shared_apt_caches[in_memory] = _apt_cache(in_memory)
+        return _shared_apt_caches[in_memory]
+
+
+def _apt_cache(in_memory):
     from apt import apt_pkg
     apt_pkg.init()
     if in_memory:
         apt_pkg.config.set("Dir::Cache::pkgcache", "")
         apt_pkg.config.set("Dir::Cache::srcpkgcache", "")
+    else:
+        apt_pkg.config.set("Dir::Cache::pkgcache", "pkgcache.bin")
+        apt_pkg.config.set("Dir::Cache::srcpkgcache", "srcpkgcache.bin")
     return apt_pkg.Cache()
 
 
+def invalidate_apt_cache():
+    """Drop the shared apt caches, so that they are rebuilt on next use"""
+    with _shared_apt_cache_lock:
+        _shared_apt_caches.clear()
+
+
 def apt_install(packages, options=None, fatal=False):
     """Install one or more packages"""
     if options is None:
@@ -198,10 +380,73 @@ def apt_upgrade(options=None, fatal=False, dist=False):
     _run_apt_command(cmd, fatal)
 
 
-def apt_update(fatal=False):
-    """Update local apt cache"""
+def apt_update(fatal=False, force=False):
+    """Update local apt cache
+
+    Within a charm, the checksums of :data:`APT_SOURCES` are recorded in
+    :func:`unitdata.kv` after each successful update. Unless `force` is set,
+    the update is then skipped while those files are unchanged, for up to
+    :data:`APT_UPDATE_MAX_AGE` seconds. If the only changes are source lists
+    added to or changed in :data:`APT_SOURCE_PARTS`, only those lists are
+    updated.
+    """
     cmd = ['apt-get', 'update']
-    _run_apt_command(cmd, fatal)
+    if not charm_dir():
+        _run_apt_command(cmd, fatal)
+        return
+    db = unitdata.kv()
+
+    sources = file_hashes(_apt_source_files(), 'sha1')
+    last = db.get('fetch.apt_update')
+    changed = None
+    if (last and not force and
+            (APT_UPDATE_MAX_AGE is None or
+             time.time() - last['time'] < APT_UPDATE_MAX_AGE)):
+        changed = _changed_source_parts(last['sources'], sources)
+
+    if changed == []:
+        log('Package sources unchanged, skipping apt-get update',
+            level=DEBUG)
+        return
+    if changed:
+        updated = last['time']
+        for path in changed:
+            log('Updating package source {}'.format(path), level=DEBUG)
+            result = _run_apt_command(
+                cmd + ['-o', 'Dir::Etc::sourcelist={}'.format(path),
+                       '-o', 'Dir::Etc::sourceparts=-',
+                       '-o', 'APT::Get::List-Cleanup=0'], fatal)
+            if result != 0:
+                break
+    else:
+        updated = time.time()
+        result = _run_apt_command(cmd, fatal)
+    if result == 0:
+        db.set('fetch.apt_update', {
+            'sources': sources,
+            'time': updated,
+        })
+
+
+def _apt_source_files():
+    paths = []
+    for pattern in APT_SOURCES:
+        paths.extend(sorted(glob.glob(pattern)))
+    return paths
+
+
+def _changed_source_parts(old, new):
+    """
+    Return the source lists of :data:`APT_SOURCE_PARTS` which were added or
+    changed between two sets of checksums, or None if anything else changed.
+    """
+    if set(old) - set(new):
+        return None
+    changed = sorted(path for path in new if new[path] != old.get(path))
+    for path in changed:
+        if not path.startswith(APT_SOURCE_PARTS):
+            return None
+    return changed
 
 
 def apt_purge(packages, fatal=False):
@@ -230,6 +475,121 @@ def apt_hold(packages, fatal=False):
         subprocess.call(cmd)
 
 
+class AptBatch(object):
+    """
+    Packages to install, purge and hold in a single apt transaction.
+
+    Requests are queued, deduplicated and only carried out by :meth:`commit`,
+    with one ``apt-get`` run per distinct set of install options (usually
+    just one), followed by one ``apt-mark hold``. A package queued for both
+    installation and purging is only kept for the latest request. The
+    transaction is fatal if any request was. See :func:`apt_batch`.
+    """
+    def __init__(self):
+        self.installs = OrderedDict()
+        self.purges = []
+        self.holds = []
+        self.fatal = False
+        self._lock = threading.Lock()
+
+    def install(self, packages, options=None, fatal=False):
+        """Queue the installation of one or more packages"""
+        if options is None:
+            options = ['--option=Dpkg::Options::=--force-confold']
+        with self._lock:
+            for package in _package_list(packages):
+                if package in self.purges:
+                    self.purges.remove(package)
+                for queued in self.installs.values():
+                    if package in queued:
+                        queued.remove(package)
+                self.installs.setdefault(tuple(options), []).append(package)
+            self.fatal = self.fatal or fatal
+
+    def purge(self, packages, fatal=False):
+        """Queue the purging of one or more packages"""
+        with self._lock:
+            for package in _package_list(packages):
+                for queued in self.installs.values():
+                    if package in queued:
+                        queued.remove(package)
+                if package not in self.purges:
+                    self.purges.append(package)
+            self.fatal = self.fatal or fatal
+
+    def hold(self, packages, fatal=False):
+        """Queue holding one or more packages"""
+        with self._lock:
+            self.holds.extend(package for package in _package_list(packages)
+                              if package not in self.holds)
+            self.fatal = self.fatal or fatal
+
+    def commit(self):
+        """Run the queued requests and empty the queue"""
+        with self._lock:
+            installs = [(list(options), packages)
+                        for options, packages in self.installs.items()
+                        if packages]
+            purges, holds, fatal = self.purges, self.holds, self.fatal
+            self.installs = OrderedDict()
+            self.purges, self.holds, self.fatal = [], [], False
+        if purges and not installs:
+            apt_purge(purges, fatal)
+        for options, packages in installs:
+            if purges:
+                # apt-get install removes packages suffixed with a minus.
+                options = options + ['--purge']
+                packages = packages + ['%s-' % p for p in purges]
+                purges = []
+            apt_install(packages, options, fatal)
+        if holds:
+            apt_hold(holds, fatal)
+
+
+_apt_batches = []
+
+
+@contextmanager
+def apt_batch():
+    """
+    Collect the packages requested within the block in an :class:`AptBatch`,
+    committed when the block exits without an exception::
+
+        with apt_batch() as batch:
+            batch.install(['haproxy', 'keepalived'], fatal=True)
+            batch.purge('apache2')
+            ensure_packages(['python-psutil'])
+
+    Helpers which install packages that are not needed right away, such as
+    ``ensure_packages`` in :mod:`charmhelpers.contrib.openstack.context`,
+    queue them on the :func:`current_apt_batch`. Nested blocks share the
+    outermost batch, which is committed when its block exits.
+    """
+    if _apt_batches:
+        batch = _apt_batches[-1]
+    else:
+        batch = AptBatch()
+    _apt_batches.append(batch)
+    try:
+        yield batch
+    finally:
+        _apt_batches.pop()
+    if not _apt_batches:
+        batch.commit()
+
+
+def current_apt_batch():
+    """Return the :class:`AptBatch` of the innermost :func:`apt_batch` block,
+    or None"""
+    return _apt_batches[-1] if _apt_batches else None
+
+
+def _package_list(packages):
+    if isinstance(packages, six.string_types):
+        return packages.split()
+    return list(packages)
+
+
 def add_source(source, key=None):
     """Add a package source to this system.
 
@@ -258,6 +618,13 @@ def add_source(source, key=None):
         log('Source is not present. Skipping')
         return
 
+    try:
+        _add_source(source, key)
+    finally:
+        invalidate_apt_cache()
+
+
+def _add_source(source, key):
     if (source.startswith('ppa:') or
         source.startswith('http') or
         source.startswith('deb ') or
@@ -301,7 +668,8 @@ def add_source(source, key=None):
 
 def configure_sources(update=False,
                       sources_var='install_sources',
-                      keys_var='install_keys'):
+                      keys_var='install_keys',
+                      force=False):
     """
     Configure multiple sources from charm configuration.
 
@@ -318,6 +686,9 @@ def configure_sources(update=False,
           - "a1b2c3d4"
 
     Note that 'null' (a.k.a. None) should not be quoted.
+
+    With `update` set, apt_update() is called, which skips the update if the
+    sources are unchanged unless `force` is also set.
     """
     sources = safe_load((config(sources_var) or '').strip()) or []
     keys = safe_load((config(keys_var) or '').strip()) or None
@@ -338,7 +709,7 @@ def configure_sources(update=False,
         for source, key in zip(sources, keys):
             add_source(source, key)
     if update:
-        apt_update(fatal=True)
+        apt_update(fatal=True, force=force)
 
 
 def install_remote(source, *args, **kwargs):
@@ -410,12 +781,20 @@ def _run_apt_command(cmd, fatal=False):
     :param: cmd: str: The apt command to run.
     :param: fatal: bool: Whether the command's output should be checked and
         retried.
+    :returns: The exit status of the command.
     """
     env = os.environ.copy()
 
     if 'DEBIAN_FRONTEND' not in env:
         env['DEBIAN_FRONTEND'] = 'noninteractive'
 
+    try:
+        return _run_apt(cmd, env, fatal)
+    finally:
+        invalidate_apt_cache()
+
+
+def _run_apt(cmd, env, fatal):
     if fatal:
         retry_count = 0
         result = None
@@ -431,9 +810,49 @@ def _run_apt_command(cmd, fatal=False):
                 if retry_count > APT_NO_LOCK_RETRY_COUNT:
                     raise
                 result = e.returncode
-                log("Couldn't acquire DPKG lock. Will retry in {} seconds."
-                    "".format(APT_NO_LOCK_RETRY_DELAY))
-                time.sleep(APT_NO_LOCK_RETRY_DELAY)
+                log("Couldn't acquire DPKG lock. Waiting for it to be "
+                    "released.")
+                _wait_for_apt_lock(
+                    APT_NO_LOCK_RETRY_DELAY * APT_NO_LOCK_RETRY_COUNT)
+        return result
 
     else:
-        subprocess.call(cmd, env=env)
+        return subprocess.call(cmd, env=env)
+
+
+def _apt_lock_held():
+    """
+    Whether another process holds one of :data:`APT_LOCK_FILES`. Lock files
+    which do not exist or cannot be opened are ignored.
+    """
+    for path in APT_LOCK_FILES:
+        try:
+            fd = os.open(path, os.O_RDWR)
+        except OSError:
+            continue
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            return True
+        finally:
+            # Closing the file releases the lock if it was taken.
+            os.close(fd)
+    return False
+
+
+def _wait_for_apt_lock(timeout):
+    """
+    Poll the APT locks until they are free, doubling the delay between polls
+    from :data:`APT_LOCK_POLL_DELAY` up to :data:`APT_NO_LOCK_RETRY_DELAY`.
+    Raises :class:`AptLockError` if they are still held after `timeout`
+    seconds.
+    """
+    delay = APT_LOCK_POLL_DELAY
+    deadline = time.time() + timeout
+    while _apt_lock_held():
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise AptLockError(
+                'APT lock still held after {} seconds'.format(timeout))
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, APT_NO_LOCK_RETRY_DELAY)
@@ -17,6 +17,7 @@
 import os
 import hashlib
 import re
+import time
 
 from charmhelpers.fetch import (
     BaseFetchHandler,
@@ -26,22 +27,23 @@ from charmhelpers.payload.archive import (
     get_archive_handler,
     extract,
 )
-from charmhelpers.core.host import mkdir, check_hash
+from charmhelpers.core.hookenv import log, DEBUG
+from charmhelpers.core.host import mkdir, check_hash, ChecksumError
 
 import six
 if six.PY3:
     from urllib.request import (
-        build_opener, install_opener, urlopen, urlretrieve,
+        build_opener, install_opener, urlopen, urlretrieve, Request,
         HTTPPasswordMgrWithDefaultRealm, HTTPBasicAuthHandler,
     )
     from urllib.parse import urlparse, urlunparse, parse_qs
-    from urllib.error import URLError
+    from urllib.error import HTTPError, URLError
 else:
     from urllib import urlretrieve
     from urllib2 import (
-        build_opener, install_opener, urlopen,
+        build_opener, install_opener, urlopen, Request,
         HTTPPasswordMgrWithDefaultRealm, HTTPBasicAuthHandler,
-        URLError
+        HTTPError, URLError
     )
     from urlparse import urlparse, urlunparse, parse_qs
 
@@ -74,6 +76,8 @@ class ArchiveUrlFetchHandler(BaseFetchHandler):
 
     Installs the contents of the archive in $CHARM_DIR/fetched/.
     """
+    buffer_size = 64 * 1024
+
     def can_handle(self, source):
         url_parts = self.parse_url(source)
         if url_parts.scheme not in ('http', 'https', 'ftp', 'file'):
@@ -82,12 +86,31 @@ class ArchiveUrlFetchHandler(BaseFetchHandler):
             return True
         return False
 
-    def download(self, source, dest):
+    def download(self, source, dest, hash_types=(), resume=False,
+                 buffer_size=None, progress=None):
         """
         Download an archive file.
 
+        The file is streamed to `dest` `buffer_size` bytes at a time, and
+        hashed as it is written.
+
         :param str source: URL pointing to an archive file.
         :param str dest: Local path location to download archive file to.
+        :param hash_types: Algorithms to compute checksums of the file with.
+        :param bool resume: Keep the partial file of a failed download, and
+            continue a partial download of the same `source` left by an
+            earlier call with an HTTP range request. The request is
+            conditional on the ETag or Last-Modified date the server sent
+            for the partial file, which is kept next to it. If there is no
+            such validator, or the archive has changed since, the download
+            starts over.
+        :param int buffer_size: Bytes read at a time. Defaults to
+            :attr:`buffer_size`.
+        :param progress: Callable passed the number of bytes downloaded, the
+            size of the file (or None if unknown) and the elapsed seconds
+            after each chunk is written.
+        :returns: A dict of the hex digest of the file for each of
+            `hash_types`.
         """
         # propogate all exceptions
         # URLError, OSError, etc
@@ -104,14 +127,79 @@ class ArchiveUrlFetchHandler(BaseFetchHandler):
                 authhandler = HTTPBasicAuthHandler(passman)
                 opener = build_opener(authhandler)
                 install_opener(opener)
-        response = urlopen(source)
+        buffer_size = buffer_size or self.buffer_size
+        hashes = dict((hash_type, hashlib.new(hash_type))
+                      for hash_type in hash_types)
+        partial = dest + '.partial'
+        validator_file = partial + '.validator'
+        offset = 0
+        request = Request(source)
+        resumable = resume and proto in ('http', 'https')
+        if resumable and os.path.isfile(partial):
+            validator = _read_validator(validator_file)
+            if validator is None:
+                # Nothing tells whether the partial file is of the same
+                # version of the archive.
+                _remove(partial)
+            else:
+                offset = os.path.getsize(partial)
+                request.add_header('Range', 'bytes=%d-' % offset)
+                request.add_header('If-Range', validator)
+        start = time.time()
         try:
-            with open(dest, 'w') as dest_file:
-                dest_file.write(response.read())
-        except Exception as e:
-            if os.path.isfile(dest):
-                os.unlink(dest)
-            raise e
+            response = urlopen(request)
+        except HTTPError as e:
+            # 416 Range Not Satisfiable: the partial file is no shorter than
+            # the archive, so it cannot be resumed.
+            if not offset or e.code != 416:
+                raise
+            _remove(partial, validator_file)
+            return self.download(source, dest, hash_types, resume,
+                                 buffer_size, progress)
+        try:
+            if offset and not _resumed(response, offset):
+                # The archive changed, or the server ignored the range, so
+                # the partial file is replaced.
+                offset = 0
+            if resumable and not offset:
+                _write_validator(validator_file, response)
+            if offset:
+                log('Resuming download of {} from byte {}'.format(
+                    source, offset), level=DEBUG)
+                _update_hashes(partial, hashes, buffer_size)
+            size = response.info().get('Content-Length')
+            if size is not None:
+                size = int(size) + offset
+            received = offset
+            with open(partial, 'ab' if offset else 'wb') as dest_file:
+                while True:
+                    chunk = response.read(buffer_size)
+                    if not chunk:
+                        break
+                    dest_file.write(chunk)
+                    for h in hashes.values():
+                        h.update(chunk)
+                    received += len(chunk)
+                    if progress:
+                        progress(received, size, time.time() - start)
+            if size is not None and received != size:
+                raise URLError('Download of {} incomplete: {} of {} '
+                               'bytes'.format(source, received, size))
+            os.rename(partial, dest)
+            _remove(validator_file)
+        except Exception:
+            if not resume:
+                _remove(partial, validator_file)
+            raise
+        finally:
+            response.close()
+        elapsed = time.time() - start
+        log('Downloaded {} bytes of {} in {:.1f}s ({:.0f} KiB/s)'.format(
+            received - offset, source, elapsed,
+            (received - offset) / 1024.0 / max(elapsed, 0.001)),
+            level=DEBUG)
+        return dict((hash_type, h.hexdigest())
+                    for hash_type, h in hashes.items())
 
     # Mandatory file validation via Sha1 or MD5 hashing.
     def download_and_validate(self, url, hashsum, validate="sha1"):
@@ -119,7 +207,8 @@ class ArchiveUrlFetchHandler(BaseFetchHandler):
         check_hash(tempfile, hashsum, validate)
         return tempfile
 
-    def install(self, source, dest=None, checksum=None, hash_type='sha1'):
+    def install(self, source, dest=None, checksum=None, hash_type='sha1',
+                resume=False):
         """
         Download and install an archive file, with optional checksum validation.
 
@@ -135,6 +224,8 @@ class ArchiveUrlFetchHandler(BaseFetchHandler):
         :param str hash_type: Algorithm used to generate `checksum`.
             Can be any hash alrgorithm supported by :mod:`hashlib`,
             such as md5, sha1, sha256, sha512, etc.
+        :param bool resume: Continue an interrupted download of `source`
+            (see :meth:`download`).
 
         """
         url_parts = self.parse_url(source)
@@ -142,20 +233,69 @@ class ArchiveUrlFetchHandler(BaseFetchHandler):
         if not os.path.exists(dest_dir):
             mkdir(dest_dir, perms=0o755)
         dld_file = os.path.join(dest_dir, os.path.basename(url_parts.path))
+        options = parse_qs(url_parts.fragment)
+        if not six.PY3:
+            algorithms = hashlib.algorithms
+        else:
+            algorithms = hashlib.algorithms_available
+        checksums = [(key, value[0]) for key, value in options.items()
+                     if key in algorithms]
+        if checksum:
+            checksums.append((hash_type, checksum))
         try:
-            self.download(source, dld_file)
+            digests = self.download(
+                source, dld_file, resume=resume,
+                hash_types=set(key for key, _ in checksums))
         except URLError as e:
             raise UnhandledSource(e.reason)
         except OSError as e:
             raise UnhandledSource(e.strerror)
-        options = parse_qs(url_parts.fragment)
-        for key, value in options.items():
-            if not six.PY3:
-                algorithms = hashlib.algorithms
-            else:
-                algorithms = hashlib.algorithms_available
-            if key in algorithms:
-                check_hash(dld_file, value, key)
-        if checksum:
-            check_hash(dld_file, checksum, hash_type)
+        for key, value in checksums:
+            if value != digests[key]:
+                raise ChecksumError("'%s' != '%s'" % (value, digests[key]))
         return extract(dld_file, dest)
+
+
+def _resumed(response, offset):
+    """Whether a response to a range request continues from `offset`"""
+    content_range = response.info().get('Content-Range') or ''
+    return (response.getcode() == 206 and
+            content_range.startswith('bytes %d-' % offset))
+
+
+def _read_validator(path):
+    try:
+        with open(path) as f:
+            return f.read().strip() or None
+    except IOError:
+        return None
+
+
+def _write_validator(path, response):
+    """Keep the strong ETag or the Last-Modified date of a response, which
+    a range request resuming its download sends as If-Range"""
+    headers = response.info()
+    validator = headers.get('ETag')
+    if not validator or validator.startswith('W/'):
+        validator = headers.get('Last-Modified')
+    if validator:
+        with open(path, 'w') as f:
+            f.write(validator)
+    else:
+        _remove(path)
+
+
+def _remove(*paths):
+    for path in paths:
+        if os.path.isfile(path):
+            os.unlink(path)
+
+
+def _update_hashes(path, hashes, buffer_size):
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(buffer_size)
+            if not chunk:
+                break
+            for h in hashes.values():
+                h.update(chunk)
@@ -7,6 +7,7 @@ from testtools import TestCase
 from mock import MagicMock, patch, call
 
 import charmhelpers.contrib.openstack.utils as openstack
+from charmhelpers import fetch
 
 import six
 
@@ -140,6 +141,16 @@ class FakeDNS(object):
 
 
 class OpenStackHelpersTestCase(TestCase):
+    def setUp(self):
+        super(OpenStackHelpersTestCase, self).setUp()
+        fetch.invalidate_apt_cache()
+        self.addCleanup(fetch.invalidate_apt_cache)
+        # Look packages up in the fake apt cache rather than the host's
+        # index of installed packages.
+        patcher = patch.object(fetch, 'DPKG_STATUS', '/nonexistent')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
     def _apt_cache(self):
         # mocks out the apt cache
         def cache_get(package):
@@ -248,6 +259,17 @@ class OpenStackHelpersTestCase(TestCase):
                 self.assertEquals(openstack.get_os_codename_package(pkg),
                                   vers['os_release'])
 
+    @patch.object(openstack, 'apt_cache')
+    @patch.object(openstack, 'installed_version')
+    def test_os_codename_from_installed_package(self, installed_version,
+                                                apt_cache):
+        '''Test deriving OpenStack codename from the installed package index'''
+        installed_version.return_value = '1:2013.1-0ubuntu1.1~cloud0'
+        self.assertEquals(openstack.get_os_codename_package('keystone-common'),
+                          'grizzly')
+        installed_version.assert_called_with('keystone-common')
+        self.assertFalse(apt_cache.called)
+
     @patch('charmhelpers.contrib.openstack.utils.error_out')
     def test_os_codename_from_bad_package_version(self, mocked_error):
         '''Test deriving OpenStack codename for a poorly versioned package'''
@@ -1,8 +1,10 @@
 import charmhelpers.contrib.openstack.context as context
+from charmhelpers.core import hookenv, unitdata
 import yaml
 import json
 import unittest
 from copy import copy, deepcopy
+from subprocess import CalledProcessError
 from mock import (
     patch,
     Mock,
@@ -1662,6 +1664,21 @@ class ContextTests(unittest.TestCase):
         neutron._ensure_packages()
         _install.assert_called_with(['quantum-plugin-package'], fatal=True)
 
+    @patch.object(context, 'neutron_plugin_attribute')
+    @patch.object(context, 'apt_install')
+    @patch.object(context, 'filter_installed_packages')
+    def test_neutron_ensure_package_batched(self, _filter, _install,
+                                            _packages):
+        '''Test neutron context queues required packages on an apt batch'''
+        _filter.return_value = ['quantum-plugin-package']
+        _packages.return_value = [['quantum-plugin-package']]
+        neutron = context.NeutronContext()
+        with patch.object(context, 'current_apt_batch') as batch:
+            neutron._ensure_packages()
+        batch.return_value.install.assert_called_with(
+            ['quantum-plugin-package'], fatal=True)
+        self.assertFalse(_install.called)
+
     @patch.object(context.NeutronContext, 'network_manager')
     @patch.object(context.NeutronContext, 'plugin')
     def test_neutron_save_flag_file(self, plugin, nm):
@@ -2491,3 +2508,130 @@ class ContextTests(unittest.TestCase):
         relation = FakeRelation(relation_data=QUANTUM_NETWORK_SERVICE_RELATION)
         self.relation_get.side_effect = relation.get
         self.assertEquals(context.NetworkServiceContext()(), data_result)
+
+
+class MemoizedContextTests(unittest.TestCase):
+
+    def setUp(self):
+        hookenv.cache.clear()
+        self.addCleanup(hookenv.cache.clear)
+        self.settings = {'debug': True}
+        patcher = patch('subprocess.check_output')
+        self.check_output = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.check_output.side_effect = lambda cmd: json.dumps(
+            self.settings.get(cmd[1])).encode('UTF-8')
+        patcher = patch.object(unitdata, 'kv')
+        patcher.start().return_value = unitdata.Storage(':memory:')
+        self.addCleanup(patcher.stop)
+
+        class DebugContext(context.OSContextGenerator):
+            interfaces = ['debug']
+            calls = []
+
+            def __call__(self):
+                self.calls.append(1)
+                return {'debug': hookenv.config('debug')}
+
+        self.generator = DebugContext()
+
+    def test_memoized_within_hook(self):
+        ctxt = context.MemoizedContext(self.generator)
+        self.assertEqual(ctxt.interfaces, ['debug'])
+        self.assertEqual(ctxt(), {'debug': True})
+        self.assertEqual(ctxt(), {'debug': True})
+        self.assertEqual(len(self.generator.calls), 1)
+        self.assertEqual(self.check_output.call_count, 1)
+
+    def test_inputs_changed(self):
+        ctxt = context.MemoizedContext(self.generator)
+        ctxt()
+        self.settings['debug'] = False
+        hookenv.cache.clear()
+        self.assertEqual(ctxt(), {'debug': False})
+        self.assertEqual(len(self.generator.calls), 2)
+
+    def test_persisted_across_hooks(self):
+        context.MemoizedContext(self.generator, 'debug')()
+        hookenv.cache.clear()
+        self.assertEqual(context.MemoizedContext(self.generator, 'debug')(),
+                         {'debug': True})
+        self.assertEqual(len(self.generator.calls), 1)
+        self.assertEqual(self.check_output.call_count, 2)
+
+    def test_relation_departed(self):
+        units = {'db:1': ['mysql/0']}
+
+        def hook_tool(cmd):
+            if cmd[0] == 'relation-list':
+                if cmd[-1] not in units:
+                    raise CalledProcessError(1, cmd)
+                return json.dumps(units[cmd[-1]]).encode('UTF-8')
+            return json.dumps({'host': 'db'}).encode('UTF-8')
+        self.check_output.side_effect = hook_tool
+
+        class DBContext(context.OSContextGenerator):
+            def __call__(self):
+                try:
+                    return {'hosts': [
+                        hookenv.relation_get('host', unit, 'db:1')
+                        for unit in hookenv.related_units('db:1')]}
+                except CalledProcessError:
+                    return {}
+
+        context.MemoizedContext(DBContext(), 'db')()
+        del units['db:1']
+        hookenv.cache.clear()
+        self.assertEqual(context.MemoizedContext(DBContext(), 'db')(), {})
+
+    def test_relation_restored(self):
+        units = {}
+
+        def hook_tool(cmd):
+            if cmd[0] == 'relation-list':
+                if cmd[-1] not in units:
+                    raise CalledProcessError(1, cmd)
+                return json.dumps(units[cmd[-1]]).encode('UTF-8')
+            return json.dumps({'host': 'db'}).encode('UTF-8')
+        self.check_output.side_effect = hook_tool
+
+        class DBContext(context.OSContextGenerator):
+            def __call__(self):
+                try:
+                    return {'hosts': [
+                        hookenv.relation_get('host', unit, 'db:1')
+                        for unit in hookenv.related_units('db:1')]}
+                except CalledProcessError:
+                    return {}
+
+        self.assertEqual(context.MemoizedContext(DBContext(), 'db')(), {})
+        self.assertIsNone(unitdata.kv().get('openstack.context.db'))
+        units['db:1'] = ['mysql/1']
+        hookenv.cache.clear()
+        self.assertEqual(context.MemoizedContext(DBContext(), 'db')(),
+                         {'hosts': [{'host': 'db'}]})
+
+    def test_not_persisted_unless_json_round_trips(self):
+        class PortsContext(context.OSContextGenerator):
+            calls = []
+
+            def __call__(self):
+                self.calls.append(1)
+                return {'ports': {hookenv.config('debug'): ('a', 'b')}}
+
+        generator = PortsContext()
+        ctxt = context.MemoizedContext(generator, 'ports')
+        self.assertEqual(ctxt(), {'ports': {True: ('a', 'b')}})
+        self.assertIsNone(unitdata.kv().get('openstack.context.ports'))
+        hookenv.cache.clear()
+        self.assertEqual(context.MemoizedContext(generator, 'ports')(),
+                         {'ports': {True: ('a', 'b')}})
+        self.assertEqual(len(generator.calls), 2)
+
+    def test_record_inputs_nested(self):
+        with hookenv.record_inputs() as outer:
+            hookenv.config('debug')
+            with hookenv.record_inputs() as inner:
+                hookenv.config('other')
+        self.assertEqual([i[1] for i in outer], [('debug',), ('other',)])
+        self.assertEqual([i[1] for i in inner], [('other',)])
@@ -1,5 +1,7 @@
 
 import os
+import shutil
+import tempfile
 import unittest
 
 from mock import patch, call, MagicMock
@@ -8,12 +10,6 @@ import charmhelpers.contrib.openstack.templating as templating
 
 from jinja2.exceptions import TemplateNotFound
 
-import six
-if not six.PY3:
-    builtin_open = '__builtin__.open'
-else:
-    builtin_open = 'builtins.open'
-
 
 class FakeContextGenerator(object):
     interfaces = None
@@ -166,31 +162,92 @@ class TemplatingTests(unittest.TestCase):
     def test_render_template_by_basename(self):
         '''It renders template if it finds it by config file basename'''
 
-    @patch(builtin_open)
     @patch.object(templating, 'get_loader')
-    def test_write_out_config(self, loader, _open):
+    def test_write_out_config(self, loader):
         '''It writes a templated config when provided a complete context'''
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        foo = os.path.join(tmpdir, 'foo')
+        with open(foo, 'w') as config:
+            config.write('old')
+        os.chmod(foo, 0o640)
+        inode = os.stat(foo).st_ino
         self.context.set(interfaces=['fooservice'], context={'foo': 'bar'})
-        self.renderer.register('/tmp/foo', [self.context])
+        self.renderer.register(foo, [self.context])
         with patch.object(self.renderer, '_get_template') as _get_t:
             fake_tmpl = MockTemplate()
+            fake_tmpl.render.return_value = u'foo = bar'
             _get_t.return_value = fake_tmpl
-            self.renderer.write('/tmp/foo')
-            _open.assert_called_with('/tmp/foo', 'wb')
+            self.renderer.write(foo)
+        with open(foo) as config:
+            self.assertEqual(config.read(), 'foo = bar')
+        st = os.stat(foo)
+        self.assertNotEqual(st.st_ino, inode)
+        self.assertEqual(st.st_mode & 0o777, 0o640)
+        self.assertEqual(os.listdir(tmpdir), ['foo'])
+
+    @patch('grp.getgrgid', side_effect=KeyError)
+    @patch('pwd.getpwuid', side_effect=KeyError)
+    @patch.object(templating, 'get_loader')
+    def test_write_out_config_unnamed_owner(self, loader, getpwuid,
+                                            getgrgid):
+        '''It keeps owners that have no passwd or group entry'''
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        foo = os.path.join(tmpdir, 'foo')
+        with open(foo, 'w') as config:
+            config.write('old')
+        st = os.stat(foo)
+        self.context.set(interfaces=['fooservice'], context={'foo': 'bar'})
+        self.renderer.register(foo, [self.context])
+        with patch.object(self.renderer, '_get_template') as _get_t:
+            fake_tmpl = MockTemplate()
+            fake_tmpl.render.return_value = u'foo = bar'
+            _get_t.return_value = fake_tmpl
+            self.renderer.write(foo)
+        with open(foo) as config:
+            self.assertEqual(config.read(), 'foo = bar')
+        self.assertEqual((os.stat(foo).st_uid, os.stat(foo).st_gid),
+                         (st.st_uid, st.st_gid))
 
     def test_write_all(self):
         '''It writes out all configuration files at once'''
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        foo = os.path.join(tmpdir, 'foo')
+        bar = os.path.join(tmpdir, 'bar')
         self.context.set(interfaces=['fooservice'], context={'foo': 'bar'})
-        self.renderer.register('/tmp/foo', [self.context])
-        self.renderer.register('/tmp/bar', [self.context])
-        ex_calls = [
-            call('/tmp/bar'),
-            call('/tmp/foo'),
-        ]
-        with patch.object(self.renderer, 'write') as _write:
-            self.renderer.write_all()
-            self.assertEquals(sorted(ex_calls), sorted(_write.call_args_list))
-            pass
+        other = FakeContextGenerator()
+        other.set(interfaces=['barservice'], context={'bar': 'baz'})
+        shared = MagicMock(wraps=self.context)
+        shared.interfaces = self.context.interfaces
+        self.renderer.register(foo, [shared])
+        self.renderer.register(bar, [shared, other])
+
+        def get_template(name):
+            tmpl = MockTemplate()
+            tmpl.render.side_effect = lambda ctxt: repr(sorted(ctxt.items()))
+            return tmpl
+
+        with patch.object(self.renderer, '_get_template') as _get_t:
+            _get_t.side_effect = get_template
+            report = self.renderer.write_all()
+            self.assertEqual(shared.call_count, 1)
+            self.assertEqual(sorted(report), [bar, foo])
+            self.assertEqual([report[f][0] for f in (foo, bar)],
+                             [True, True])
+            with open(bar) as config:
+                self.assertEqual(config.read(),
+                                 repr([('bar', 'baz'), ('foo', 'bar')]))
+
+            other.set(interfaces=['barservice'], context={'bar': 'qux'})
+            report = self.renderer.write_all(max_workers=1)
+            self.assertEqual([report[f][0] for f in (foo, bar)],
+                             [False, True])
+            changed, render_ms, context_ms = report[foo]
+            self.assertTrue(render_ms >= 0 and context_ms >= 0)
+        self.assertEqual(sorted(self.renderer.complete_contexts()),
+                         ['barservice', 'fooservice', 'fooservice'])
 
     @patch.object(templating, 'get_loader')
     def test_reset_template_loader_for_new_os_release(self, loader):
@@ -1,8 +1,11 @@
+import errno
 import os
 import json
 from subprocess import CalledProcessError
 import shutil
 import tempfile
+import threading
+import time
 from mock import call, MagicMock, mock_open, patch, sentinel
 from testtools import TestCase
 import yaml
@@ -261,7 +264,14 @@ class HelpersTest(TestCase):
     def setUp(self):
         super(HelpersTest, self).setUp()
         # Reset hookenv cache for each test
-        hookenv.cache = {}
+        hookenv.cache.clear()
+        hookenv._relation_set_accepts_file = None
+        hookenv.relation_snapshot_stats.update(invocations=0, saved=0)
+
+    def snapshot(self, rid, units):
+        for unit, settings in units.items():
+            hookenv._active_cache().set(hookenv._RELATION_SNAPSHOT,
+                                        (unit, rid), settings)
 
     @patch('subprocess.call')
     def test_logs_messages_to_juju_with_default_level(self, mock_call):
@@ -905,6 +915,143 @@ class HelpersTest(TestCase):
         check_output.assert_called_with(['relation-get', '--format=json',
                                          'baz-scope', 'baz-unit'])
 
+    @patch('charmhelpers.core.hookenv.related_units')
+    @patch('subprocess.check_output')
+    def test_prefetch_relation(self, check_output, related_units):
+        related_units.return_value = ['foo/0', 'foo/1']
+        check_output.side_effect = [
+            json.dumps({'host': 'a', 'port': '80'}).encode('UTF-8'),
+            json.dumps({'host': 'b'}).encode('UTF-8'),
+        ]
+
+        result = hookenv.prefetch_relation('foo:1')
+
+        self.assertEqual(result, {'foo/0': {'host': 'a', 'port': '80'},
+                                  'foo/1': {'host': 'b'}})
+        related_units.assert_called_with('foo:1')
+        check_output.assert_has_calls([
+            call(['relation-get', '--format=json', '-r', 'foo:1', '-',
+                  'foo/0']),
+            call(['relation-get', '--format=json', '-r', 'foo:1', '-',
+                  'foo/1']),
+        ])
+        self.assertEqual(hookenv.relation_snapshot_stats['invocations'], 2)
+
+    @patch('subprocess.check_output')
+    def test_relation_get_served_from_snapshot(self, check_output):
+        self.snapshot('foo:1', {'foo/0': {'host': 'a', 'port': '80'}})
+
+        self.assertEqual(
+            hookenv.relation_get('host', unit='foo/0', rid='foo:1'), 'a')
+        self.assertEqual(
+            hookenv.relation_get('port', unit='foo/0', rid='foo:1'), '80')
+        self.assertEqual(
+            hookenv.relation_get('missing', unit='foo/0', rid='foo:1'), None)
+        settings = hookenv.relation_get(unit='foo/0', rid='foo:1')
+        self.assertEqual(settings, {'host': 'a', 'port': '80'})
+        # Callers may mutate the result without corrupting the snapshot
+        settings['host'] = 'z'
+        self.assertEqual(hookenv._active_cache().get(
+            hookenv._RELATION_SNAPSHOT, ('foo/0', 'foo:1'))['host'], 'a')
+        self.assertFalse(check_output.called)
+        self.assertEqual(hookenv.relation_snapshot_stats['saved'], 4)
+
+    @patch('subprocess.check_output')
+    def test_relation_get_falls_back_for_unknown_units(self, check_output):
+        self.snapshot('foo:1', {'foo/0': {'host': 'a'}})
+        check_output.return_value = json.dumps('b').encode('UTF-8')
+
+        self.assertEqual(
+            hookenv.relation_get('host', unit='foo/1', rid='foo:1'), 'b')
+        check_output.assert_called_with(['relation-get', '--format=json',
+                                         '-r', 'foo:1', 'host', 'foo/1'])
+
+    @patch('charmhelpers.core.hookenv.relation_id')
+    @patch('charmhelpers.core.hookenv.remote_unit')
+    @patch('subprocess.check_output')
+    def test_relation_get_snapshot_uses_hook_context(self, check_output,
+                                                     remote_unit,
+                                                     relation_id):
+        remote_unit.return_value = 'foo/0'
+        relation_id.return_value = 'foo:1'
+        self.snapshot('foo:1', {'foo/0': {'host': 'a'}})
+
+        self.assertEqual(hookenv.relation_get('host'), 'a')
+        self.assertFalse(check_output.called)
+
+    @patch('charmhelpers.core.hookenv.relation_ids')
+    @patch('charmhelpers.core.hookenv.prefetch_relation')
+    def test_prefetch_relations(self, prefetch_relation, relation_ids):
+        relation_ids.return_value = ['foo:1', 'foo:2']
+        prefetch_relation.side_effect = lambda rid: {rid: {}}
+
+        result = hookenv.prefetch_relations('foo')
+
+        self.assertEqual(result, {'foo:1': {'foo:1': {}},
+                                  'foo:2': {'foo:2': {}}})
+        relation_ids.assert_called_with('foo')
+
+    @patch('subprocess.check_output')
+    def test_flush_relation_snapshot(self, check_output):
+        self.snapshot('foo:1', {'foo/0': {'host': 'a'}})
+        self.snapshot('foo:2', {'foo/1': {'host': 'b'}})
+        self.assertEqual(
+            hookenv.relation_get('host', unit='foo/0', rid='foo:1'), 'a')
+
+        hookenv.flush_relation_snapshot('foo:1')
+        check_output.return_value = json.dumps('c').encode('UTF-8')
+        self.assertEqual(
+            hookenv.relation_get('host', unit='foo/0', rid='foo:1'), 'c')
+        self.assertEqual(
+            hookenv.relation_get('host', unit='foo/1', rid='foo:2'), 'b')
+
+        hookenv.flush_relation_snapshot()
+        self.assertEqual(
+            hookenv.relation_get('host', unit='foo/1', rid='foo:2'), 'c')
+
+    @patch('charmhelpers.core.hookenv.related_units')
+    @patch('subprocess.check_output')
+    def test_invalidate_prefetched_relation(self, check_output,
+                                            related_units):
+        related_units.return_value = ['foo/0']
+        check_output.return_value = json.dumps({'host': 'a'}).encode('UTF-8')
+        hookenv.prefetch_relation('foo:1')
+        self.assertEqual(
+            hookenv.relation_get('host', unit='foo/0', rid='foo:1'), 'a')
+        check_output.return_value = json.dumps('b').encode('UTF-8')
+
+        hookenv.cache.invalidate('relation_get', rid='foo:1')
+        self.assertEqual(
+            hookenv.relation_get('host', unit='foo/0', rid='foo:1'), 'b')
+
+        self.addCleanup(setattr, hookenv, 'cache', hookenv.cache)
+        for reset in (hookenv.cache.clear,
+                      lambda: hookenv.flush('relation_get'),
+                      lambda: setattr(hookenv, 'cache', {})):
+            check_output.return_value = json.dumps(
+                {'host': 'a'}).encode('UTF-8')
+            hookenv.prefetch_relation('foo:1')
+            reset()
+            check_output.return_value = json.dumps('b').encode('UTF-8')
+            self.assertEqual(
+                hookenv.relation_get('host', unit='foo/0', rid='foo:1'), 'b')
+
+    @patch('time.time')
+    @patch('charmhelpers.core.hookenv.related_units')
+    @patch('subprocess.check_output')
+    def test_prefetched_relation_expires(self, check_output, related_units,
+                                         time):
+        time.return_value = 0
+        hookenv._active_cache().configure(ttl=10)
+        self.addCleanup(hookenv.cache.configure, ttl=None)
+        related_units.return_value = ['foo/0']
+        check_output.return_value = json.dumps({'host': 'a'}).encode('UTF-8')
+        hookenv.prefetch_relation('foo:1')
+        time.return_value = 20
+        check_output.return_value = json.dumps('b').encode('UTF-8')
+        self.assertEqual(
+            hookenv.relation_get('host', unit='foo/0', rid='foo:1'), 'b')
+
     @patch('charmhelpers.core.hookenv.local_unit')
     @patch('subprocess.check_call')
     @patch('subprocess.check_output')
@@ -983,6 +1130,64 @@ class HelpersTest(TestCase):
             self.assertEqual("{foo: bar}", f.read().strip())
         remove.assert_called_with(temp_file)
 
+    @patch('charmhelpers.core.hookenv.local_unit')
+    @patch('subprocess.check_output')
+    @patch('subprocess.check_call')
+    def test_relation_set_probes_file_support_once(self, check_call,
+                                                   check_output, local_unit):
+        check_output.return_value = b'usage: relation-set [options]'
+        hookenv.relation_set(foo='bar')
+        hookenv.relation_set(baz='qux')
+        check_output.assert_called_once_with(['relation-set', '--help'])
+        check_call.assert_has_calls([
+            call(['relation-set', 'foo=bar']),
+            call(['relation-set', 'baz=qux']),
+        ])
+
+    @patch('charmhelpers.core.hookenv.local_unit')
+    @patch('subprocess.check_output')
+    @patch('subprocess.check_call')
+    def test_relation_set_batch(self, check_call, check_output, local_unit):
+        check_output.return_value = b''
+        with hookenv.relation_set_batch():
+            hookenv.relation_set('db:1', foo='bar')
+            hookenv.relation_set(relation_settings={'foo': 'baz'})
+            hookenv.relation_set('db:1', {'a': '1'}, b=None)
+            hookenv.relation_set('db:1', a='2')
+            self.assertFalse(check_call.called)
+        self.assertEqual(check_call.call_count, 2)
+        first, second = [c[0][0] for c in check_call.call_args_list]
+        self.assertEqual(first[:3], ['relation-set', '-r', 'db:1'])
+        self.assertEqual(sorted(first[3:]), ['a=2', 'b=', 'foo=bar'])
+        self.assertEqual(second, ['relation-set', 'foo=baz'])
+
+    @patch('charmhelpers.core.hookenv.local_unit')
+    @patch('subprocess.check_output')
+    @patch('subprocess.check_call')
+    def test_relation_set_batch_nested(self, check_call, check_output,
+                                       local_unit):
+        check_output.return_value = b''
+        with hookenv.relation_set_batch():
+            with hookenv.relation_set_batch():
+                hookenv.relation_set('db:1', foo='bar')
+            self.assertFalse(check_call.called)
+            hookenv.relation_set('db:1', bar='baz')
+        self.assertEqual(check_call.call_count, 1)
+        command = check_call.call_args[0][0]
+        self.assertEqual(command[:3], ['relation-set', '-r', 'db:1'])
+        self.assertEqual(sorted(command[3:]), ['bar=baz', 'foo=bar'])
+
+    @patch('subprocess.check_call')
+    def test_relation_set_batch_discarded_on_error(self, check_call):
+        try:
+            with hookenv.relation_set_batch():
+                hookenv.relation_set('db:1', foo='bar')
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertFalse(check_call.called)
+        self.assertIsNone(hookenv._relation_set_batch)
+
     def test_lists_relation_types(self):
         open_ = mock_open()
         open_.return_value = io.BytesIO(CHARM_METADATA)
@@ -1084,6 +1289,459 @@ class HelpersTest(TestCase):
         self.assertTrue(hookenv.is_leader())
 
 
+class LogBufferTest(TestCase):
+    def setUp(self):
+        super(LogBufferTest, self).setUp()
+        self.addCleanup(hookenv.disable_log_buffer)
+
+    @patch('subprocess.call')
+    def test_drops_messages_below_threshold(self, call_):
+        log_buffer = hookenv.LogBuffer(threshold=hookenv.INFO)
+        log_buffer.write('debug', hookenv.DEBUG)
+        log_buffer.write('info')
+        log_buffer.write('custom', 'TRACE')
+        log_buffer.flush()
+        self.assertEqual(call_.call_args_list, [
+            call(['juju-log', 'info']),
+            call(['juju-log', '-l', 'TRACE', 'custom']),
+        ])
+        self.assertEqual(log_buffer.stats, {
+            'queued': 2, 'dropped': 1, 'coalesced': 0, 'invocations': 2})
+
+    @patch('subprocess.call')
+    def test_flush_coalesces_by_level(self, call_):
+        log_buffer = hookenv.LogBuffer()
+        log_buffer.write('a', hookenv.DEBUG)
+        log_buffer.write('b', hookenv.DEBUG)
+        log_buffer.write('b', hookenv.DEBUG)
+        log_buffer.write('b', hookenv.DEBUG)
+        log_buffer.write('c', hookenv.ERROR)
+        log_buffer.write('d', hookenv.DEBUG)
+        log_buffer.flush()
+        self.assertEqual(call_.call_args_list, [
+            call(['juju-log', '-l', 'DEBUG', 'a\nb (repeated 3 times)']),
+            call(['juju-log', '-l', 'ERROR', 'c']),
+            call(['juju-log', '-l', 'DEBUG', 'd']),
+        ])
+        self.assertEqual(log_buffer.stats['coalesced'], 3)
+        self.assertEqual(log_buffer.stats['invocations'], 3)
+
+        call_.reset_mock()
+        log_buffer.flush()
+        self.assertFalse(call_.called)
+
+    @patch('subprocess.call')
+    def test_log_uses_buffer(self, call_):
+        log_buffer = hookenv.enable_log_buffer(flush_interval=60)
+        self.assertIs(hookenv.enable_log_buffer(), log_buffer)
+        hookenv.log('foo')
+        hookenv.log(object, hookenv.INFO)
+        self.assertFalse(call_.called)
+
+        self.assertIs(hookenv.disable_log_buffer(), log_buffer)
+        self.assertEqual(call_.call_args_list, [
+            call(['juju-log', 'foo']),
+            call(['juju-log', '-l', 'INFO', repr(object)]),
+        ])
+        hookenv.log('bar')
+        call_.assert_called_with(['juju-log', 'bar'])
+
+    @patch('subprocess.call')
+    def test_background_flush(self, call_):
+        log_buffer = hookenv.LogBuffer(flush_interval=60, max_pending=2)
+        log_buffer.start()
+        self.addCleanup(log_buffer.stop)
+        log_buffer.write('a')
+        log_buffer.write('b')
+        for _ in range(100):
+            if call_.called:
+                break
+            time.sleep(0.01)
+        call_.assert_called_once_with(['juju-log', 'a\nb'])
+
+    @patch('subprocess.call')
+    def test_buffered_log_flushes_on_error(self, call_):
+        try:
+            with hookenv.buffered_log(flush_interval=60) as log_buffer:
+                hookenv.log('failing', hookenv.ERROR)
+                raise ValueError()
+        except ValueError:
+            pass
+        call_.assert_called_once_with(['juju-log', '-l', 'ERROR', 'failing'])
+        self.assertIsNone(hookenv._log_buffer)
+        self.assertEqual(log_buffer.stats['queued'], 1)
+
+    @patch('subprocess.call')
+    def test_buffered_log_nested(self, call_):
+        with hookenv.buffered_log(flush_interval=60) as outer:
+            with hookenv.buffered_log() as inner:
+                hookenv.log('foo')
+            self.assertIs(inner, outer)
+            self.assertFalse(call_.called)
+        call_.assert_called_once_with(['juju-log', 'foo'])
+
+
+class HookCacheTest(TestCase):
+    def setUp(self):
+        super(HookCacheTest, self).setUp()
+        self.cache = hookenv.HookCache(maxsize=3)
+        self.cache.register('relation_get', ('attribute', 'unit', 'rid'))
+
+    def test_get_missing(self):
+        self.assertRaises(KeyError, self.cache.get, 'relation_get', ('a',))
+        self.assertEqual(self.cache.stats(), {
+            'hits': 0, 'misses': 1, 'evictions': 0, 'size': 0})
+
+    def test_set_and_get(self):
+        self.cache.set('relation_get', ('a', None, None), 'b')
+        self.assertEqual(self.cache.get('relation_get', ('a', None, None)),
+                         'b')
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(len(self.cache), 1)
+
+    def test_lru_eviction(self):
+        for i in range(3):
+            self.cache.set('relation_get', (i, None, None), i)
+        # Touch the oldest entry so it survives the next insert
+        self.cache.get('relation_get', (0, None, None))
+        self.cache.set('relation_get', (3, None, None), 3)
+        self.assertEqual(len(self.cache), 3)
+        self.assertRaises(KeyError, self.cache.get, 'relation_get',
+                          (1, None, None))
+        self.assertEqual(self.cache.get('relation_get', (0, None, None)), 0)
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_configure_shrinks(self):
+        for i in range(3):
+            self.cache.set('relation_get', (i, None, None), i)
+        self.cache.configure(maxsize=1)
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(self.cache.get('relation_get', (2, None, None)), 2)
+
+    @patch('charmhelpers.core.hookenv.time')
+    def test_ttl(self, time_):
+        self.cache.configure(ttl=10)
+        time_.time.return_value = 100
+        self.cache.set('relation_get', ('a', None, None), 'b')
+        time_.time.return_value = 105
+        self.assertEqual(self.cache.get('relation_get', ('a', None, None)),
+                         'b')
+        time_.time.return_value = 111
+        self.assertRaises(KeyError, self.cache.get, 'relation_get',
+                          ('a', None, None))
+
+    def test_invalidate_namespace(self):
+        self.cache.set('relation_get', ('a', None, None), 1)
+        self.cache.set('unit_get', ('a',), 2)
+        self.cache.invalidate('relation_get')
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(self.cache.get('unit_get', ('a',)), 2)
+
+    def test_invalidate_matching_params(self):
+        self.cache.set('relation_get', ('a', 'foo/0', 'db:1'), 1)
+        self.cache.set('relation_get', ('a', 'foo/0', 'db:2'), 2)
+        self.cache.set('relation_get', ('a', 'foo/1', 'db:1'), 3)
+        self.cache.invalidate('relation_get', rid='db:1', unit='foo/0')
+        self.assertRaises(KeyError, self.cache.get, 'relation_get',
+                          ('a', 'foo/0', 'db:1'))
+        self.assertEqual(
+            self.cache.get('relation_get', ('a', 'foo/0', 'db:2')), 2)
+        self.assertEqual(
+            self.cache.get('relation_get', ('a', 'foo/1', 'db:1')), 3)
+
+    def test_invalidate_unknown_param(self):
+        self.cache.set('relation_get', ('a', 'foo/0', 'db:1'), 1)
+        self.cache.invalidate('relation_get', relid='db:1')
+        self.assertEqual(len(self.cache), 1)
+
+    def test_invalidate_all(self):
+        self.cache.set('relation_get', ('a', None, None), 1)
+        self.cache.set('unit_get', ('a',), 2)
+        self.cache.invalidate()
+        self.assertEqual(len(self.cache), 0)
+
+    def test_flush_matching(self):
+        self.cache.set('relation_get', ('a', 'foo/0', None), 1)
+        self.cache.set('relation_get', ('a', 'foo/1', None), 2)
+        self.cache.flush('foo/0')
+        self.assertEqual(len(self.cache), 1)
+
+    def test_clear(self):
+        self.cache.set('relation_get', ('a', None, None), 1)
+        self.cache.get('relation_get', ('a', None, None))
+        self.cache.clear()
+        self.assertEqual(self.cache.stats(), {
+            'hits': 0, 'misses': 0, 'evictions': 0, 'size': 0})
+
+
+class CachedDecoratorTest(TestCase):
+    def setUp(self):
+        super(CachedDecoratorTest, self).setUp()
+        hookenv.cache.clear()
+        hookenv._relation_set_accepts_file = None
+
+    def test_keys_bound_to_parameters(self):
+        calls = []
+
+        @hookenv.cached
+        def lookup(attribute=None, unit=None):
+            calls.append((attribute, unit))
+            return attribute
+
+        lookup('a', 'foo/0')
+        lookup('a', unit='foo/0')
+        lookup(attribute='a', unit='foo/0')
+        lookup(unit='foo/0', attribute='a')
+        self.assertEqual(calls, [('a', 'foo/0')])
+        lookup()
+        lookup(None)
+        self.assertEqual(calls, [('a', 'foo/0'), (None, None)])
+
+    def test_functions_with_same_name(self):
+        def make_lookup(value):
+            @hookenv.cached
+            def lookup(attribute):
+                return value
+            return lookup
+
+        first, second = make_lookup('A'), make_lookup('B')
+        self.assertEqual(first('x'), 'A')
+        self.assertEqual(second('x'), 'B')
+
+    def test_invalidate_by_function_name(self):
+        calls = []
+
+        @hookenv.cached
+        def lookup(attribute):
+            calls.append(attribute)
+            return attribute
+
+        lookup('a')
+        hookenv.cache.invalidate('lookup', attribute='a')
+        lookup('a')
+        self.assertEqual(calls, ['a', 'a'])
+
+    @patch('subprocess.check_output')
+    def test_legacy_reset(self, check_output):
+        cache = hookenv.cache
+        self.addCleanup(setattr, hookenv, 'cache', cache)
+        check_output.return_value = json.dumps('10.0.0.1').encode('UTF-8')
+        self.assertEqual(hookenv.unit_get('private-address'), '10.0.0.1')
+        hookenv.cache = {}
+        check_output.return_value = json.dumps('10.0.0.2').encode('UTF-8')
+        self.assertEqual(hookenv.unit_get('private-address'), '10.0.0.2')
+        check_output.return_value = json.dumps('10.0.0.3').encode('UTF-8')
+        self.assertEqual(hookenv.unit_get('private-address'), '10.0.0.3')
+        self.assertEqual(hookenv.cache, {})
+        hookenv.cache = cache
+        self.assertEqual(hookenv.unit_get('private-address'), '10.0.0.3')
+        self.assertEqual(check_output.call_count, 3)
+
+    def test_dict_compatibility(self):
+        cache = hookenv.HookCache()
+        cache['key'] = 'value'
+        self.assertIn('key', cache)
+        self.assertEqual(cache['key'], 'value')
+        self.assertEqual(len(cache), 1)
+        del cache['key']
+        self.assertNotIn('key', cache)
+        self.assertRaises(KeyError, lambda: cache['key'])
+        cache['key'] = 'value'
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    @patch('subprocess.check_output')
+    def test_record_uncached_reads(self, check_output):
+        check_output.return_value = json.dumps('bar').encode('UTF-8')
+        with patch.dict('os.environ', {'JUJU_RELATION_ID': 'db:1'}):
+            with hookenv.record_inputs() as inputs:
+                hookenv.relation_id()
+                hookenv.leader_get('foo')
+            self.assertEqual([i[3] for i in inputs], ['db:1', 'bar'])
+            self.assertTrue(inputs.memoisable)
+            replayable = inputs.replayable()
+            self.assertFalse(hookenv.inputs_changed(replayable))
+            check_output.return_value = json.dumps('baz').encode('UTF-8')
+            self.assertTrue(hookenv.inputs_changed(replayable))
+
+    @patch('subprocess.check_output')
+    def test_inputs_changed_stops_at_first_change(self, check_output):
+        check_output.side_effect = [b'["db:1"]', b'["mysql/0"]']
+        with hookenv.record_inputs() as inputs:
+            for rid in hookenv.relation_ids('db'):
+                hookenv.related_units(rid)
+        hookenv.cache.clear()
+        check_output.side_effect = [b'[]', CalledProcessError(1, 'x')]
+        self.assertTrue(hookenv.inputs_changed(inputs.replayable()))
+        self.assertEqual(check_output.call_count, 3)
+        hookenv.cache.clear()
+        check_output.side_effect = [b'["db:1"]', CalledProcessError(1, 'x')]
+        self.assertTrue(hookenv.inputs_changed(inputs.replayable()))
+
+    @patch('subprocess.check_output')
+    def test_record_nested_reads_once(self, check_output):
+        check_output.return_value = json.dumps({'foo': 'bar'}).encode('UTF-8')
+        with patch.dict('os.environ', {'JUJU_RELATION_ID': 'db:1',
+                                       'JUJU_REMOTE_UNIT': 'db/0'}):
+            with hookenv.record_inputs() as inputs:
+                hookenv.relation_get()
+        self.assertEqual(len(inputs), 1)
+
+    @patch('subprocess.check_output')
+    def test_unrecorded_read_not_memoisable(self, check_output):
+        check_output.return_value = b'"10.0.0.1"'
+        with hookenv.record_inputs() as inputs:
+            hookenv.unit_get('private-address')
+            self.assertTrue(inputs.memoisable)
+            hookenv._check_output(['storage-get'])
+        self.assertFalse(inputs.memoisable)
+
+    @patch('subprocess.check_output')
+    def test_share_recording(self, check_output):
+        check_output.return_value = b'"10.0.0.1"'
+        with hookenv.record_inputs() as inputs:
+            thread = threading.Thread(target=hookenv.share_recording(
+                lambda: hookenv.unit_get('private-address')))
+            thread.start()
+            thread.join()
+            hookenv.share_recording(hookenv.relation_id)()
+        self.assertEqual([i[3] for i in inputs], ['10.0.0.1', None])
+
+    def test_unhashable_arguments(self):
+        calls = []
+
+        @hookenv.cached
+        def lookup(keys):
+            calls.append(keys)
+            return len(keys)
+
+        self.assertEqual(lookup(['a', 'b']), 2)
+        self.assertEqual(lookup(['a', 'b']), 2)
+        self.assertEqual(calls, [['a', 'b']])
+
+    @patch('charmhelpers.core.hookenv.local_unit')
+    @patch('subprocess.check_call')
+    @patch('subprocess.check_output')
+    def test_relation_set_invalidates_only_its_relation(self, check_output,
+                                                        check_call,
+                                                        local_unit):
+        local_unit.return_value = 'me/0'
+        check_output.return_value = json.dumps('BAR').encode('UTF-8')
+        hookenv.relation_get('foo', unit='me/0', rid='db:1')
+        hookenv.relation_get('foo', unit='me/0', rid='db:2')
+        hookenv.relation_get('foo', unit='them/0', rid='db:1')
+        hookenv.unit_get('private-address')
+        check_output.return_value = ''
+
+        hookenv.relation_set('db:1', foo='baz')
+
+        self.assertEqual(len(hookenv.cache), 3)
+        check_output.reset_mock()
+        hookenv.relation_get('foo', unit='me/0', rid='db:2')
+        hookenv.relation_get('foo', unit='them/0', rid='db:1')
+        self.assertFalse(check_output.called)
+
+
+class HookToolTransportTest(TestCase):
+    def setUp(self):
+        super(HookToolTransportTest, self).setUp()
+        hookenv.cache.clear()
+        self.requests = []
+        self.responses = {}
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.server = hookenv.HookToolServer(
+            os.path.join(tmpdir, 'hook-tools.sock'), self.handle)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.transport = hookenv.SocketTransport(self.server.path)
+        self.addCleanup(self.transport.close)
+        self.previous = hookenv.set_transport(self.transport)
+        self.addCleanup(hookenv.set_transport, self.previous)
+
+    def handle(self, args):
+        self.requests.append(args)
+        response = self.responses[args[0]]
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def test_default_transport(self):
+        self.assertIsInstance(self.previous, hookenv.SubprocessTransport)
+
+    def test_get_transport(self):
+        self.assertIs(hookenv.get_transport(), self.transport)
+
+    @patch('subprocess.check_output')
+    def test_config_over_socket(self, check_output):
+        self.responses['config-get'] = (0, b'"bar"')
+        self.assertEqual(hookenv.config('foo'), 'bar')
+        self.assertEqual(self.requests,
+                         [['config-get', 'foo', '--format=json']])
+        self.assertFalse(check_output.called)
+
+    def test_requests_share_connection(self):
+        self.responses['unit-get'] = (0, b'"10.0.0.1"')
+        self.responses['relation-ids'] = (0, b'["db:1"]')
+        self.assertEqual(hookenv.unit_get('private-address'), '10.0.0.1')
+        sock = self.transport._sock
+        self.assertEqual(hookenv.relation_ids('db'), ['db:1'])
+        self.assertIs(self.transport._sock, sock)
+
+    def test_reconnect_after_server_restart(self):
+        self.responses['unit-get'] = (0, b'"old"')
+        self.assertEqual(self.transport.check_output(['unit-get']), b'"old"')
+        self.server.stop()
+        server = hookenv.HookToolServer(self.server.path,
+                                        lambda args: (0, b'"new"'))
+        server.start()
+        self.addCleanup(server.stop)
+        # Stopping closed the connection, which the next request finds out.
+        self.assertRaises(IOError, self.transport.check_output, ['unit-get'])
+        self.assertIsNone(self.transport._sock)
+        self.assertEqual(self.transport.check_output(['unit-get']), b'"new"')
+
+    def test_check_output_error(self):
+        self.responses['relation-get'] = (2, b'')
+        self.assertEqual(hookenv.relation_get('foo', 'bar/0', 'db:1'), None)
+        self.responses['relation-get'] = (1, b'boom')
+        e = self.assertRaises(CalledProcessError, self.transport.check_output,
+                              ['relation-get', 'foo'])
+        self.assertEqual(e.returncode, 1)
+        self.assertEqual(e.output, b'boom')
+
+    def test_check_call_error(self):
+        self.responses['open-port'] = (1, b'')
+        self.assertRaises(CalledProcessError, hookenv.open_port, 80)
+
+    def test_missing_tool(self):
+        self.responses['is-leader'] = OSError(errno.ENOENT, 'is-leader')
+        self.assertRaises(NotImplementedError, hookenv.is_leader)
+
+    @patch('sys.stderr')
+    def test_missing_juju_log(self, stderr):
+        self.responses['juju-log'] = OSError(errno.ENOENT, 'juju-log')
+        hookenv.log('foo', hookenv.INFO)
+        stderr.write.assert_any_call('juju-log: INFO: foo')
+
+    def test_status_get_text(self):
+        self.responses['status-get'] = (0, b'active\n')
+        self.assertEqual(hookenv.status_get(), 'active')
+
+    def test_run_many(self):
+        self.responses['relation-list'] = (0, b'["foo/0"]')
+        self.responses['leader-get'] = OSError(errno.ENOENT, 'leader-get')
+        results = self.transport.run_many([
+            ['relation-list', '-r', 'foo:1'],
+            ['leader-get', '-'],
+            ['relation-list', '-r', 'foo:2'],
+        ])
+        self.assertEqual(results[0], (0, b'["foo/0"]'))
+        self.assertIsInstance(results[1], OSError)
+        self.assertEqual(results[1].errno, errno.ENOENT)
+        self.assertEqual(results[2], (0, b'["foo/0"]'))
+
+
 class HooksTest(TestCase):
     def setUp(self):
         super(HooksTest, self).setUp()
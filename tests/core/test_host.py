@@ -1,5 +1,13 @@
 from collections import OrderedDict
+import hashlib
+import grp
+import os
+import pwd
+import shutil
 import subprocess
+import tempfile
+import threading
+import time
 import apt_pkg
 
 from mock import patch, call
@@ -8,7 +16,8 @@ from tests.helpers import patch_open
 from tests.helpers import mock_open as mocked_open
 import six
 
-from charmhelpers.core import host
+from charmhelpers import fetch
+from charmhelpers.core import host, unitdata
 
 
 MOUNT_LINES = ("""
@@ -514,6 +523,71 @@ class HelpersTest(TestCase):
             mock_open.assert_called_with('/some/path/{baz}', 'wb')
             mock_file.write.assert_called_with(fmtstr)
 
+    def owner_group(self):
+        return (pwd.getpwuid(os.getuid()).pw_name,
+                grp.getgrgid(os.getgid()).gr_name)
+
+    @patch.object(host, 'log')
+    def test_write_file_if_changed(self, log):
+        owner, group = self.owner_group()
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'test.conf')
+
+        self.assertTrue(host.write_file(path, b'one', owner, group, 0o640,
+                                        if_changed=True))
+        past = int(time.time()) - 10
+        os.utime(path, (past, past))
+        self.assertFalse(host.write_file(path, b'one', owner, group, 0o600,
+                                         if_changed=True))
+        st = os.stat(path)
+        self.assertEqual(st.st_mtime, past)
+        self.assertEqual(st.st_mode & 0o777, 0o600)
+
+        self.assertTrue(host.write_file(path, b'two', owner, group, 0o600,
+                                        if_changed=True))
+        self.assertNotEqual(os.stat(path).st_ino, st.st_ino)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'two')
+        self.assertEqual(os.listdir(tmpdir), ['test.conf'])
+
+    @patch.object(host, 'log')
+    def test_write_file_numeric_owner(self, log):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'test.conf')
+        with patch('pwd.getpwnam') as getpwnam:
+            host.write_file(path, b'one', os.getuid(), os.getgid(),
+                            if_changed=True)
+            self.assertFalse(getpwnam.called)
+        st = os.stat(path)
+        self.assertEqual((st.st_uid, st.st_gid), (os.getuid(), os.getgid()))
+
+    @patch.object(host, 'log')
+    def test_write_file_if_changed_through_link(self, log):
+        owner, group = self.owner_group()
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'real.conf')
+        link = os.path.join(tmpdir, 'link.conf')
+        os.symlink(path, link)
+        host.write_file(link, b'content', owner, group, if_changed=True)
+        self.assertTrue(os.path.islink(link))
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'content')
+
+    @patch.object(host, 'log')
+    @patch.object(host.os, 'rename')
+    def test_write_file_if_changed_failure(self, rename, log):
+        owner, group = self.owner_group()
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        rename.side_effect = OSError('no')
+        self.assertRaises(OSError, host.write_file,
+                          os.path.join(tmpdir, 'test.conf'), b'content',
+                          owner, group, if_changed=True)
+        self.assertEqual(os.listdir(tmpdir), [])
+
     @patch('subprocess.check_output')
     @patch.object(host, 'log')
     def test_mounts_a_device(self, log, check_output):
@@ -677,6 +751,144 @@ class HelpersTest(TestCase):
             call('file', 'sha256'),
         ])
 
+    def write_hash_file(self, name, content, age=10):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        past = time.time() - age
+        os.utime(path, (past, past))
+        return path
+
+    def test_file_hash_chunked(self):
+        content = b'x' * (host.HASH_CHUNK_SIZE * 2 + 5)
+        path = self.write_hash_file('big', content)
+        self.assertEqual(host.file_hash(path, 'sha256'),
+                         hashlib.sha256(content).hexdigest())
+        path = self.write_hash_file('empty', b'')
+        self.assertEqual(host.file_hash(path), hashlib.md5().hexdigest())
+
+    @patch.object(unitdata, 'kv')
+    def test_file_hash_cache(self, kv):
+        kv.return_value = unitdata.Storage(':memory:')
+        path = self.write_hash_file('conf', b'a')
+        expected = hashlib.md5(b'a').hexdigest()
+        self.assertEqual(host.file_hash(path, cache=True), expected)
+        with patch.object(host, '_hash_file') as hash_file:
+            self.assertEqual(host.file_hash(path, cache=True), expected)
+            self.assertFalse(hash_file.called)
+        self.assertEqual(host.file_hash(path, 'sha1', cache=True),
+                         hashlib.sha1(b'a').hexdigest())
+
+        with open(path, 'wb') as f:
+            f.write(b'b')
+        os.utime(path, (time.time() - 5, time.time() - 5))
+        self.assertEqual(host.file_hash(path, cache=True),
+                         hashlib.md5(b'b').hexdigest())
+
+    @patch.object(unitdata, 'kv')
+    def test_file_hash_cache_skips_recent_files(self, kv):
+        kv.return_value = unitdata.Storage(':memory:')
+        path = self.write_hash_file('conf', b'a', age=0)
+        host.file_hash(path, cache=True)
+        self.assertEqual(kv.return_value.getrange('host.file_hash'), None)
+
+    def test_file_hash_cache_worker_thread(self):
+        path = self.write_hash_file('conf', b'a')
+        result = []
+        worker = threading.Thread(target=lambda: result.append(
+            host.file_hash(path, cache=True)))
+        with patch.object(unitdata, '_KV', unitdata.Storage(':memory:')):
+            worker.start()
+            worker.join()
+            recorded = unitdata.kv().get(host._file_hash_key(path, 'md5'))
+            self.assertEqual(recorded[-1], hashlib.md5(b'a').hexdigest())
+        self.assertEqual(result, [hashlib.md5(b'a').hexdigest()])
+
+    def test_file_hashes(self):
+        paths = [self.write_hash_file('f%d' % i, six.b(str(i)))
+                 for i in range(10)]
+        result = host.file_hashes(paths + ['/nonexistent'], 'sha1')
+        self.assertEqual(result['/nonexistent'], None)
+        for i, path in enumerate(paths):
+            self.assertEqual(result[path],
+                             hashlib.sha1(six.b(str(i))).hexdigest())
+
+    def make_tree(self, files):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        for name, content in files.items():
+            path = os.path.join(root, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(content)
+        return root
+
+    def test_tree_hashes(self):
+        root = self.make_tree({'a.conf': b'a', 'sub/b.conf': b'b',
+                               'sub/c.txt': b'c'})
+        conf = os.path.join(root, 'a.conf')
+        pattern = os.path.join(root, 'sub', '*.conf')
+        paths = [root, pattern, conf, os.path.join(root, '*.none')]
+        before = host.tree_hashes(paths)
+        self.assertEqual(before[conf], hashlib.md5(b'a').hexdigest())
+        self.assertEqual(before[os.path.join(root, '*.none')], None)
+        self.assertEqual(host.tree_hashes(paths), before)
+
+        with open(os.path.join(root, 'sub', 'c.txt'), 'wb') as f:
+            f.write(b'changed')
+        after = host.tree_hashes(paths)
+        self.assertNotEqual(after[root], before[root])
+        self.assertEqual(after[pattern], before[pattern])
+
+        os.unlink(os.path.join(root, 'sub', 'b.conf'))
+        after = host.tree_hashes(paths)
+        self.assertEqual(after[pattern], None)
+
+        os.mkdir(os.path.join(root, 'empty'))
+        self.assertNotEqual(host.tree_hashes([root])[root], after[root])
+
+    @patch.object(unitdata, 'kv')
+    def test_tree_hashes_cached(self, kv):
+        kv.return_value = unitdata.Storage(':memory:')
+        root = self.make_tree(dict(('f%d' % i, b'x') for i in range(5)))
+        past = time.time() - 10
+        for name in os.listdir(root):
+            os.utime(os.path.join(root, name), (past, past))
+        before = host.tree_hashes([root], cache=True)[root]
+        with open(os.path.join(root, 'f1'), 'wb') as f:
+            f.write(b'y')
+        with patch.object(host, '_hash_file') as hash_file:
+            hash_file.return_value = 'new'
+            after = host.tree_hashes([root], cache=True)[root]
+        hash_file.assert_called_once_with(os.path.join(root, 'f1'), 'md5')
+        self.assertNotEqual(after, before)
+
+    @patch.object(host, 'service')
+    def test_restart_on_change_directory(self, service):
+        root = self.make_tree({'sites/a': b'a', 'nrpe.d/check': b'c'})
+        restart_map = {os.path.join(root, 'sites', '*'): ['apache2'],
+                       os.path.join(root, 'nrpe.d'): ['nrpe']}
+
+        @host.restart_on_change(restart_map)
+        def add_site():
+            with open(os.path.join(root, 'sites', 'b'), 'wb') as f:
+                f.write(b'b')
+
+        add_site()
+        service.assert_called_once_with('restart', 'apache2')
+
+    def test_threaded_map_reraises(self):
+        def func(item):
+            if item == 3:
+                raise ValueError(item)
+            return item
+
+        self.assertEqual(host.threaded_map(func, [1, 2], 4), {1: 1, 2: 2})
+        self.assertRaises(ValueError, host.threaded_map, func, range(5), 2)
+
     @patch.object(host, 'service')
     @patch('os.path.exists')
     def test_restart_no_changes(self, exists, service):
@@ -775,6 +987,99 @@ class HelpersTest(TestCase):
         ]
         self.assertEquals(expected, service.call_args_list)
 
+    @patch.object(host, 'service')
+    @patch.object(host, 'tree_hashes')
+    def test_restart_on_change_report(self, tree_hashes, service):
+        tree_hashes.side_effect = [{'/etc/a.conf': None},
+                                   {'/etc/a.conf': 'x'}]
+        service.return_value = True
+        reports = []
+
+        @host.restart_on_change({'/etc/a.conf': ['a', 'b']},
+                                stopstart=True, report=reports.append)
+        def make_some_changes():
+            pass
+
+        make_some_changes()
+        self.assertEqual(service.call_args_list, [
+            call('stop', 'a'), call('stop', 'b'),
+            call('start', 'a'), call('start', 'b')])
+        self.assertEqual(list(reports[0]), ['a', 'b'])
+        success, elapsed = reports[0]['a']['start']
+        self.assertTrue(success)
+        self.assertTrue(elapsed >= 0)
+
+    @patch.object(host, 'service')
+    def test_restart_services_dependencies(self, service):
+        service.return_value = True
+        dependencies = {'nova-api': ['keystone'], 'keystone': ['mysql'],
+                        'haproxy': ['nova-api', 'glance']}
+        host.restart_services(
+            ['haproxy', 'nova-api', 'keystone', 'glance'], stopstart=True,
+            dependencies=dependencies)
+        self.assertEqual(service.call_args_list, [
+            call('stop', 'haproxy'), call('stop', 'nova-api'),
+            call('stop', 'keystone'), call('stop', 'glance'),
+            call('start', 'keystone'), call('start', 'glance'),
+            call('start', 'nova-api'), call('start', 'haproxy')])
+        self.assertRaises(ValueError, host.restart_services, ['a', 'b'],
+                          dependencies={'a': ['b'], 'b': ['a']})
+
+    @patch.object(host, 'log')
+    @patch.object(host, 'service')
+    def test_restart_services_concurrently(self, service, log):
+        started = threading.Event()
+
+        def restart(action, service_name):
+            if service_name == 'a':
+                # Only returns in time if 'b' is restarted meanwhile.
+                return started.wait(5)
+            started.set()
+            return service_name != 'c'
+
+        service.side_effect = restart
+        timings = host.restart_services(['a', 'b', 'c'], max_workers=3)
+        self.assertEqual(
+            [(name, timings[name]['restart'][0]) for name in timings],
+            [('a', True), ('b', True), ('c', False)])
+        log.assert_called_with('Failed to restart c', level=host.WARNING)
+
+    @patch.object(host, 'service')
+    def test_restart_services_timeout(self, service):
+        service.return_value = True
+        host.restart_services(['a'], timeout=30)
+        service.assert_called_with('restart', 'a', timeout=30)
+
+    @patch.object(host, 'log')
+    def test_call_with_timeout(self, log):
+        self.assertEqual(host._call_with_timeout(['true'], 5), 0)
+        started = time.time()
+        self.assertEqual(host._call_with_timeout(['sleep', '10'], 0.2), None)
+        self.assertTrue(time.time() - started < 5)
+        self.assertTrue(log.called)
+
+    @patch.object(host, 'log')
+    def test_call_with_timeout_kills_children(self, log):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        pidfile = os.path.join(tmpdir, 'pid')
+        self.assertEqual(host._call_with_timeout(
+            ['sh', '-c', 'sleep 30 & echo $! > %s; wait' % pidfile], 0.5),
+            None)
+        with open(pidfile) as f:
+            pid = int(f.read())
+
+        def alive():
+            try:
+                with open('/proc/%d/stat' % pid) as f:
+                    return f.read().split(')')[-1].split()[0] != 'Z'
+            except IOError:
+                return False
+        deadline = time.time() + 5
+        while alive() and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertFalse(alive())
+
     def test_lsb_release(self):
         result = {
             "DISTRIB_ID": "Ubuntu",
@@ -848,8 +1153,21 @@ class HelpersTest(TestCase):
         hwaddr = host.get_nic_hwaddr(nic)
         self.assertEqual(hwaddr, 'e4:11:5b:ab:a7:3c')
 
+    @patch.object(fetch, 'installed_version')
+    @patch.object(apt_pkg, 'Cache')
+    def test_cmp_pkgrevno_installed_index(self, pkg_cache, installed_version):
+        installed_version.return_value = '2.4'
+        self.assertEqual(host.cmp_pkgrevno('python', '2.3'), 1)
+        self.assertEqual(host.cmp_pkgrevno('python', '2.4'), 0)
+        self.assertEqual(host.cmp_pkgrevno('python', '2.5'), -1)
+        self.assertFalse(pkg_cache.called)
+
+    @patch.object(fetch, 'DPKG_STATUS', '/nonexistent')
     @patch.object(apt_pkg, 'Cache')
     def test_cmp_pkgrevno_revnos(self, pkg_cache):
+        fetch.invalidate_apt_cache()
+        self.addCleanup(fetch.invalidate_apt_cache)
+
         class MockPackage:
             class MockPackageRevno:
                 def __init__(self, ver_str):
@@ -1,7 +1,12 @@
+import json
+import jinja2
 import mock
+import threading
 import unittest
+from subprocess import CalledProcessError
 from charmhelpers.core import hookenv
 from charmhelpers.core import services
+from charmhelpers.core import unitdata
 
 
 class TestServiceManager(unittest.TestCase):
@@ -304,6 +309,41 @@ class TestServiceManager(unittest.TestCase):
         assert not manager.is_ready('foo')
         get_service.assert_has_calls([mock.call('foo'), mock.call('bar')])
 
+    @mock.patch.object(services.ServiceManager, 'get_service')
+    def test_is_ready_factories(self, get_service):
+        made = []
+
+        def factory(ready):
+            def make():
+                made.append(ready)
+                return {'ready': True} if ready else {}
+            return make
+        ready, not_ready, unused = factory(True), factory(False), factory(1)
+        get_service.side_effect = lambda name: {
+            'a': {'required_data': [ready, not_ready, unused]},
+            'b': {'required_data': [ready]},
+        }[name]
+        manager = services.ServiceManager()
+        assert not manager.is_ready('a')
+        assert manager.is_ready('b')
+        self.assertEqual(made, [True, False])
+        self.assertIs(manager.required_context(ready),
+                      manager.required_context(ready))
+
+    @mock.patch.object(services.ServiceManager, 'reconfigure_services')
+    @mock.patch.object(services.ServiceManager, 'provide_data')
+    @mock.patch.object(hookenv, 'config')
+    @mock.patch.object(hookenv, 'hook_name')
+    def test_required_context_per_hook(self, hook_name, config, *_):
+        factory = mock.Mock(side_effect=lambda: {'x': 1})
+        manager = services.ServiceManager()
+        manager.required_context(factory)
+        manager.required_context(factory)
+        self.assertEqual(factory.call_count, 1)
+        manager.manage()
+        manager.required_context(factory)
+        self.assertEqual(factory.call_count, 2)
+
     def test_load_ready_file_short_circuit(self):
         manager = services.ServiceManager()
         manager._ready = 'foo'
@@ -377,6 +417,282 @@ class TestServiceManager(unittest.TestCase):
         assert manager.was_ready('foo')
         assert not manager.was_ready('bar')
 
+    @mock.patch.object(unitdata, 'kv')
+    @mock.patch('os.path.exists')
+    def test_incremental_ready_in_unitdata(self, exists, kv):
+        kv.return_value = unitdata.Storage(':memory:')
+        exists.return_value = False
+        manager = services.ServiceManager(incremental=True)
+        manager.save_ready('foo')
+        self.assertEqual(kv.return_value.get('services.ready'), ['foo'])
+        manager = services.ServiceManager(incremental=True)
+        assert manager.was_ready('foo')
+
+    @mock.patch('subprocess.check_output')
+    @mock.patch.object(hookenv, 'hook_name')
+    @mock.patch.object(unitdata, 'kv')
+    def test_incremental_reconfigure(self, kv, hook_name, check_output):
+        kv.return_value = unitdata.Storage(':memory:')
+        hook_name.return_value = 'config-changed'
+        settings = {'port': 80}
+        check_output.side_effect = lambda cmd: json.dumps(
+            settings.get(cmd[1])).encode('UTF-8')
+        fired = []
+        required = {'db': 'a'}
+        missing = {}
+        manager = services.ServiceManager([
+            {'service': 'web',
+             'required_data': [required],
+             'data_ready': lambda s: fired.append(
+                 (s, hookenv.config('port'))),
+             'start': []},
+            {'service': 'worker',
+             'required_data': [missing],
+             'start': lambda s: fired.append((s, 'start')),
+             'stop': lambda s: fired.append((s, 'stop'))},
+        ], incremental=True)
+
+        def hook(name='config-changed'):
+            hookenv.cache.clear()
+            hook_name.return_value = name
+            del fired[:]
+            manager._ready = None
+            manager.reconfigure_services()
+            return list(fired)
+
+        self.assertEqual(hook(), [('web', 80), ('worker', 'stop')])
+        self.assertEqual(hook(), [])
+        settings['port'] = 81
+        self.assertEqual(hook(), [('web', 81)])
+        required['db'] = 'b'
+        self.assertEqual(hook(), [('web', 81)])
+        missing['x'] = 1
+        self.assertEqual(hook(), [('worker', 'start')])
+        self.assertEqual(hook('upgrade-charm'),
+                         [('web', 81), ('worker', 'start')])
+        self.assertEqual(hook(), [])
+
+    @mock.patch('subprocess.check_output')
+    @mock.patch.object(hookenv, 'hook_name')
+    @mock.patch.object(unitdata, 'kv')
+    def test_incremental_uncached_reads(self, kv, hook_name, check_output):
+        kv.return_value = unitdata.Storage(':memory:')
+        hook_name.return_value = 'leader-settings-changed'
+        settings = {'password': 'a'}
+        check_output.side_effect = lambda cmd: json.dumps(
+            settings.get(cmd[-1])).encode('UTF-8')
+        fired = []
+        manager = services.ServiceManager([
+            {'service': 'web',
+             'data_ready': lambda s: fired.append(
+                 hookenv.leader_get('password')),
+             'start': []},
+            {'service': 'worker',
+             'data_ready': lambda s: fired.append(
+                 hookenv._check_output(['storage-get', 'location'])),
+             'start': []},
+        ], incremental=True)
+
+        def hook():
+            hookenv.cache.clear()
+            del fired[:]
+            manager._ready = None
+            manager.reconfigure_services()
+            return list(fired)
+
+        self.assertEqual(len(hook()), 2)
+        # The worker's read can't be replayed, so it is always reconfigured.
+        self.assertEqual(len(hook()), 1)
+        settings['password'] = 'b'
+        self.assertEqual(len(hook()), 2)
+
+    @mock.patch('subprocess.check_output')
+    @mock.patch.object(hookenv, 'hook_name')
+    @mock.patch.object(unitdata, 'kv')
+    def test_incremental_relation_removed(self, kv, hook_name, check_output):
+        kv.return_value = unitdata.Storage(':memory:')
+        hook_name.return_value = 'db-relation-departed'
+        units = {'db:1': ['mysql/0']}
+
+        def hook_tool(cmd):
+            if cmd[0] == 'relation-list':
+                if cmd[-1] not in units:
+                    raise CalledProcessError(1, cmd)
+                return json.dumps(units[cmd[-1]]).encode('UTF-8')
+            return json.dumps('db').encode('UTF-8')
+        check_output.side_effect = hook_tool
+        fired = []
+
+        def data_ready(service_name):
+            try:
+                fired.append([hookenv.relation_get('host', unit, 'db:1')
+                              for unit in hookenv.related_units('db:1')])
+            except CalledProcessError:
+                fired.append([])
+        manager = services.ServiceManager([
+            {'service': 'web', 'data_ready': data_ready, 'start': []},
+        ], incremental=True)
+
+        def hook():
+            hookenv.cache.clear()
+            del fired[:]
+            manager._ready = None
+            manager.reconfigure_services()
+            return list(fired)
+
+        self.assertEqual(hook(), [['db']])
+        self.assertEqual(hook(), [])
+        del units['db:1']
+        self.assertEqual(hook(), [[]])
+
+    @mock.patch('subprocess.check_output')
+    @mock.patch.object(hookenv, 'hook_name')
+    @mock.patch.object(unitdata, 'kv')
+    def test_incremental_relation_restored(self, kv, hook_name, check_output):
+        kv.return_value = unitdata.Storage(':memory:')
+        hook_name.return_value = 'db-relation-joined'
+        units = {}
+
+        def hook_tool(cmd):
+            if cmd[0] == 'relation-list':
+                if cmd[-1] not in units:
+                    raise CalledProcessError(1, cmd)
+                return json.dumps(units[cmd[-1]]).encode('UTF-8')
+            return json.dumps('db').encode('UTF-8')
+        check_output.side_effect = hook_tool
+        fired = []
+
+        def data_ready(service_name):
+            try:
+                fired.append([hookenv.relation_get('host', unit, 'db:1')
+                              for unit in hookenv.related_units('db:1')])
+            except CalledProcessError:
+                fired.append([])
+        manager = services.ServiceManager([
+            {'service': 'web', 'data_ready': data_ready, 'start': []},
+        ], incremental=True)
+
+        def hook():
+            hookenv.cache.clear()
+            del fired[:]
+            manager._ready = None
+            manager.reconfigure_services()
+            return list(fired)
+
+        # The failed read is not recorded, so it is retried by every hook.
+        self.assertEqual(hook(), [[]])
+        self.assertEqual(hook(), [[]])
+        units['db:1'] = ['mysql/1']
+        self.assertEqual(hook(), [['db']])
+        self.assertEqual(hook(), [])
+
+    @mock.patch.object(hookenv, 'log')
+    @mock.patch.object(services.ServiceManager, 'was_ready')
+    @mock.patch.object(services.ServiceManager, 'save_ready')
+    def test_reconfigure_concurrently(self, save_ready, was_ready, log):
+        c_started = threading.Event()
+        order = []
+
+        def callback(service_name):
+            if service_name == 'a':
+                # Only returns in time if 'c' runs meanwhile.
+                self.assertTrue(c_started.wait(5))
+            elif service_name == 'c':
+                c_started.set()
+            order.append(service_name)
+
+        manager = services.ServiceManager([
+            {'service': 'a', 'data_ready': callback, 'start': []},
+            {'service': 'b', 'data_ready': callback, 'start': [],
+             'after': ['a']},
+            {'service': 'c', 'data_ready': callback, 'start': []},
+        ], max_workers=3)
+        manager.reconfigure_services()
+        self.assertEqual(order, ['c', 'a', 'b'])
+        self.assertEqual(sorted(c[0][0] for c in save_ready.call_args_list),
+                         ['a', 'b', 'c'])
+        timings = [c[0][0] for c in log.call_args_list
+                   if c[0][0].startswith('Callback timings')]
+        self.assertEqual(len(timings), 2)
+        self.assertTrue(timings[0].startswith('Callback timings: a '))
+
+    @mock.patch.object(hookenv, 'log')
+    @mock.patch.object(services.ServiceManager, 'was_ready')
+    @mock.patch.object(services.ServiceManager, 'save_ready')
+    def test_reconfigure_concurrently_errors(self, save_ready, was_ready, log):
+        fired = []
+
+        def fail(service_name):
+            raise ValueError(service_name)
+
+        manager = services.ServiceManager([
+            {'service': 'a', 'data_ready': fail},
+            {'service': 'b', 'data_ready': fail},
+            {'service': 'c', 'data_ready': fired.append, 'start': []},
+        ], max_workers=2)
+        try:
+            manager.reconfigure_services()
+        except services.ServiceEventError as e:
+            self.assertEqual(sorted(d for d, _ in e.failures), ['a', 'b'])
+            self.assertTrue(isinstance(e.failures[0][1][1], ValueError))
+        else:
+            self.fail('ServiceEventError not raised')
+        self.assertEqual(fired, ['c'])
+
+    @mock.patch.object(hookenv, 'log')
+    def test_parallel_callback(self, log):
+        fired = []
+        manager = services.ServiceManager([
+            {'service': 'a', 'data_ready': [
+                services.ParallelCallback(fired.append, fired.append),
+                lambda s: fired.append('last')]},
+        ], max_workers=2)
+        manager.fire_event('data_ready', 'a')
+        self.assertEqual(fired, ['a', 'a', 'last'])
+        self.assertTrue(any(
+            c[0][0].startswith('a data_ready callback timings: '
+                               'ParallelCallback ')
+            for c in log.call_args_list))
+
+    @mock.patch.object(hookenv, 'log')
+    @mock.patch('subprocess.check_output')
+    @mock.patch.object(hookenv, 'hook_name')
+    @mock.patch.object(unitdata, 'kv')
+    def test_incremental_parallel_callback(self, kv, hook_name, check_output,
+                                           log):
+        kv.return_value = unitdata.Storage(':memory:')
+        hook_name.return_value = 'config-changed'
+        settings = {'port': 80, 'debug': False}
+        check_output.side_effect = lambda cmd: json.dumps(
+            settings.get(cmd[1])).encode('UTF-8')
+        fired = []
+
+        def read(key):
+            def callback(service_name):
+                fired.append((key, hookenv.config(key)))
+                manager.save_ready('other')
+            return callback
+        manager = services.ServiceManager([
+            {'service': 'web',
+             'data_ready': services.ParallelCallback(read('port'),
+                                                     read('debug')),
+             'start': []},
+        ], incremental=True, max_workers=2)
+
+        def hook():
+            hookenv.cache.clear()
+            del fired[:]
+            manager._ready = None
+            manager.reconfigure_services()
+            return sorted(fired)
+
+        self.assertEqual(hook(), [('debug', False), ('port', 80)])
+        self.assertEqual(kv.return_value.get('services.ready'),
+                         ['other', 'web'])
+        self.assertEqual(hook(), [])
+        settings['debug'] = True
+        self.assertEqual(hook(), [('debug', True), ('port', 80)])
+
     @mock.patch.object(services.base.hookenv, 'relation_set')
     @mock.patch.object(services.base.hookenv, 'related_units')
     @mock.patch.object(services.base.hookenv, 'relation_ids')
@@ -487,6 +803,52 @@ class TestRelationContext(unittest.TestCase):
             mock.call(rid='tomcat', unit='tomcat/0'),
         ])
 
+    def test_serialized(self):
+        self.mhookenv.relation_ids.return_value = ['nginx']
+        self.mhookenv.related_units.return_value = ['nginx/0']
+        self.mhookenv.relation_get.return_value = {'foo': '1', 'bar': '2'}
+        context = services.RelationContext(name='http')
+        self.assertEqual(json.loads(json.dumps(context)),
+                         {'http': [{'foo': '1', 'bar': '2'}]})
+
+    def test_rendered(self):
+        self.mhookenv.relation_ids.return_value = ['nginx']
+        self.mhookenv.related_units.return_value = ['nginx/0']
+        self.mhookenv.relation_get.return_value = {'foo': '1', 'bar': '2'}
+        context = services.RelationContext(name='http')
+        template = jinja2.Template('{{ http[0].foo }}-{{ http[0].bar }}')
+        self.assertEqual(template.render(context), '1-2')
+
+    def test_get_data_again(self):
+        self.mhookenv.relation_ids.return_value = ['nginx']
+        self.mhookenv.related_units.side_effect = lambda i: [i + '/0']
+        self.mhookenv.relation_get.return_value = {'foo': '1', 'bar': '2'}
+        self.context.get_data()
+        self.mhookenv.relation_ids.return_value = ['apache', 'nginx']
+        self.context.get_data()
+        self.assertEqual(len(self.context['http']), 2)
+
+    @mock.patch('subprocess.check_output')
+    def test_shared_relation_data(self, check_output):
+        tools = {
+            'relation-ids': ['nginx:1'],
+            'relation-list': ['nginx/0', 'nginx/1'],
+            'relation-get': {'host': 'nginx', 'port': '80'},
+        }
+        check_output.side_effect = lambda cmd: json.dumps(
+            tools[cmd[0]]).encode('UTF-8')
+        hookenv.cache.clear()
+        self.addCleanup(hookenv.cache.clear)
+        with mock.patch.object(services.helpers, 'hookenv', hookenv):
+            hookenv.prefetch_relations('http')
+            contexts = [services.RelationContext(name='http'),
+                        services.helpers.HttpRelation(name='http')]
+        for context in contexts:
+            self.assertEqual(len(context['http']), 2)
+        self.assertEqual([c[0][0][0] for c in check_output.call_args_list],
+                         ['relation-ids', 'relation-list', 'relation-get',
+                          'relation-get'])
+
     def test_provide(self):
         self.assertEqual(self.context.provide_data(), {})
 
@@ -731,6 +1093,18 @@ class TestTemplateCallback(unittest.TestCase):
             'foo.yml', 'bar.yml', {'foo': 'bar'},
             'root', 'root', 0o444)
 
+    @mock.patch.object(hookenv, 'charm_dir', return_value='charm_dir')
+    @mock.patch.object(services.helpers, 'templating')
+    def test_template_factory(self, mtemplating, charm_dir):
+        factory = mock.Mock(return_value={'foo': 'bar'})
+        manager = services.ServiceManager([
+            {'service': 'test', 'required_data': [factory, {'baz': 1}]}])
+        services.template(source='foo.yml', target='bar.yml')(
+            manager, 'test', 'event')
+        mtemplating.render.assert_called_once_with(
+            'foo.yml', 'bar.yml', {'foo': 'bar', 'baz': 1},
+            'root', 'root', 0o444)
+
     @mock.patch.object(services.helpers, 'templating')
     def test_template_explicit(self, mtemplating):
         manager = mock.Mock(**{'get_service.return_value': {
@@ -21,9 +21,11 @@ class TestTemplating(unittest.TestCase):
                                                   'charm_dir')
         self._charm_dir_mock = self._charm_dir_patch.start()
         self._charm_dir_mock.side_effect = lambda: self.charm_dir
+        templating._environments.clear()
 
     def tearDown(self):
         self._charm_dir_patch.stop()
+        templating._environments.clear()
 
     @mock.patch.object(templating.host.os, 'fchown')
     @mock.patch.object(templating.host, 'mkdir')
@@ -73,6 +75,64 @@ class TestTemplating(unittest.TestCase):
         finally:
             shutil.rmtree(tmpdir, ignore_errors=True)
 
+    @mock.patch.object(templating.host, 'mkdir')
+    @mock.patch.object(templating.host, 'log')
+    def test_render_if_changed(self, log, mkdir):
+        tmpdir = tempfile.mkdtemp()
+        fn1 = os.path.join(tmpdir, 'test.conf')
+        owner = pwd.getpwuid(os.getuid()).pw_name
+        group = grp.getgrgid(os.getgid()).gr_name
+        try:
+            for port, changed in ((80, True), (80, False), (81, True)):
+                self.assertEqual(
+                    templating.render('test.conf', fn1, {'nginx_port': port},
+                                      owner=owner, group=group,
+                                      templates_dir=TEMPLATES_DIR,
+                                      if_changed=True),
+                    changed)
+            with open(fn1) as f:
+                self.assertRegexpMatches(f.read(), 'listen 81')
+            self.assertFalse(mkdir.called)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    @mock.patch.object(templating.host, 'mkdir')
+    @mock.patch.object(templating.host, 'log')
+    def test_render_many(self, log, mkdir):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.charm_dir = tmpdir
+        owner = pwd.getpwuid(os.getuid()).pw_name
+        group = grp.getgrgid(os.getgid()).gr_name
+        targets = [os.path.join(tmpdir, 'port%d.conf' % port)
+                   for port in (80, 81)]
+        renders = [('test.conf', target, {'nginx_port': port})
+                   for target, port in zip(targets, (80, 81))]
+        result = templating.render_many(
+            renders, owner=owner, group=group, templates_dir=TEMPLATES_DIR,
+            if_changed=True, bytecode_cache=True)
+        self.assertEqual(result, {targets[0]: True, targets[1]: True})
+        with open(targets[1]) as f:
+            self.assertRegexpMatches(f.read(), 'listen 81')
+        self.assertEqual(len(templating._environments), 1)
+        self.assertTrue(os.listdir(
+            os.path.join(tmpdir, templating.BYTECODE_CACHE_DIR)))
+
+        result = templating.render_many(
+            renders, owner=owner, group=group, templates_dir=TEMPLATES_DIR,
+            if_changed=True, bytecode_cache=True)
+        self.assertEqual(result, {targets[0]: False, targets[1]: False})
+
+    @mock.patch.object(templating.host, 'write_file')
+    @mock.patch.object(templating.host, 'mkdir')
+    def test_environment_reused(self, mkdir, write_file):
+        with mock.patch('jinja2.Environment') as Env:
+            templating.render('a', '/tmp/a', {}, templates_dir='tmpl')
+            templating.render('b', '/tmp/b', {}, templates_dir='tmpl')
+            templating.render('a', '/tmp/a', {}, templates_dir='other')
+        self.assertEqual(Env.call_count, 2)
+        self.assertEqual(Env().get_template.call_count, 3)
+
     @mock.patch.object(templating, 'hookenv')
     @mock.patch('jinja2.Environment')
     def test_load_error(self, Env, hookenv):
@@ -10,12 +10,19 @@ try:
 except:
     from io import StringIO
 
+import collections
+import datetime
+import json
 import os
 import shutil
+import sqlite3
 import tempfile
+import threading
+import time
 import unittest
 
 from mock import patch
+import nose.plugins.attrib
 
 from charmhelpers.core.unitdata import Storage, HookData, kv
 
@@ -188,6 +195,59 @@ class StorageTest(unittest.TestCase):
         self.assertEqual(delta.c.previous, None)
         self.assertEqual(delta.a.current, False)
 
+    def test_delta_decodes_changed_values_only(self):
+        kv = Storage(':memory:')
+        kv.update(dict(('k%d' % i, {'v': i}) for i in range(50)), 'x.')
+        mapping = dict(('k%d' % i, {'v': i}) for i in range(1, 50))
+        mapping['k7'] = {'v': 'changed'}
+        mapping['new'] = 1
+        with patch('charmhelpers.core.unitdata.json.loads') as loads:
+            loads.side_effect = json.JSONDecoder().decode
+            delta = kv.delta(mapping, 'x.')
+        self.assertEqual(delta, {'k0': ({'v': 0}, None),
+                                 'k7': ({'v': 7}, {'v': 'changed'}),
+                                 'new': (None, 1)})
+        self.assertEqual(loads.call_count, 2)
+
+    def test_delta_ignores_key_order(self):
+        kv = Storage(':memory:')
+        kv.set('x.a', collections.OrderedDict([('p', 1), ('q', 2)]))
+        value = collections.OrderedDict([('q', 2), ('p', 1)])
+        self.assertEqual(kv.delta({'a': value}, 'x.'), {})
+
+    def test_delta_and_update(self):
+        kv = Storage(':memory:')
+        with kv.hook_scope('install'):
+            kv.update({'a': 1, 'b': 2, 'c': 3}, 'x.')
+        with kv.hook_scope('config-changed'):
+            delta = kv.delta_and_update({'a': 1, 'b': 5, 'd': 4}, 'x.')
+        self.assertEqual(delta, {'b': (2, 5), 'c': (3, None),
+                                 'd': (None, 4)})
+        self.assertEqual(kv.getrange('x.', True),
+                         {'a': 1, 'b': 5, 'd': 4})
+        self.assertEqual([h[0] for h in kv.gethistory('x.a')], [1])
+        self.assertEqual([h[:-1] for h in kv.gethistory('x.c')],
+                         [(1, 'x.c', '3', 'install'),
+                          (2, 'x.c', '"DELETED"', 'config-changed')])
+        self.assertEqual(kv.delta({'a': 1, 'b': 5, 'd': 4}, 'x.'), {})
+
+    def test_digest_added_to_existing_database(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'state.db')
+        conn = sqlite3.connect(path)
+        conn.execute('create table kv (key text, data text,'
+                     ' primary key (key))')
+        conn.execute('insert into kv values (?, ?)', ['x.a', '[1]'])
+        conn.commit()
+        conn.close()
+        kv = Storage(path)
+        self.addCleanup(kv.close)
+        kv.cursor.execute('select digest from kv')
+        self.assertNotEqual(kv.cursor.fetchone()[0], None)
+        self.assertEqual(kv.delta({'a': [1]}, 'x.'), {})
+        self.assertEqual(kv.delta({'a': [2]}, 'x.'), {'a': ([1], [2])})
+
     def test_update(self):
         kv = Storage(':memory:')
         kv.update({'v_a': 1, 'v_b': 2.2})
@@ -210,6 +270,54 @@ class StorageTest(unittest.TestCase):
             kv.getrange('docker.', True),
             {'net_mtu': 1, 'net_type': 'vxlan', 'net_nack': True})
 
+    def test_keyrange_literal_wildcards(self):
+        kv = Storage(':memory:')
+        kv.set('a%b.x', 1)
+        kv.set('a_b.y', 2)
+        kv.set('aXb.z', 3)
+        kv.set('a%', 4)
+        self.assertEqual(kv.getrange('a%b'), {'a%b.x': 1})
+        self.assertEqual(kv.getrange('a_b', True), {'.y': 2})
+        self.assertEqual(kv.getrange("a'"), None)
+
+    def test_keyrange_upper_bound(self):
+        kv = Storage(':memory:')
+        kv.set('ab', 1)
+        kv.set('abc', 2)
+        kv.set('ac', 3)
+        kv.set(u'ab\u00ff', 4)
+        self.assertEqual(kv.getrange('ab'),
+                         {'ab': 1, 'abc': 2, u'ab\u00ff': 4})
+        self.assertEqual(len(kv.getrange('')), 4)
+
+    def test_keyrange_uses_index(self):
+        kv = Storage(':memory:')
+        kv.cursor.execute(
+            'explain query plan select key, data from kv '
+            'where key >= ? and key < ? order by key', ['a', 'b'])
+        plan = ' '.join(str(row) for row in kv.cursor.fetchall())
+        self.assertIn('SEARCH', plan)
+
+    def test_iterrange(self):
+        kv = Storage(':memory:')
+        kv.update(dict(('item.%d' % i, {'n': i}) for i in range(5)))
+        kv.set('other', 1)
+        items = kv.iterrange('item.', strip=True)
+        self.assertEqual(next(items), ('0', {'n': 0}))
+        self.assertEqual(list(items),
+                         [(str(i), {'n': i}) for i in range(1, 5)])
+
+    def test_keyrange_paging(self):
+        kv = Storage(':memory:')
+        kv.update(dict(('item.%d' % i, i) for i in range(5)))
+        self.assertEqual(kv.getrange('item.', limit=2),
+                         {'item.0': 0, 'item.1': 1})
+        self.assertEqual(kv.getrange('item.', True, limit=2, offset=2),
+                         {'2': 2, '3': 3})
+        self.assertEqual(list(kv.iterrange('item.', offset=4)),
+                         [('item.4', 4)])
+        self.assertEqual(kv.getrange('item.', offset=5), None)
+
     def test_get_set_unset(self):
         kv = Storage(':memory:')
         kv.hook_scope('test')
@@ -222,5 +330,302 @@ class StorageTest(unittest.TestCase):
         kv.flush(False)
         self.assertEqual(kv.get('hello'), 'world')
 
+    def test_set_many(self):
+        kv = Storage(':memory:')
+        kv.set('a', 1)
+        with kv.hook_scope('install'):
+            kv.set_many({'a': 1, 'b': [1, 2], 'c': {'x': None}})
+        self.assertEqual(kv.getrange(''),
+                         {'a': 1, 'b': [1, 2], 'c': {'x': None}})
+        # Unchanged keys do not gain a revision
+        self.assertEqual(kv.gethistory('a'), [])
+        self.assertEqual([h[:-1] for h in kv.gethistory('b')],
+                         [(1, 'b', '[1, 2]', 'install')])
+
+        with kv.hook_scope('config-changed'):
+            kv.set_many({'b': [1, 2, 3]})
+            kv.set_many({'b': [1, 2, 4]})
+        self.assertEqual([h[:-1] for h in kv.gethistory('b')],
+                         [(1, 'b', '[1, 2]', 'install'),
+                          (2, 'b', '[1, 2, 4]', 'config-changed')])
+
+    def test_set_many_large(self):
+        kv = Storage(':memory:')
+        data = dict(('k%05d' % i, i) for i in range(2500))
+        kv.set_many(data)
+        data['k00001'] = 'changed'
+        kv.set_many(data)
+        self.assertEqual(kv.getrange('k'), data)
+
+    def test_journal_mode(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        kv = Storage(os.path.join(tmpdir, 'state.db'),
+                     journal_mode='wal', synchronous='normal')
+        kv.cursor.execute('pragma journal_mode')
+        self.assertEqual(kv.cursor.fetchone()[0], 'wal')
+        kv.cursor.execute('pragma synchronous')
+        self.assertEqual(kv.cursor.fetchone()[0], 1)
+        kv.set('a', 1)
+        kv.flush()
+        kv.close()
+        self.assertEqual(Storage(os.path.join(tmpdir, 'state.db')).get('a'),
+                         1)
+
+    def test_shared_between_threads(self):
+        kv = Storage(':memory:')
+        errors = []
+
+        def worker(n):
+            try:
+                for i in range(50):
+                    kv.set('t%d.%d' % (n, i), i)
+                    kv.get('t%d.%d' % (n, i))
+                self.assertEqual(len(list(kv.iterrange('t%d.' % n))), 50)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=worker, args=(n,))
+                   for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(kv.getrange('t')), 200)
+
+
+class CachedStorageTest(unittest.TestCase):
+
+    def stored(self, kv, key):
+        kv.cursor.execute('select data from kv where key=?', [key])
+        row = kv.cursor.fetchone()
+        return row and row[0]
+
+    def test_reads_are_cached(self):
+        kv = Storage(':memory:', cache=True)
+        kv.set('a', {'x': 1})
+        kv.flush()
+        kv._cache.clear()
+        kv.cache_hits = kv.cache_misses = 0
+        self.assertEqual(kv.get('a'), {'x': 1})
+        self.assertEqual(kv.get('a'), {'x': 1})
+        self.assertEqual(kv.get('a', record=True).x, 1)
+        self.assertEqual(kv.get('missing', 'default'), 'default')
+        self.assertEqual(kv.get('missing', 'default'), 'default')
+        stats = kv.cache_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (3, 2))
+        self.assertEqual(stats['hit_rate'], 0.6)
+
+    def test_writes_deferred_until_flush(self):
+        kv = Storage(':memory:', cache=True)
+        kv.set('a', 1)
+        kv.set('b', 2)
+        kv.set('a', 3)
+        self.assertEqual(kv.get('a'), 3)
+        self.assertEqual(self.stored(kv, 'a'), None)
+        self.assertEqual(kv.cache_stats()['dirty'], 2)
+        kv.flush()
+        self.assertEqual(self.stored(kv, 'a'), '3')
+        self.assertEqual(self.stored(kv, 'b'), '2')
+        self.assertEqual(kv.cache_stats()['dirty'], 0)
+
+    def test_unchanged_value_not_dirty(self):
+        kv = Storage(':memory:', cache=True)
+        kv.set('a', [1])
+        kv.flush()
+        kv.set('a', [1])
+        kv.set_many({'a': [1]})
+        self.assertEqual(kv.cache_stats()['dirty'], 0)
+
+    def test_revisions_preserved(self):
+        kv = Storage(':memory:', cache=True)
+        with kv.hook_scope('install'):
+            kv.set('a', 1)
+            kv.set_many({'b': 1})
+        with kv.hook_scope('config-changed'):
+            kv.set('a', 2)
+            kv.unset('b')
+        self.assertEqual([h[:-1] for h in kv.gethistory('a')],
+                         [(1, 'a', '1', 'install'),
+                          (2, 'a', '2', 'config-changed')])
+        self.assertEqual([h[:-1] for h in kv.gethistory('b')],
+                         [(1, 'b', '1', 'install'),
+                          (2, 'b', '"DELETED"', 'config-changed')])
+        self.assertEqual(self.stored(kv, 'b'), None)
+
+    def test_rollback_discards_changes(self):
+        kv = Storage(':memory:', cache=True)
+        kv.set('a', 1)
+        kv.flush()
+        try:
+            with kv.hook_scope('install'):
+                kv.set('a', 2)
+                kv.getrange('a')
+                kv.set('b', 1)
+                raise RuntimeError('x')
+        except RuntimeError:
+            pass
+        self.assertEqual(kv.get('a'), 1)
+        self.assertEqual(kv.get('b'), None)
+
+    def test_ranges_see_pending_changes(self):
+        kv = Storage(':memory:', cache=True)
+        kv.update({'a': 1, 'b': 2}, prefix='x.')
+        kv.unset('x.b')
+        self.assertEqual(kv.getrange('x.', True), {'a': 1})
+        self.assertEqual(kv.delta({'a': 2}, 'x.'), {'a': (1, 2)})
+
+    def test_delta_and_update(self):
+        kv = Storage(':memory:', cache=True)
+        kv.update({'a': 1, 'b': 2}, prefix='x.')
+        kv.flush()
+        self.assertEqual(kv.delta_and_update({'a': 3}, 'x.'),
+                         {'a': (1, 3), 'b': (2, None)})
+        self.assertEqual(kv.get('x.a'), 3)
+        self.assertEqual(kv.cache_stats()['dirty'], 2)
+        kv.flush()
+        self.assertEqual(self.stored(kv, 'x.a'), '3')
+        self.assertEqual(self.stored(kv, 'x.b'), None)
+
+
+class RetentionTest(unittest.TestCase):
+
+    def populate(self, kv, hooks=5):
+        for i in range(hooks):
+            with kv.hook_scope('update-status'):
+                kv.set('a', i)
+                kv.set('b', i)
+
+    def revisions(self, kv, key):
+        return [h[0] for h in kv.gethistory(key)]
+
+    def age_hooks(self, kv, days, upto):
+        date = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+        kv.cursor.execute('update hooks set date=? where version <= ?',
+                          [date.isoformat(), upto])
+
+    def test_keep_revisions(self):
+        kv = Storage(':memory:')
+        self.populate(kv)
+        self.assertEqual(kv.compact(keep_revisions=2), 6)
+        self.assertEqual(self.revisions(kv, 'a'), [4, 5])
+        self.assertEqual(self.revisions(kv, 'b'), [4, 5])
+        self.assertEqual(kv.get('a'), 4)
+        self.assertEqual(kv.compact(keep_revisions=2), 0)
+        self.assertRaises(ValueError, kv.compact, keep_revisions=0)
+
+    def test_keep_days(self):
+        kv = Storage(':memory:')
+        self.populate(kv)
+        self.age_hooks(kv, 10, 3)
+        self.assertEqual(kv.compact(keep_days=7), 9)
+        self.assertEqual(self.revisions(kv, 'a'), [4, 5])
+        kv.cursor.execute('select version from hooks')
+        self.assertEqual(kv.cursor.fetchall(), [(4,), (5,)])
+
+    def test_compact_limit(self):
+        kv = Storage(':memory:')
+        self.populate(kv)
+        self.age_hooks(kv, 10, 2)
+        removed = []
+        while True:
+            count = kv.compact(keep_revisions=2, keep_days=7, limit=2)
+            if not count:
+                break
+            self.assertTrue(count <= 2)
+            removed.append(count)
+        self.assertEqual(sum(removed), 8)
+        self.assertEqual(self.revisions(kv, 'a'), [4, 5])
+
+    def test_hook_scope_compacts(self):
+        kv = Storage(':memory:', keep_revisions=1, compact_limit=1)
+        self.populate(kv, 3)
+        self.assertEqual(len(kv.gethistory('a') + kv.gethistory('b')), 4)
+        self.assertEqual(self.revisions(kv, 'b'), [1, 2, 3])
+        with kv.hook_scope('update-status'):
+            pass
+        self.assertEqual(self.revisions(kv, 'b'), [1, 2, 3])
+        # Only the keys written in the hook are trimmed.
+        with kv.hook_scope('update-status'):
+            kv.set('b', 9)
+        self.assertEqual(self.revisions(kv, 'a'), [3])
+        self.assertEqual(self.revisions(kv, 'b'), [2, 3, 5])
+
+    def test_keep_revisions_uses_primary_key(self):
+        kv = Storage(':memory:')
+        kv.cursor.execute(
+            'explain query plan select rowid from kv_revisions'
+            ' where key = ? and revision < ('
+            ' select revision from kv_revisions where key = ?'
+            ' order by revision desc limit 1 offset ?)', ['a', 'a', 1])
+        plan = ' '.join(str(r) for r in kv.cursor.fetchall())
+        self.assertFalse('SCAN' in plan, plan)
+        self.assertTrue('sqlite_autoindex_kv_revisions_1' in plan, plan)
+
+    def test_history_ordered(self):
+        kv = Storage(':memory:')
+        self.populate(kv, 3)
+        kv.cursor.execute(
+            'explain query plan select rowid from kv_revisions'
+            ' where revision < 2')
+        plan = ' '.join(str(r) for r in kv.cursor.fetchall())
+        self.assertTrue('kv_revisions_revision' in plan, plan)
+        self.assertEqual(self.revisions(kv, 'a'), [1, 2, 3])
+
+    def test_vacuum(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        kv = Storage(os.path.join(tmpdir, 'state.db'))
+        self.addCleanup(kv.close)
+        kv.set_many(dict(('k%d' % i, 'x' * 100) for i in range(2000)))
+        kv.flush()
+        self.assertFalse(kv.vacuum())
+        kv.cursor.execute('delete from kv')
+        self.assertTrue(kv.vacuum())
+        kv.cursor.execute('pragma freelist_count')
+        self.assertEqual(kv.cursor.fetchone()[0], 0)
+        self.assertFalse(kv.vacuum())
+
+
+class StorageBenchmark(unittest.TestCase):
+    """Print keys/sec for bulk and per-key operations.
+
+    Run with ``nosetests -s -a slow tests/core/test_unitdata.py``.
+    """
+
+    sizes = (1000, 10000, 100000)
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def report(self, operation, count, started):
+        elapsed = time.time() - started
+        print('%-10s %7d keys %10.0f keys/sec' % (
+            operation, count, count / max(elapsed, 1e-9)))
+
+    @nose.plugins.attrib.attr('slow')
+    def test_benchmark(self):
+        for count in self.sizes:
+            kv = Storage(os.path.join(self.tmpdir, '%d.db' % count),
+                         journal_mode='wal', synchronous='normal')
+            data = dict(('bench.%08d' % i, {'value': i}) for i in range(count))
+            with kv.hook_scope('set'):
+                started = time.time()
+                for key, value in data.items():
+                    kv.set(key, value)
+                self.report('set', count, started)
+            with kv.hook_scope('update'):
+                data = dict((k, {'value': -v['value']})
+                            for k, v in data.items())
+                started = time.time()
+                kv.update(data)
+                self.report('update', count, started)
+            started = time.time()
+            self.assertEqual(len(kv.getrange('bench.')), count)
+            self.report('getrange', count, started)
+            kv.close()
+
+
 if __name__ == '__main__':
     unittest.main()
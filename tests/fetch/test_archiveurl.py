@@ -1,4 +1,7 @@
+import hashlib
 import os
+import shutil
+import tempfile
 
 from unittest import TestCase
 from mock import (
@@ -7,6 +10,7 @@ from mock import (
     mock_open,
     Mock,
 )
+from charmhelpers.core.host import ChecksumError
 from charmhelpers.fetch import (
     archiveurl,
     UnhandledSource,
@@ -15,12 +19,39 @@ from charmhelpers.fetch import (
 import six
 if six.PY3:
     from urllib.parse import urlparse
-    from urllib.error import URLError
+    from urllib.error import HTTPError, URLError
 else:
-    from urllib2 import URLError
+    from urllib2 import HTTPError, URLError
     from urlparse import urlparse
 
 
+class LocalArchive(object):
+    """An archive in a temporary directory, served from a file:// URL"""
+
+    def __init__(self, content, name='archive.tar.gz'):
+        self.content = content
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, name)
+        with open(self.path, 'wb') as f:
+            f.write(content)
+        self.url = 'file://' + self.path
+
+    def digest(self, hash_type):
+        return hashlib.new(hash_type, self.content).hexdigest()
+
+    def cleanup(self):
+        shutil.rmtree(self.dir)
+
+
+def fake_response(content, code=200, headers=None):
+    response = MagicMock()
+    chunks = [content[i:i + 4] for i in range(0, len(content), 4)]
+    response.read.side_effect = chunks + [b'']
+    response.getcode.return_value = code
+    response.info.return_value = headers or {}
+    return response
+
+
 class ArchiveUrlFetchHandlerTest(TestCase):
 
     def setUp(self):
@@ -57,26 +88,170 @@ class ArchiveUrlFetchHandlerTest(TestCase):
             result = self.fh.can_handle(url)
             self.assertNotEqual(result, True, url)
 
+    def local_archive(self, content):
+        archive = LocalArchive(content)
+        self.addCleanup(archive.cleanup)
+        return archive
+
     @patch('charmhelpers.fetch.archiveurl.urlopen')
     def test_downloads(self, _urlopen):
         for url in self.valid_urls:
-            response = MagicMock()
-            response.read.return_value = "bar"
+            response = fake_response(b"bar")
             _urlopen.return_value = response
 
             _open = mock_open()
-            with patch('charmhelpers.fetch.archiveurl.open', _open, create=True):
+            with patch('charmhelpers.fetch.archiveurl.open', _open,
+                       create=True), patch('os.rename') as _rename:
                 self.fh.download(url, "foo")
 
-            response.read.assert_called_with()
-            _open.assert_called_once_with("foo", 'w')
-            _open().write.assert_called_with("bar")
+            self.assertEqual(_urlopen.call_args[0][0].get_full_url(), url)
+            response.read.assert_called_with(self.fh.buffer_size)
+            _open.assert_called_once_with("foo.partial", 'wb')
+            _open().write.assert_called_with(b"bar")
+            _rename.assert_called_once_with("foo.partial", "foo")
+
+    @patch.object(archiveurl, 'log')
+    def test_streams_local_archive(self, _log):
+        content = os.urandom(100000)
+        archive = self.local_archive(content)
+        dest = os.path.join(archive.dir, 'fetched.tar.gz')
+        progress = MagicMock()
+
+        digests = self.fh.download(archive.url, dest,
+                                   hash_types=['sha1', 'md5'],
+                                   buffer_size=4096, progress=progress)
+
+        with open(dest, 'rb') as f:
+            self.assertEqual(f.read(), content)
+        self.assertFalse(os.path.exists(dest + '.partial'))
+        self.assertEqual(digests, {'sha1': archive.digest('sha1'),
+                                   'md5': archive.digest('md5')})
+        self.assertEqual(progress.call_count, 25)
+        received, size, elapsed = progress.call_args[0]
+        self.assertEqual((received, size), (100000, 100000))
+
+    @patch('charmhelpers.fetch.archiveurl.urlopen')
+    def test_incomplete_download(self, _urlopen):
+        archive = self.local_archive(b'')
+        dest = os.path.join(archive.dir, 'fetched.tar.gz')
+        _urlopen.return_value = fake_response(
+            b'12345678', headers={'Content-Length': '10'})
+        self.assertRaises(URLError, self.fh.download, archive.url, dest)
+        self.assertFalse(os.path.exists(dest))
+        self.assertFalse(os.path.exists(dest + '.partial'))
+
+        _urlopen.return_value = fake_response(
+            b'12345678', headers={'Content-Length': '10'})
+        self.assertRaises(URLError, self.fh.download, archive.url, dest,
+                          resume=True)
+        with open(dest + '.partial', 'rb') as f:
+            self.assertEqual(f.read(), b'12345678')
+
+    def write_partial(self, dest, content, validator='"v1"'):
+        with open(dest + '.partial', 'wb') as f:
+            f.write(content)
+        if validator is not None:
+            with open(dest + '.partial.validator', 'w') as f:
+                f.write(validator)
+
+    @patch('charmhelpers.fetch.archiveurl.urlopen')
+    def test_keeps_validator(self, _urlopen):
+        archive = self.local_archive(b'')
+        dest = os.path.join(archive.dir, 'fetched.tar.gz')
+        for headers, validator in [
+                ({'ETag': '"v1"', 'Last-Modified': 'Mon'}, '"v1"'),
+                ({'ETag': 'W/"v1"', 'Last-Modified': 'Mon'}, 'Mon'),
+                ({}, None)]:
+            headers['Content-Length'] = '10'
+            _urlopen.return_value = fake_response(b'12345678',
+                                                  headers=headers)
+            self.assertRaises(URLError, self.fh.download,
+                              'http://example.com/foo.tgz', dest,
+                              resume=True)
+            self.assertEqual(
+                archiveurl._read_validator(dest + '.partial.validator'),
+                validator)
+
+    @patch.object(archiveurl, 'log')
+    @patch('charmhelpers.fetch.archiveurl.urlopen')
+    def test_resumes_download(self, _urlopen, _log):
+        archive = self.local_archive(b'0123456789')
+        dest = os.path.join(archive.dir, 'fetched.tar.gz')
+        self.write_partial(dest, b'012345')
+        _urlopen.return_value = fake_response(b'6789', code=206, headers={
+            'Content-Length': '4',
+            'Content-Range': 'bytes 6-9/10',
+        })
+
+        digests = self.fh.download('http://example.com/foo.tgz', dest,
+                                   hash_types=['sha1'], resume=True)
+
+        request = _urlopen.call_args[0][0]
+        self.assertEqual(request.get_header('Range'), 'bytes=6-')
+        self.assertEqual(request.get_header('If-range'), '"v1"')
+        with open(dest, 'rb') as f:
+            self.assertEqual(f.read(), b'0123456789')
+        self.assertEqual(digests, {'sha1': archive.digest('sha1')})
+        self.assertFalse(os.path.exists(dest + '.partial.validator'))
+
+    @patch.object(archiveurl, 'log')
+    @patch('charmhelpers.fetch.archiveurl.urlopen')
+    def test_resume_without_validator(self, _urlopen, _log):
+        archive = self.local_archive(b'0123456789')
+        dest = os.path.join(archive.dir, 'fetched.tar.gz')
+        self.write_partial(dest, b'abcdef', validator=None)
+        _urlopen.return_value = fake_response(b'0123456789', headers={
+            'Content-Length': '10',
+        })
+
+        self.fh.download('http://example.com/foo.tgz', dest, resume=True)
+
+        self.assertIsNone(_urlopen.call_args[0][0].get_header('Range'))
+        with open(dest, 'rb') as f:
+            self.assertEqual(f.read(), b'0123456789')
+
+    @patch.object(archiveurl, 'log')
+    @patch('charmhelpers.fetch.archiveurl.urlopen')
+    def test_resume_not_supported(self, _urlopen, _log):
+        archive = self.local_archive(b'0123456789')
+        dest = os.path.join(archive.dir, 'fetched.tar.gz')
+        self.write_partial(dest, b'abcdef')
+        _urlopen.return_value = fake_response(b'0123456789', headers={
+            'Content-Length': '10',
+            'ETag': '"v2"',
+        })
+
+        digests = self.fh.download('http://example.com/foo.tgz', dest,
+                                   hash_types=['sha1'], resume=True)
+
+        with open(dest, 'rb') as f:
+            self.assertEqual(f.read(), b'0123456789')
+        self.assertEqual(digests, {'sha1': archive.digest('sha1')})
+
+    @patch.object(archiveurl, 'log')
+    @patch('charmhelpers.fetch.archiveurl.urlopen')
+    def test_resume_of_complete_partial(self, _urlopen, _log):
+        archive = self.local_archive(b'0123456789')
+        dest = os.path.join(archive.dir, 'fetched.tar.gz')
+        self.write_partial(dest, b'0123456789')
+        _urlopen.side_effect = [
+            HTTPError('http://example.com/foo.tgz', 416,
+                      'Range Not Satisfiable', {}, None),
+            fake_response(b'0123456789'),
+        ]
+
+        self.fh.download('http://example.com/foo.tgz', dest, resume=True)
+
+        self.assertIsNone(_urlopen.call_args[0][0].get_header('Range'))
+        with open(dest, 'rb') as f:
+            self.assertEqual(f.read(), b'0123456789')
 
-    @patch('charmhelpers.fetch.archiveurl.check_hash')
     @patch('charmhelpers.fetch.archiveurl.mkdir')
     @patch('charmhelpers.fetch.archiveurl.extract')
-    def test_installs(self, _extract, _mkdir, _check_hash):
+    def test_installs(self, _extract, _mkdir):
         self.fh.download = MagicMock()
+        self.fh.download.return_value = {'sha1': 'deadbeef',
+                                         'sha512': 'beefdead'}
 
         for url in self.valid_urls:
             filename = urlparse(url).path
@@ -84,16 +259,20 @@ class ArchiveUrlFetchHandlerTest(TestCase):
             _extract.return_value = dest
             with patch.dict('os.environ', {'CHARM_DIR': 'foo'}):
                 where = self.fh.install(url, checksum='deadbeef')
-            self.fh.download.assert_called_with(url, dest)
-            _extract.assert_called_with(dest, None)
-            _check_hash.assert_called_with(dest, 'deadbeef', 'sha1')
+            hash_types = set(['sha1'])
             if 'sha512' in url:
-                _check_hash.assert_has_call(dest, 'beefdead', 'sha512')
+                hash_types.add('sha512')
+            self.fh.download.assert_called_with(
+                url, dest, resume=False, hash_types=hash_types)
+            _extract.assert_called_with(dest, None)
             self.assertEqual(where, dest)
-            _check_hash.reset_mock()
 
         url = "http://www.example.com/archive.tar.gz"
 
+        with patch.dict('os.environ', {'CHARM_DIR': 'foo'}):
+            self.assertRaises(ChecksumError, self.fh.install, url,
+                              checksum='cafebabe')
+
         self.fh.download.side_effect = URLError('fail')
         with patch.dict('os.environ', {'CHARM_DIR': 'foo'}):
             self.assertRaises(UnhandledSource, self.fh.install, url)
@@ -102,6 +281,19 @@ class ArchiveUrlFetchHandlerTest(TestCase):
         with patch.dict('os.environ', {'CHARM_DIR': 'foo'}):
             self.assertRaises(UnhandledSource, self.fh.install, url)
 
+    @patch.object(archiveurl, 'log')
+    @patch('charmhelpers.fetch.archiveurl.extract')
+    def test_installs_local_archive(self, _extract, _log):
+        archive = self.local_archive(b'archive')
+        url = '{}#sha256={}'.format(archive.url, archive.digest('sha256'))
+        with patch.dict('os.environ', {'CHARM_DIR': archive.dir}):
+            self.fh.install(url, checksum=archive.digest('md5'),
+                            hash_type='md5')
+        dest = os.path.join(archive.dir, 'fetched', 'archive.tar.gz')
+        _extract.assert_called_with(dest, None)
+        with open(dest, 'rb') as f:
+            self.assertEqual(f.read(), b'archive')
+
     @patch('charmhelpers.fetch.archiveurl.urlretrieve')
     @patch('charmhelpers.fetch.archiveurl.check_hash')
     def test_download_and_validate(self, vfmock, urlmock):
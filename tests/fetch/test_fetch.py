@@ -8,7 +8,12 @@ from mock import (
     call,
 )
 from charmhelpers import fetch
+from charmhelpers.core import unitdata
+import json
 import os
+import shutil
+import tempfile
+import threading
 import yaml
 
 import six
@@ -19,6 +24,32 @@ else:
     from urlparse import urlparse
 
 
+DPKG_STATUS = """\
+Package: vim
+Status: install ok installed
+Priority: optional
+Architecture: amd64
+Version: 2:7.3.547-6ubuntu5
+Description: Vi IMproved - enhanced vi editor
+ Vim is an almost compatible version of the UNIX editor Vi.
+
+Package: emacs
+Status: deinstall ok config-files
+Architecture: all
+Version: 45.0
+
+Package: libc6
+Status: install ok installed
+Architecture: amd64
+Version: 2.19-0ubuntu6
+
+Package: libc6
+Status: install ok unpacked
+Architecture: i386
+Version: 2.19-0ubuntu5
+"""
+
+
 FAKE_APT_CACHE = {
     # an installed package
     'vim': {
@@ -57,12 +88,66 @@ def getenv(update=None):
 
 class FetchTest(TestCase):
 
+    def setUp(self):
+        super(FetchTest, self).setUp()
+        fetch.invalidate_apt_cache()
+        self.addCleanup(fetch.invalidate_apt_cache)
+        patcher = patch.object(fetch, 'DPKG_STATUS', '/nonexistent')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
     @patch('apt_pkg.Cache')
     def test_filter_packages_missing(self, cache):
         cache.side_effect = fake_apt_cache
         result = fetch.filter_installed_packages(['vim', 'emacs'])
         self.assertEquals(result, ['emacs'])
 
+    @patch('apt_pkg.Cache')
+    def test_filter_packages_shares_cache(self, cache):
+        cache.side_effect = fake_apt_cache
+        fetch.filter_installed_packages(['vim'])
+        fetch.filter_installed_packages(['emacs'])
+        self.assertEquals(cache.call_count, 1)
+
+    @patch('apt_pkg.Cache')
+    def test_apt_cache_not_shared(self, cache):
+        fetch.apt_cache(shared=True)
+        fetch.apt_cache()
+        fetch.apt_cache()
+        self.assertEquals(cache.call_count, 3)
+        self.assertIs(fetch.apt_cache(shared=True),
+                      fetch.apt_cache(shared=True))
+        self.assertEquals(cache.call_count, 3)
+
+    @patch('apt_pkg.config')
+    @patch('apt_pkg.Cache')
+    def test_apt_cache_on_disk(self, cache, config):
+        fetch.apt_cache(in_memory=False)
+        config.set.assert_any_call('Dir::Cache::pkgcache', 'pkgcache.bin')
+        with patch.object(fetch, 'APT_CACHE_IN_MEMORY', True):
+            fetch.apt_cache()
+        config.set.assert_called_with('Dir::Cache::srcpkgcache', '')
+
+    @patch('subprocess.call')
+    @patch.object(fetch, 'log')
+    @patch('apt_pkg.Cache')
+    def test_apt_install_invalidates_cache(self, cache, log, mock_call):
+        cache.side_effect = fake_apt_cache
+        first = fetch.apt_cache(shared=True)
+        fetch.apt_install(['vim'])
+        self.assertIsNot(fetch.apt_cache(shared=True), first)
+        self.assertEquals(cache.call_count, 2)
+
+    @patch('subprocess.check_call')
+    @patch('apt_pkg.Cache')
+    def test_add_source_invalidates_cache(self, cache, check_call):
+        check_call.side_effect = subprocess.CalledProcessError(1, 'cmd')
+        fetch.apt_cache(shared=True)
+        self.assertRaises(subprocess.CalledProcessError,
+                          fetch.add_source, 'ppa:test-ppa')
+        fetch.apt_cache(shared=True)
+        self.assertEquals(cache.call_count, 2)
+
     @patch('apt_pkg.Cache')
     def test_filter_packages_none_missing(self, cache):
         cache.side_effect = fake_apt_cache
@@ -306,6 +391,129 @@ deb http://archive.ubuntu.com/ubuntu precise-proposed main universe multiverse r
         apt_update.assertCalled()
 
 
+class InstalledPackagesTest(TestCase):
+
+    def setUp(self):
+        super(InstalledPackagesTest, self).setUp()
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.status = os.path.join(tmpdir, 'status')
+        self.write_status(DPKG_STATUS)
+        patcher = patch.object(fetch, 'DPKG_STATUS', self.status)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        fetch._installed_packages.clear()
+        self.addCleanup(fetch._installed_packages.clear)
+
+    def write_status(self, content):
+        with open(self.status, 'w') as status:
+            status.write(content)
+
+    def test_installed_packages(self):
+        self.assertEqual(fetch.installed_packages(persist=False), {
+            'vim': '2:7.3.547-6ubuntu5',
+            'vim:amd64': '2:7.3.547-6ubuntu5',
+            'libc6': '2.19-0ubuntu6',
+            'libc6:amd64': '2.19-0ubuntu6',
+            'libc6:i386': '2.19-0ubuntu5',
+        })
+        self.assertEqual(fetch.installed_version('vim'),
+                         '2:7.3.547-6ubuntu5')
+        self.assertEqual(fetch.installed_version('emacs'), None)
+
+    def test_no_status_file(self):
+        os.unlink(self.status)
+        self.assertEqual(fetch.installed_packages(), {})
+
+    @patch.object(fetch, '_read_dpkg_status')
+    def test_reread_when_changed(self, read):
+        read.return_value = {'vim': '1'}
+        fetch.installed_packages(persist=False)
+        fetch.installed_packages(persist=False)
+        self.assertEqual(read.call_count, 1)
+        self.write_status(DPKG_STATUS + '\nPackage: joe\n')
+        fetch.installed_packages(persist=False)
+        self.assertEqual(read.call_count, 2)
+
+    def patch_charm_dir(self):
+        charm = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, charm)
+        patcher = patch.object(fetch, 'charm_dir', return_value=charm)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return os.path.join(charm, fetch.DPKG_INDEX_CACHE)
+
+    @patch.object(fetch, '_read_dpkg_status')
+    def test_persist(self, read):
+        index = self.patch_charm_dir()
+        read.return_value = {'vim': '1'}
+        fetch.installed_packages(persist=True)
+        fetch._installed_packages.clear()
+        self.assertEqual(fetch.installed_packages(persist=True),
+                         {'vim': '1'})
+        self.assertEqual(read.call_count, 1)
+        with open(index) as f:
+            self.assertEqual(json.load(f)['packages'], {'vim': '1'})
+        self.assertEqual(os.listdir(os.path.dirname(index)),
+                         [fetch.DPKG_INDEX_CACHE])
+
+    @patch.object(fetch, '_read_dpkg_status')
+    def test_persist_reread_when_changed(self, read):
+        self.patch_charm_dir()
+        read.return_value = {'vim': '1'}
+        fetch.installed_packages(persist=True)
+        fetch._installed_packages.clear()
+        self.write_status(DPKG_STATUS + '\nPackage: joe\n')
+        read.return_value = {'vim': '1', 'joe': '2'}
+        self.assertEqual(fetch.installed_packages(persist=True),
+                         {'vim': '1', 'joe': '2'})
+        self.assertEqual(read.call_count, 2)
+
+    @patch.object(fetch, '_read_dpkg_status')
+    def test_persist_unwritable(self, read):
+        index = self.patch_charm_dir()
+        os.mkdir(index)
+        read.return_value = {'vim': '1'}
+        self.assertEqual(fetch.installed_packages(persist=True),
+                         {'vim': '1'})
+        self.assertEqual(os.listdir(os.path.dirname(index)),
+                         [fetch.DPKG_INDEX_CACHE])
+
+    @patch.object(unitdata, 'kv')
+    def test_persist_in_charm(self, kv):
+        index = self.patch_charm_dir()
+        fetch.charm_dir.return_value = None
+        fetch.installed_packages()
+        self.assertFalse(os.path.exists(index))
+        fetch._installed_packages.clear()
+        fetch.charm_dir.return_value = os.path.dirname(index)
+        fetch.installed_packages()
+        self.assertTrue(os.path.exists(index))
+        self.assertFalse(kv.called)
+
+    @patch.object(fetch, '_read_dpkg_status')
+    def test_persist_from_worker_thread(self, read):
+        index = self.patch_charm_dir()
+        read.return_value = {'vim': '1'}
+        result = []
+        worker = threading.Thread(target=lambda: result.append(
+            fetch.installed_packages(persist=True)))
+        worker.start()
+        worker.join()
+        self.assertEqual(result, [{'vim': '1'}])
+        self.assertTrue(os.path.exists(index))
+
+    @patch.object(fetch, 'apt_cache')
+    def test_filter_installed_packages(self, apt_cache):
+        self.assertEqual(
+            fetch.filter_installed_packages(['vim', 'libc6:i386']), [])
+        self.assertFalse(apt_cache.called)
+        apt_cache.return_value = fake_apt_cache()
+        self.assertEqual(
+            fetch.filter_installed_packages(['emacs', 'vim']), ['emacs'])
+        apt_cache.assert_called_once_with(shared=True)
+
+
 class InstallTest(TestCase):
 
     def setUp(self):
@@ -665,3 +873,202 @@ class AptTests(TestCase):
 
         fetch._run_apt_command(["some", "command"], fatal=True)
         sleep.assert_called()
+
+    @patch.object(fetch, '_wait_for_apt_lock')
+    @patch('subprocess.check_call')
+    def test_run_apt_command_waits_for_lock(self, check_call, wait):
+        check_call.side_effect = [
+            subprocess.CalledProcessError(returncode=100, cmd='apt-get'),
+            0,
+        ]
+        fetch._run_apt_command(['apt-get', 'update'], fatal=True)
+        self.assertEqual(check_call.call_count, 2)
+        wait.assert_called_once_with(
+            fetch.APT_NO_LOCK_RETRY_DELAY * fetch.APT_NO_LOCK_RETRY_COUNT)
+
+    @patch('time.sleep')
+    @patch.object(fetch, '_apt_lock_held')
+    def test_wait_for_apt_lock_backs_off(self, lock_held, sleep):
+        lock_held.side_effect = [True] * 8 + [False]
+        fetch._wait_for_apt_lock(600)
+        self.assertEqual([c[0][0] for c in sleep.call_args_list],
+                         [0.1, 0.2, 0.4, 0.8, 1.6, 3.2, 6.4, 10])
+
+    @patch('time.time')
+    @patch('time.sleep')
+    @patch.object(fetch, '_apt_lock_held')
+    def test_wait_for_apt_lock_timeout(self, lock_held, sleep, time):
+        lock_held.return_value = True
+        time.side_effect = [100, 100, 130]
+        self.assertRaises(fetch.AptLockError, fetch._wait_for_apt_lock, 30)
+        sleep.assert_called_once_with(0.1)
+
+    def test_apt_lock_held(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        lock = os.path.join(tmpdir, 'lock')
+        open(lock, 'w').close()
+        with patch.object(fetch, 'APT_LOCK_FILES',
+                          (os.path.join(tmpdir, 'missing'), lock)):
+            self.assertFalse(fetch._apt_lock_held())
+            with patch('fcntl.lockf') as lockf:
+                lockf.side_effect = IOError(11, 'Resource unavailable')
+                self.assertTrue(fetch._apt_lock_held())
+
+
+class AptUpdateTest(TestCase):
+
+    def setUp(self):
+        super(AptUpdateTest, self).setUp()
+        self.kv = unitdata.Storage(':memory:')
+        self.sources = {
+            '/etc/apt/sources.list': 'a',
+            '/etc/apt/sources.list.d/cloud-archive.list': 'b',
+            '/etc/apt/trusted.gpg': 'c',
+        }
+        for target, name, value in (
+                (unitdata, 'kv', self.kv),
+                (fetch, 'charm_dir', '/var/lib/juju/charm'),
+                (fetch, 'file_hashes', self.sources),
+                (fetch, '_apt_source_files', []),
+                (fetch, 'log', None)):
+            patcher = patch.object(target, name)
+            patcher.start().return_value = value
+            self.addCleanup(patcher.stop)
+        patcher = patch.object(fetch, '_run_apt_command')
+        self.run_apt = patcher.start()
+        self.run_apt.return_value = 0
+        self.addCleanup(patcher.stop)
+
+    def test_records_sources(self):
+        fetch.apt_update(fatal=True)
+        self.run_apt.assert_called_once_with(['apt-get', 'update'], True)
+        self.assertEqual(self.kv.get('fetch.apt_update')['sources'],
+                         self.sources)
+
+    def test_skipped_when_unchanged(self):
+        fetch.apt_update()
+        fetch.apt_update()
+        self.assertEqual(self.run_apt.call_count, 1)
+
+    def test_force(self):
+        fetch.apt_update()
+        fetch.apt_update(force=True)
+        self.assertEqual(self.run_apt.call_count, 2)
+
+    def test_worker_thread(self):
+        fetch.apt_update()
+        worker = threading.Thread(target=fetch.apt_update)
+        worker.start()
+        worker.join()
+        self.assertEqual(self.run_apt.call_count, 1)
+
+    def test_not_recorded_on_failure(self):
+        self.run_apt.return_value = 100
+        fetch.apt_update()
+        fetch.apt_update()
+        self.assertEqual(self.run_apt.call_count, 2)
+        self.assertIsNone(self.kv.get('fetch.apt_update'))
+
+    @patch('time.time')
+    def test_max_age(self, time):
+        time.return_value = 1000
+        fetch.apt_update()
+        time.return_value = 1000 + fetch.APT_UPDATE_MAX_AGE
+        fetch.apt_update()
+        self.assertEqual(self.run_apt.call_count, 2)
+
+    def test_changed_source_part(self):
+        fetch.apt_update()
+        self.sources['/etc/apt/sources.list.d/cloud-archive.list'] = 'd'
+        self.sources['/etc/apt/sources.list.d/ppa.list'] = 'e'
+        fetch.apt_update()
+        self.assertEqual(self.run_apt.call_args_list[1:], [
+            call(['apt-get', 'update', '-o',
+                  'Dir::Etc::sourcelist=/etc/apt/sources.list.d/%s' % name,
+                  '-o', 'Dir::Etc::sourceparts=-',
+                  '-o', 'APT::Get::List-Cleanup=0'], False)
+            for name in ('cloud-archive.list', 'ppa.list')])
+        fetch.apt_update()
+        self.assertEqual(self.run_apt.call_count, 3)
+
+    def test_changed_keyring(self):
+        fetch.apt_update()
+        self.sources['/etc/apt/trusted.gpg'] = 'd'
+        fetch.apt_update()
+        self.run_apt.assert_called_with(['apt-get', 'update'], False)
+
+    def test_removed_source_part(self):
+        fetch.apt_update()
+        del self.sources['/etc/apt/sources.list.d/cloud-archive.list']
+        fetch.apt_update()
+        self.run_apt.assert_called_with(['apt-get', 'update'], False)
+
+    def test_outside_charm(self):
+        fetch.charm_dir.return_value = None
+        fetch.apt_update()
+        fetch.apt_update()
+        self.assertEqual(self.run_apt.call_count, 2)
+        self.assertIsNone(self.kv.get('fetch.apt_update'))
+
+
+class AptBatchTest(TestCase):
+
+    @patch.object(fetch, 'apt_hold')
+    @patch.object(fetch, 'apt_purge')
+    @patch.object(fetch, 'apt_install')
+    def test_commit(self, apt_install, apt_purge, apt_hold):
+        with fetch.apt_batch() as batch:
+            batch.install(['haproxy', 'keepalived'])
+            batch.install('haproxy vim', fatal=True)
+            batch.purge(['apache2', 'vim'])
+            batch.hold('haproxy')
+            self.assertFalse(apt_install.called)
+        apt_install.assert_called_once_with(
+            ['keepalived', 'haproxy', 'apache2-', 'vim-'],
+            ['--option=Dpkg::Options::=--force-confold', '--purge'], True)
+        apt_hold.assert_called_once_with(['haproxy'], True)
+        self.assertFalse(apt_purge.called)
+
+    @patch.object(fetch, 'apt_purge')
+    @patch.object(fetch, 'apt_install')
+    def test_commit_purge_only(self, apt_install, apt_purge):
+        with fetch.apt_batch() as batch:
+            batch.install('vim')
+            batch.purge('vim')
+        apt_purge.assert_called_once_with(['vim'], False)
+        self.assertFalse(apt_install.called)
+
+    @patch.object(fetch, 'apt_install')
+    def test_options(self, apt_install):
+        with fetch.apt_batch() as batch:
+            batch.install('vim', options=['--foo'])
+            batch.install('joe')
+            batch.install('emacs', options=['--foo'])
+        self.assertEqual(apt_install.call_args_list, [
+            call(['vim', 'emacs'], ['--foo'], False),
+            call(['joe'], ['--option=Dpkg::Options::=--force-confold'],
+                 False),
+        ])
+
+    @patch.object(fetch, 'apt_install')
+    def test_nested(self, apt_install):
+        with fetch.apt_batch() as outer:
+            with fetch.apt_batch() as inner:
+                self.assertIs(inner, outer)
+                self.assertIs(fetch.current_apt_batch(), outer)
+                inner.install('vim')
+            self.assertFalse(apt_install.called)
+            outer.install('joe')
+        self.assertEqual(apt_install.call_count, 1)
+        self.assertIsNone(fetch.current_apt_batch())
+
+    @patch.object(fetch, 'apt_install')
+    def test_discarded_on_error(self, apt_install):
+        def install():
+            with fetch.apt_batch() as batch:
+                batch.install('vim')
+                raise ValueError()
+        self.assertRaises(ValueError, install)
+        self.assertFalse(apt_install.called)
+        self.assertIsNone(fetch.current_apt_batch())